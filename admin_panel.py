@@ -18,13 +18,15 @@ from pathlib import Path
 from typing import List, Optional
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Form, Request
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel
 import secrets
 
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, MetricsRegistry
+
 # Carica variabili d'ambiente
 try:
     from dotenv import load_dotenv
@@ -90,6 +92,30 @@ def get_db():
 
 app = FastAPI(title="RAG Admin Panel", version="1.0.0")
 
+# ============================================================================
+# METRICHE (Prometheus, endpoint /metrics)
+# ============================================================================
+
+def documents_stat(attribute: str) -> float:
+    """Numero ("count") o dimensione totale ("bytes") dei documenti caricati"""
+    files = [p for p in DOCUMENTS_PATH.glob("*") if p.is_file() and p.suffix.lower() in ALLOWED_EXTENSIONS]
+    if attribute == "count":
+        return len(files)
+    return sum(p.stat().st_size for p in files)
+
+
+metrics = MetricsRegistry()
+UPLOADED_FILES = metrics.counter("rag_admin_uploaded_files_total", "File caricati", ["result"])
+UPLOADED_BYTES = metrics.counter("rag_admin_uploaded_bytes_total", "Byte caricati")
+REINDEX_REQUESTS = metrics.counter("rag_admin_reindex_requests_total", "Reindicizzazioni richieste", ["result"])
+REINDEX_DURATION = metrics.histogram(
+    "rag_admin_reindex_duration_seconds", "Durata della chiamata /reload all'API Server",
+    buckets=(0.5, 1, 5, 15, 30, 60, 120, 300),
+)
+metrics.gauge("rag_admin_documents", "Documenti nella cartella documenti", function=lambda: documents_stat("count"))
+metrics.gauge("rag_admin_documents_bytes", "Dimensione totale dei documenti", function=lambda: documents_stat("bytes"))
+app.add_middleware(MetricsMiddleware, registry=metrics, prefix="rag_admin")
+
 # Security
 security = HTTPBasic()
 
@@ -485,6 +511,7 @@ async def upload_files(
         ext = Path(file.filename).suffix.lower()
         if ext not in ALLOWED_EXTENSIONS:
             errors.append(f"{file.filename}: formato non supportato")
+            UPLOADED_FILES.labels(result="rejected").inc()
             continue
         
         try:
@@ -500,6 +527,7 @@ async def upload_files(
             with open(file_path, "wb") as f:
                 content = await file.read()
                 f.write(content)
+            UPLOADED_BYTES.inc(len(content))
             
             # Registra nel database
             cursor.execute("""
@@ -508,8 +536,10 @@ async def upload_files(
             """, (file_path.name, file.filename, len(content), ext))
             
             uploaded += 1
+            UPLOADED_FILES.labels(result="ok").inc()
             
         except Exception as e:
+            UPLOADED_FILES.labels(result="error").inc()
             errors.append(f"{file.filename}: {str(e)}")
     
     conn.commit()
@@ -582,7 +612,9 @@ async def reindex(username: str = Depends(verify_admin)):
         import httpx
         try:
             async with httpx.AsyncClient(timeout=120.0) as client:  # Timeout 2 minuti per indicizzazione
-                response = await client.post("http://localhost:8000/reload")
+                with REINDEX_DURATION.time():
+                    response = await client.post("http://localhost:8000/reload")
+                REINDEX_REQUESTS.labels(result="ok" if response.status_code == 200 else "error").inc()
                 
                 if response.status_code == 200:
                     result = response.json()
@@ -603,9 +635,11 @@ async def reindex(username: str = Depends(verify_admin)):
                     message = f"⚠️ Reindicizzazione richiesta ma API Server ha risposto con errore (status {response.status_code})"
                     msg_type = "warning"
         except httpx.ConnectError:
+            REINDEX_REQUESTS.labels(result="unreachable").inc()
             message = "⚠️ API Server non raggiungibile. Assicurati che sia in esecuzione su porta 8000, poi riavvialo manualmente."
             msg_type = "warning"
         except httpx.TimeoutException:
+            REINDEX_REQUESTS.labels(result="timeout").inc()
             message = "⚠️ Reindicizzazione in corso... Potrebbe richiedere alcuni minuti. Ricarica la pagina tra poco."
             msg_type = "info"
         except Exception as e:
@@ -635,6 +669,12 @@ async def health():
     return {"status": "ok", "service": "admin-panel"}
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Metriche in formato Prometheus"""
+    return Response(content=metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+
 # ============================================================================
 # MAIN
 # ============================================================================
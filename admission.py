@@ -0,0 +1,114 @@
+"""
+Admission Control - Limite di concorrenza per le query
+=======================================================
+Le query RAG sono asincrone: centinaia di richieste possono attendere
+Gemini senza occupare thread. Per non sovraccaricare Gemini (e la memoria)
+al massimo max_concurrent query sono eseguite insieme; le altre attendono
+in una coda limitata a max_queue posti.
+
+- Coda piena → rifiuto immediato con 429 e Retry-After
+- Attesa in coda oltre queue_timeout → 503 con Retry-After
+
+Retry-After è stimato dalla durata media delle query (media mobile
+esponenziale) e dalla lunghezza della coda.
+"""
+
+import math
+import time
+import asyncio
+from typing import Optional
+
+
+class AdmissionRejected(Exception):
+    """Richiesta non ammessa: status_code HTTP (429/503) e secondi di Retry-After"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """Posto di esecuzione acquisito; release() è idempotente"""
+
+    def __init__(self, controller: "AdmissionController"):
+        self._controller = controller
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(time.monotonic() - self._started)
+
+
+class AdmissionController:
+    """
+    Semaforo asincrono con coda di attesa limitata.
+
+    Args:
+        max_concurrent: Query eseguite contemporaneamente
+        max_queue: Richieste in attesa oltre le quali si risponde 429
+        queue_timeout: Secondi massimi di attesa in coda prima del 503
+        initial_service_time: Stima iniziale della durata di una query (secondi)
+    """
+
+    def __init__(self, max_concurrent: int = 32, max_queue: int = 100, queue_timeout: float = 30.0,
+                 initial_service_time: float = 3.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._avg_service_time = initial_service_time
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def retry_after(self) -> int:
+        """Secondi stimati prima che si liberi un posto per una nuova richiesta"""
+        estimate = self._avg_service_time * (self.waiting + 1) / self.max_concurrent
+        return max(1, math.ceil(estimate))
+
+    async def acquire(self) -> AdmissionTicket:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        if self.waiting == 0 and not self._semaphore.locked():
+            # Posto libero e nessuno in coda: acquisizione immediata
+            await self._semaphore.acquire()
+        else:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise AdmissionRejected(429, "Troppe richieste in coda, riprova più tardi", self.retry_after())
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                raise AdmissionRejected(503, "Servizio sovraccarico, riprova più tardi", self.retry_after())
+            finally:
+                self.waiting -= 1
+
+        self.in_flight += 1
+        self.admitted += 1
+        return AdmissionTicket(self)
+
+    def _release(self, duration: float):
+        self.in_flight -= 1
+        self._avg_service_time = 0.9 * self._avg_service_time + 0.1 * duration
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_service_time": round(self._avg_service_time, 3),
+        }
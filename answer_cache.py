@@ -0,0 +1,207 @@
+"""
+Answer Cache - Cache delle risposte a due livelli
+==================================================
+Cache in memoria delle risposte RAG davanti a run_query:
+
+1. Livello esatto: chiave = domanda normalizzata + contesto conversazione.
+2. Livello semantico: restituisce una risposta già calcolata se l'embedding
+   della query è entro una soglia di similarità coseno da uno in cache
+   (stesso contesto conversazione).
+
+Le voci hanno scadenza (TTL), eviction LRU e un limite di memoria, e sono
+invalidate automaticamente quando cambia la generazione dell'indice.
+"""
+
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """Normalizza una domanda: minuscole, spazi compattati, punteggiatura finale rimossa"""
+    text = re.sub(r"\s+", " ", text.strip().lower())
+    return text.rstrip(" ?!.;:")
+
+
+def _hash(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+@dataclass
+class CachedAnswer:
+    """Risposta in cache (testo completo di fonti) con i metadati per l'eviction"""
+    answer: str
+    num_sources: int
+    sources: List[Dict[str, Any]] = field(default_factory=list)
+    context_key: str = ""
+    embedding: Optional[np.ndarray] = None
+    created_at: float = field(default_factory=time.time)
+    size_bytes: int = 0
+
+
+class AnswerCache:
+    """
+    Cache LRU + TTL delle risposte, con livello esatto e semantico.
+
+    Args:
+        max_entries: Numero massimo di risposte in cache
+        max_bytes: Memoria massima stimata (testo + embedding)
+        ttl_seconds: Durata di una voce
+        similarity_threshold: Similarità coseno minima per un hit semantico
+    """
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024,
+                 ttl_seconds: float = 3600, similarity_threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, CachedAnswer]" = OrderedDict()
+        self._bytes = 0
+        self._generation: Optional[int] = None
+        # Matrice degli embedding per contesto, ricostruita solo se cambia la cache
+        self._matrices: Dict[str, Any] = {}
+
+        self.hits_exact = 0
+        self.hits_semantic = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # ------------------------------------------------------------------
+    # API pubblica
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def make_key(question: str, conversation_context: str = "") -> str:
+        return _hash(normalize_text(question), normalize_text(conversation_context))
+
+    @staticmethod
+    def make_context_key(conversation_context: str = "") -> str:
+        return _hash(normalize_text(conversation_context))
+
+    def get(self, question: str, conversation_context: str, generation: int) -> Optional[CachedAnswer]:
+        """Livello esatto (non conta un miss: segue la ricerca semantica)"""
+        key = self.make_key(question, conversation_context)
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.hits_exact += 1
+            return entry
+
+    def get_similar(self, embedding: List[float], conversation_context: str, generation: int) -> Optional[CachedAnswer]:
+        """Livello semantico: voce più simile con similarità >= soglia"""
+        context_key = self.make_context_key(conversation_context)
+        query = _normalize(embedding)
+        with self._lock:
+            self._check_generation(generation)
+            keys, matrix = self._context_matrix(context_key)
+            if matrix is not None:
+                scores = matrix @ query
+                best = int(np.argmax(scores))
+                key = keys[best]
+                entry = self._entries.get(key)
+                if scores[best] >= self.similarity_threshold and entry is not None and not self._expired(entry):
+                    self._entries.move_to_end(key)
+                    self.hits_semantic += 1
+                    return entry
+            self.misses += 1
+            return None
+
+    def put(self, question: str, conversation_context: str, generation: int, answer: str,
+            num_sources: int, sources: Optional[List[Dict[str, Any]]] = None,
+            embedding: Optional[List[float]] = None):
+        """Inserisce una risposta calcolata sulla generazione indicata"""
+        key = self.make_key(question, conversation_context)
+        vector = _normalize(embedding) if embedding is not None else None
+        entry = CachedAnswer(
+            answer=answer,
+            num_sources=num_sources,
+            sources=sources or [],
+            context_key=self.make_context_key(conversation_context),
+            embedding=vector,
+            size_bytes=len(answer.encode("utf-8")) + (vector.nbytes if vector is not None else 0) + 256,
+        )
+        with self._lock:
+            self._check_generation(generation)
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size_bytes
+            self._matrices.pop(entry.context_key, None)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrices.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits_exact + self.hits_semantic + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits_exact": self.hits_exact,
+            "hits_semantic": self.hits_semantic,
+            "misses": self.misses,
+            "hit_rate": round((self.hits_exact + self.hits_semantic) / lookups, 3) if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "generation": self._generation,
+        }
+
+    # ------------------------------------------------------------------
+    # Interni (chiamati con il lock acquisito)
+    # ------------------------------------------------------------------
+
+    def _check_generation(self, generation: int):
+        """Svuota la cache quando l'indice passa a una generazione più recente"""
+        if self._generation is None or generation > self._generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._matrices.clear()
+            self._bytes = 0
+            self._generation = generation
+
+    def _expired(self, entry: CachedAnswer) -> bool:
+        return time.time() - entry.created_at > self.ttl_seconds
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size_bytes
+        self._matrices.pop(entry.context_key, None)
+
+    def _context_matrix(self, context_key: str):
+        cached = self._matrices.get(context_key)
+        if cached is None:
+            keys = [k for k, e in self._entries.items() if e.context_key == context_key and e.embedding is not None]
+            matrix = np.stack([self._entries[k].embedding for k in keys]) if keys else None
+            cached = self._matrices[context_key] = (keys, matrix)
+        return cached
+
+
+def _normalize(embedding) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
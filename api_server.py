@@ -9,18 +9,26 @@ Per eseguire:
 """
 
 import os
+import json
+import base64
 import time
+import shutil
 import uuid
 import traceback
+import importlib.util
 import asyncio
+import contextvars
 from pathlib import Path
-from typing import List, Optional, Dict, Any
-from contextlib import asynccontextmanager
+from typing import List, Optional, Dict, Any, Union
+from contextlib import asynccontextmanager, contextmanager
 from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
+import numpy as np
 
 # Carica variabili d'ambiente
 try:
@@ -30,25 +38,23 @@ try:
 except ImportError:
     print("⚠️ python-dotenv non installato, uso variabili d'ambiente di sistema")
 
-# Importazioni LlamaIndex
-try:
-    from llama_index.core import (
-        VectorStoreIndex,
-        SimpleDirectoryReader,
-        Settings,
-        StorageContext,
-        load_index_from_storage,
-    )
-    from llama_index.llms.google_genai import GoogleGenAI
-    from llama_index.embeddings.google_genai import GoogleGenAIEmbedding
-    from llama_index.core.retrievers import VectorIndexRetriever
-    from llama_index.core.query_engine import RetrieverQueryEngine
-    import google.generativeai as genai
-    print("✅ Librerie LlamaIndex importate")
-except ImportError as e:
-    print(f"❌ Errore: {e}")
-    print("Esegui: pip install llama-index llama-index-llms-google-genai llama-index-embeddings-google-genai google-generativeai fastapi uvicorn")
-    exit(1)
+# LlamaIndex, Gemini e i moduli che ne dipendono vengono importati in
+# background da import_rag_libraries(): il server accetta connessioni
+# (/livez, /readyz) in meno di un secondo
+
+from index_manifest import BuildCheckpoint, IndexManifest, bootstrap_manifest, scan_documents, sync_index
+from engine_state import EngineGeneration, EngineHolder, LoadProgress
+from admission import AdmissionController, AdmissionRejected, AdmissionTicket
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, MetricsRegistry
+from tracing import (
+    TracingMiddleware, current_trace, instrument_llama_index, logger, setup_logging, shutdown_logging, span,
+)
+from answer_cache import AnswerCache
+from embedding_pipeline import EmbeddingPipeline, EmbeddingMicroBatcher, estimate_tokens, llama_index_embed_fn
+from document_parser import DocumentParser
+from parsed_cache import ParsedTextCache
+from condense import QuestionCondenser
+from conversation_store import ConversationState, ConversationStore
 
 
 # ============================================================================
@@ -60,11 +66,283 @@ PERSIST_DIR = "./storage"
 MODEL_NAME = "gemini-2.0-flash"
 EMBEDDING_MODEL = "models/text-embedding-004"
 
-# Variabili globali per il query engine
-query_engine = None
-index = None
-llm = None
-executor = ThreadPoolExecutor(max_workers=4)
+# Directory per la reindicizzazione blue/green
+PERSIST_STAGING_DIR = "./storage_staging"
+PERSIST_OLD_DIR = "./storage_old"
+DRAIN_TIMEOUT = 120  # secondi di attesa per le richieste sulla vecchia generazione
+
+# Più worker uvicorn (--workers N): docstore in memory-map in sola lettura,
+# una copia nella page cache per tutti i processi (vedi shared_index.py).
+# Attivo di default solo con più worker (WEB_CONCURRENCY, impostato anche da
+# --workers): con un solo processo costerebbe esportazione e doppio caricamento
+# a ogni avvio e /reload. Mai di default su Windows: niente fcntl per il lock
+# tra processi e le directory mappate da altri worker non si possono sostituire
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1") or "1")
+SHARED_INDEX_SUPPORTED = os.name != "nt" and importlib.util.find_spec("fcntl") is not None
+SHARED_INDEX_DEFAULT = "true" if SHARED_INDEX_SUPPORTED and WEB_CONCURRENCY > 1 else "false"
+SHARED_INDEX = os.getenv("SHARED_INDEX", SHARED_INDEX_DEFAULT).lower() in ("1", "true", "yes")
+INDEX_GENERATION_PATH = PERSIST_DIR + ".generation"  # token della versione su disco
+INDEX_LOCK_PATH = PERSIST_DIR + ".lock"  # un solo processo alla volta costruisce l'indice
+INDEX_WATCH_INTERVAL = float(os.getenv("INDEX_WATCH_INTERVAL", "5"))  # secondi tra i controlli della generazione
+
+# Cache delle risposte (esatta + semantica), invalidata a ogni nuova generazione
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_MAX_MB = int(os.getenv("ANSWER_CACHE_MAX_MB", "64"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))  # secondi
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+# Ingestione: lettura dei file in un pool di processi (vedi document_parser.py)
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 1)))  # 0 = nel processo del server
+PARSE_TIMEOUT = float(os.getenv("PARSE_TIMEOUT", "300"))  # secondi per file
+PARSE_MEMORY_LIMIT_MB = int(os.getenv("PARSE_MEMORY_LIMIT_MB", "4096"))  # per worker, 0 = nessun limite
+# Testo estratto in cache per hash del contenuto: i file invariati non vengono riletti (vedi parsed_cache.py)
+PARSED_CACHE_PATH = os.getenv("PARSED_CACHE_PATH", "./cache/parsed.sqlite")
+PARSED_CACHE_MAX_MB = int(os.getenv("PARSED_CACHE_MAX_MB", "1024"))
+
+# Ingestione: embedding dei chunk a batch concorrenti, entro le quote Gemini
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_REQUESTS_PER_MINUTE = int(os.getenv("EMBED_REQUESTS_PER_MINUTE", "1500"))
+EMBED_TOKENS_PER_MINUTE = int(os.getenv("EMBED_TOKENS_PER_MINUTE", "1000000"))
+# Ingestione a flusso: chunk per batch di embedding/scrittura (0 = batch × concorrenza) e
+# capacità delle code tra gli stadi; limitano la memoria di lavoro (vedi ingestion.py)
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "0"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "8"))
+# Secondi tra due checkpoint di una sincronizzazione (indice e manifest salvati in corso d'opera;
+# dopo un errore o un crash si riparte da lì). 0 = checkpoint solo in caso di errore
+INDEX_CHECKPOINT_INTERVAL = float(os.getenv("INDEX_CHECKPOINT_INTERVAL", "300"))
+
+# Endpoint /v1/embeddings: richieste concorrenti unite in micro-batch
+EMBEDDINGS_BATCH_WINDOW_MS = float(os.getenv("EMBEDDINGS_BATCH_WINDOW_MS", "5"))
+EMBEDDINGS_MAX_BATCH = int(os.getenv("EMBEDDINGS_MAX_BATCH", "100"))
+
+# Vector store: "exact" (NumPy, ricerca esatta) o "ivf" (ANN per corpus molto grandi)
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "exact")
+IVF_NLIST = int(os.getenv("IVF_NLIST", "0"))  # 0 = automatico (circa 4·√N)
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))  # più alto = recall migliore, più lento
+
+# Retrieval ibrido: BM25 (codici errore, SKU, voci di menu) + vettoriale, fusi con RRF
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "true").lower() in ("1", "true", "yes")
+SIMILARITY_TOP_K = int(os.getenv("SIMILARITY_TOP_K", "8"))  # chunk recuperati, poi filtrati dal context assembly
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))  # candidati per lista prima della fusione
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# Diversificazione MMR: molti candidati recuperati, SIMILARITY_TOP_K diversi tenuti (vedi mmr.py)
+MMR_ENABLED = os.getenv("MMR_ENABLED", "true").lower() in ("1", "true", "yes")
+MMR_CANDIDATES = int(os.getenv("MMR_CANDIDATES", "50"))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))  # 1 = solo rilevanza, 0 = solo diversità
+
+# Chunk quasi duplicati (revisioni e copie dello stesso manuale): un solo embedding e un
+# solo risultato per gruppo, con tutti i file nelle fonti (vedi near_duplicates.py)
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() in ("1", "true", "yes")
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.9"))  # similarità di Jaccard stimata (MinHash)
+
+# Context assembly: contesto passato al LLM (vedi context_assembly.py)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_RELATIVE_CUTOFF = float(os.getenv("CONTEXT_RELATIVE_CUTOFF", "0.5"))  # frazione della similarità (coseno) migliore
+
+# Follow-up riscritti come domande autonome per il retrieval (vedi condense.py)
+CONDENSE_QUESTIONS = os.getenv("CONDENSE_QUESTIONS", "true").lower() in ("1", "true", "yes")
+CONDENSE_CACHE_MAX_ENTRIES = int(os.getenv("CONDENSE_CACHE_MAX_ENTRIES", "1000"))
+
+# Stato delle conversazioni lato server (vedi conversation_store.py)
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "true").lower() in ("1", "true", "yes")
+CONVERSATION_MAX_ENTRIES = int(os.getenv("CONVERSATION_MAX_ENTRIES", "1000"))
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "86400"))  # secondi di inattività
+CONVERSATION_DB_PATH = os.getenv("CONVERSATION_DB_PATH", "")  # vuoto = solo memoria
+CONVERSATION_WINDOW = int(os.getenv("CONVERSATION_WINDOW", "6"))  # messaggi recenti nel contesto
+CONVERSATION_SUMMARY = os.getenv("CONVERSATION_SUMMARY", "true").lower() in ("1", "true", "yes")
+
+# Admission control delle query (asincrone: l'attesa di Gemini non occupa thread)
+QUERY_MAX_CONCURRENCY = int(os.getenv("QUERY_MAX_CONCURRENCY", "32"))
+QUERY_MAX_QUEUE = int(os.getenv("QUERY_MAX_QUEUE", "100"))
+QUERY_QUEUE_TIMEOUT = float(os.getenv("QUERY_QUEUE_TIMEOUT", "30"))  # secondi, poi 503
+
+# Logging strutturato delle richieste (json o text) e header Server-Timing
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+SERVER_TIMING_HEADER = os.getenv("SERVER_TIMING_HEADER", "true").lower() in ("1", "true", "yes")
+
+# Cache persistente degli embedding (condivisa tra riavvii e processi)
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./cache/embeddings.sqlite")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+
+# Generazione corrente del motore RAG (indice, query engine, llm)
+engines = EngineHolder()
+admission = AdmissionController(
+    max_concurrent=QUERY_MAX_CONCURRENCY,
+    max_queue=QUERY_MAX_QUEUE,
+    queue_timeout=QUERY_QUEUE_TIMEOUT,
+)
+answer_cache = AnswerCache(
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    max_bytes=ANSWER_CACHE_MAX_MB * 1024 * 1024,
+    ttl_seconds=ANSWER_CACHE_TTL,
+    similarity_threshold=ANSWER_CACHE_SIMILARITY,
+)
+# Creati da import_rag_libraries() insieme agli import pesanti:
+# cache persistenti degli embedding e del testo estratto, MMR (da MMR_CANDIDATES candidati a
+# SIMILARITY_TOP_K risultati diversi) e selezione del contesto entro il budget di token
+embedding_cache = None
+parsed_text_cache = None
+mmr_reranker = None
+context_assembler = None
+# Versione dell'indice su disco condivisa tra i worker (creata da import_rag_libraries)
+index_generation = None
+# Executor dedicato alle reindicizzazioni: non sottrae thread alle query
+# e serializza /reload concorrenti
+reload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reload")
+reload_future = None
+# Avanzamento del caricamento all'avvio (/readyz)
+startup = LoadProgress()
+startup_future = None
+# Domande autonome per il retrieval dei follow-up, in cache per conversazione
+question_condenser = QuestionCondenser(max_entries=CONDENSE_CACHE_MAX_ENTRIES)
+# Cronologia elaborata, riassunto e ultimi nodi recuperati per conversazione
+conversation_store = ConversationStore(
+    max_entries=CONVERSATION_MAX_ENTRIES,
+    ttl_seconds=CONVERSATION_TTL,
+    db_path=CONVERSATION_DB_PATH or None,
+) if CONVERSATION_STORE else None
+# Riassunti in corso (riferimenti forti ai task in background)
+summary_tasks: set = set()
+# Micro-batcher dell'endpoint /v1/embeddings (creato da configure_models)
+embedding_batcher: Optional[EmbeddingMicroBatcher] = None
+# File non leggibili nell'ultima sincronizzazione (percorso → errore), ritentati alla successiva
+parse_failures: Dict[str, str] = {}
+# Ultima sincronizzazione dell'indice: esito, ripresa da un checkpoint o da zero, avanzamento
+last_build: Dict[str, Any] = {}
+
+setup_logging(LOG_LEVEL, LOG_FORMAT)
+_rag_libraries_loaded = False
+
+
+def import_rag_libraries():
+    """
+    Import pesanti (LlamaIndex, Gemini, vector store, BM25) e componenti
+    che ne dipendono. Chiamata in background da setup_rag: l'avvio di
+    uvicorn e le probe non aspettano questi import.
+    """
+    global _rag_libraries_loaded, embedding_cache, parsed_text_cache, mmr_reranker, context_assembler, index_generation
+    global VectorStoreIndex, Settings, StorageContext, load_index_from_storage, PromptTemplate, QueryBundle
+    global get_response_synthesizer, GoogleGenAI, GoogleGenAIEmbedding, VectorIndexRetriever, RetrieverQueryEngine
+    global genai, EmbeddingCache, CachedEmbedding, NumpyVectorStore, IVFVectorStore, BM25Index, HybridRetriever
+    global NearDuplicateIndex
+    global SharedDocumentStore, GenerationFile, export_docstore, has_shared_docstore, index_build_lock
+    if _rag_libraries_loaded:
+        return
+    
+    # Importazioni LlamaIndex
+    try:
+        from llama_index.core import (
+            VectorStoreIndex,
+            Settings,
+            StorageContext,
+            load_index_from_storage,
+            PromptTemplate,
+            QueryBundle,
+            get_response_synthesizer,
+        )
+        from llama_index.llms.google_genai import GoogleGenAI
+        from llama_index.embeddings.google_genai import GoogleGenAIEmbedding
+        from llama_index.core.retrievers import VectorIndexRetriever
+        from llama_index.core.query_engine import RetrieverQueryEngine
+        import google.generativeai as genai
+        print("✅ Librerie LlamaIndex importate")
+    except ImportError as e:
+        print(f"❌ Errore: {e}")
+        print("Esegui: pip install llama-index llama-index-llms-google-genai llama-index-embeddings-google-genai google-generativeai fastapi uvicorn")
+        raise
+    
+    from embedding_cache import EmbeddingCache, CachedEmbedding
+    from numpy_vector_store import NumpyVectorStore
+    from ivf_vector_store import IVFVectorStore
+    from bm25_index import BM25Index, HybridRetriever
+    from near_duplicates import NearDuplicateIndex
+    from context_assembly import ContextAssembler
+    from mmr import MMRReranker
+    from shared_index import SharedDocumentStore, GenerationFile, export_docstore, has_shared_docstore, index_build_lock
+    
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES)
+    parsed_text_cache = ParsedTextCache(PARSED_CACHE_PATH, max_mb=PARSED_CACHE_MAX_MB)
+    mmr_reranker = MMRReranker(top_k=SIMILARITY_TOP_K, lambda_mult=MMR_LAMBDA) if MMR_ENABLED else None
+    context_assembler = ContextAssembler(token_budget=CONTEXT_TOKEN_BUDGET, relative_cutoff=CONTEXT_RELATIVE_CUTOFF)
+    index_generation = GenerationFile(INDEX_GENERATION_PATH)
+    instrument_llama_index()
+    _rag_libraries_loaded = True
+
+
+# ============================================================================
+# METRICHE (Prometheus, endpoint /metrics)
+# ============================================================================
+
+def index_disk_bytes() -> int:
+    """Dimensione su disco della directory dell'indice corrente"""
+    persist_dir = engines.current.persist_dir
+    if not persist_dir or not os.path.exists(persist_dir):
+        return 0
+    return sum(p.stat().st_size for p in Path(persist_dir).rglob("*") if p.is_file())
+
+
+def index_vector_bytes() -> int:
+    """Memoria della matrice degli embedding dell'indice corrente"""
+    index = engines.current.index
+    return getattr(index.vector_store, "nbytes", 0) if index is not None else 0
+
+
+metrics = MetricsRegistry()
+STAGE_LATENCY = metrics.histogram(
+    "rag_stage_duration_seconds", "Durata delle fasi della pipeline RAG", ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+QUERIES = metrics.counter("rag_queries_total", "Query per modalità ed esito", ["mode", "result"])
+LLM_TOKENS = metrics.counter("rag_llm_tokens_total", "Token inviati e generati dal LLM", ["kind"])
+CONTEXT_TOKENS = metrics.histogram(
+    "rag_context_tokens", "Token di contesto passati al LLM per query",
+    buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 16000),
+)
+CONTEXT_CHUNKS_DROPPED = metrics.counter(
+    "rag_context_chunks_dropped_total", "Chunk recuperati non passati al LLM", ["reason"])
+ADMISSION_REJECTED = metrics.counter("rag_admission_rejected_total", "Query rifiutate dall'admission control", ["status"])
+metrics.gauge("rag_query_in_flight", "Query in esecuzione", function=lambda: admission.in_flight)
+metrics.gauge("rag_query_queue_depth", "Query in attesa di un posto di esecuzione", function=lambda: admission.waiting)
+metrics.gauge("rag_reload_in_progress", "1 se una reindicizzazione è in corso", function=lambda: reload_in_progress())
+INGESTED_FILES = metrics.counter("rag_ingestion_files_total", "File elaborati in ingestione", ["change"])
+INGESTED_CHUNKS = metrics.counter("rag_ingestion_chunks_total", "Chunk embeddati e indicizzati")
+INGESTED_CACHED_EMBEDDINGS = metrics.counter(
+    "rag_ingestion_embedding_cache_hits_total", "Chunk indicizzati con l'embedding dalla cache persistente")
+INGESTED_DUPLICATES = metrics.counter(
+    "rag_ingestion_duplicate_chunks_total", "Chunk quasi duplicati indicizzati con l'embedding del loro originale")
+INGESTION_BUILDS = metrics.counter(
+    "rag_ingestion_builds_total", "Sincronizzazioni dell'indice (da zero o riprese da un checkpoint) per esito",
+    ["mode", "result"])
+INGESTION_DURATION = metrics.histogram(
+    "rag_ingestion_duration_seconds", "Durata delle sincronizzazioni dell'indice",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+INGESTION_THROUGHPUT = metrics.gauge("rag_ingestion_chunks_per_second", "Throughput di embedding dell'ultima ingestione")
+INGESTION_STAGE_THROUGHPUT = metrics.gauge(
+    "rag_ingestion_stage_per_second", "Throughput di ogni stadio dell'ultima ingestione (file/s o chunk/s)", ["stage"])
+metrics.gauge("rag_index_generation", "Generazione corrente dell'indice", function=lambda: engines.generation)
+metrics.gauge(
+    "rag_index_chunks", "Chunk nell'indice corrente",
+    function=lambda: len(engines.current.index.index_struct.nodes_dict) if engines.current.index is not None else 0,
+)
+INDEX_BYTES = metrics.gauge("rag_index_bytes", "Dimensione dell'indice corrente", ["kind"])
+INDEX_BYTES.labels(kind="disk").set_function(index_disk_bytes)
+INDEX_BYTES.labels(kind="vectors").set_function(index_vector_bytes)
+metrics.gauge("rag_answer_cache_entries", "Risposte in cache", function=lambda: answer_cache.stats()["entries"])
+metrics.gauge("rag_condense_cache_hit_ratio", "Hit rate della cache delle domande riscritte",
+              function=lambda: question_condenser.stats()["hit_rate"])
+metrics.gauge("rag_embedding_cache_hit_ratio", "Hit rate della cache degli embedding",
+              function=lambda: embedding_cache.stats()["hit_rate"] if embedding_cache is not None else 0)
+
+
+@contextmanager
+def stage(name: str):
+    """Fase della pipeline di query: istogramma Prometheus + span della richiesta"""
+    with span(name), STAGE_LATENCY.labels(stage=name).time():
+        yield
 
 
 # ============================================================================
@@ -106,6 +384,38 @@ class ChatCompletionResponse(BaseModel):
     usage: Usage = Field(default_factory=Usage)
 
 
+class DeltaMessage(BaseModel):
+    role: Optional[str] = None
+    content: Optional[str] = None
+
+
+class ChatCompletionChunkChoice(BaseModel):
+    index: int = 0
+    delta: DeltaMessage
+    finish_reason: Optional[str] = None
+
+
+class ChatCompletionChunk(BaseModel):
+    id: str
+    object: str = "chat.completion.chunk"
+    created: int = Field(default_factory=lambda: int(time.time()))
+    model: str
+    choices: List[ChatCompletionChunkChoice]
+    # Usage nell'ultimo chunk, come OpenAI con stream_options.include_usage
+    usage: Optional[Usage] = None
+    # Estensioni non-OpenAI: fonti strutturate, inviate appena termina il retrieval,
+    # e latenze per fase (ms) nell'ultimo chunk
+    sources: Optional[List[Dict[str, Any]]] = None
+    timings: Optional[Dict[str, float]] = None
+
+
+class EmbeddingRequest(BaseModel):
+    model: str = Field(default=EMBEDDING_MODEL, description="Model ID")
+    input: Union[str, List[str]] = Field(..., description="Testo o lista di testi")
+    encoding_format: Optional[str] = Field(default="float", description="float o base64")
+    user: Optional[str] = None
+
+
 class ModelInfo(BaseModel):
     id: str
     object: str = "model"
@@ -118,14 +428,50 @@ class ModelsResponse(BaseModel):
     data: List[ModelInfo]
 
 
+# ============================================================================
+# PROMPT E FORMATTAZIONE RISPOSTE
+# ============================================================================
+
+# Prompt personalizzato per risposte più dettagliate
+QA_PROMPT_STR = (
+    "Sei un assistente helpdesk esperto e cordiale. "
+    "Rispondi sempre in italiano in modo chiaro, dettagliato e professionale.\n\n"
+    "Informazioni di contesto dai documenti:\n"
+    "---------------------\n"
+    "{context_str}\n"
+    "---------------------\n\n"
+    "Usando SOLO le informazioni di contesto sopra (non conoscenze esterne), "
+    "rispondi alla seguente domanda in modo completo e ben formattato.\n"
+    "Se la risposta contiene passaggi o istruzioni, usa elenchi numerati.\n"
+    "Se non trovi informazioni sufficienti nel contesto, dillo chiaramente.\n\n"
+    "Domanda: {query_str}\n\n"
+    "Risposta dettagliata:"
+)
+
+# Riassunto progressivo dei turni usciti dalla finestra di contesto
+SUMMARY_PROMPT_STR = (
+    "Aggiorna il riassunto di una conversazione tra un utente e un assistente "
+    "helpdesk con i nuovi messaggi. Mantieni argomenti, prodotti, versioni, "
+    "errori e decisioni citati; al massimo 5 frasi, in italiano. "
+    "Rispondi solo con il riassunto aggiornato.\n\n"
+    "Riassunto attuale: {summary}\n\n"
+    "Nuovi messaggi:\n"
+    "{messages}\n\n"
+    "Riassunto aggiornato:"
+)
+
+SOURCES_HEADER = "\n\n---\n📚 **Fonti:**\n"
+NO_RAG_NOTICE = "\n\n⚠️ *Risposta senza RAG (nessun documento caricato)*"
+NOT_INITIALIZED_MESSAGE = "❌ Sistema non inizializzato. Riavvia il server."
+
+
 # ============================================================================
 # SETUP RAG
 # ============================================================================
 
-def setup_rag():
-    """Inizializza il sistema RAG"""
-    global query_engine, index, llm
-    
+def configure_models():
+    """Configura LLM ed embedding model globali di LlamaIndex"""
+    global embedding_batcher
     api_key = os.getenv("GOOGLE_API_KEY")
     if not api_key:
         print("❌ GOOGLE_API_KEY non trovata!")
@@ -134,21 +480,6 @@ def setup_rag():
     
     print(f"🔑 API Key trovata: {api_key[:10]}...")
     
-    # Controlla se è richiesta reindicizzazione
-    reindex_flag = Path("./REINDEX_REQUIRED")
-    force_reindex = False
-    if reindex_flag.exists():
-        print("🔄 Reindicizzazione richiesta dall'Admin Panel!")
-        force_reindex = True
-        # Elimina vecchio indice
-        if os.path.exists(PERSIST_DIR):
-            import shutil
-            shutil.rmtree(PERSIST_DIR)
-            os.makedirs(PERSIST_DIR)
-            print("🗑️ Vecchio indice eliminato")
-        # Rimuovi il flag
-        reindex_flag.unlink()
-    
     # Configura API
     genai.configure(api_key=api_key)
     
@@ -177,103 +508,535 @@ def setup_rag():
         raise
     
     Settings.llm = llm
-    Settings.embed_model = embed_model
+    # Embedding di query e di chunk serviti dalla cache persistente quando possibile
+    Settings.embed_model = CachedEmbedding(embed_model, embedding_cache)
     Settings.chunk_size = 512
     Settings.chunk_overlap = 50
     
-    print(f"✅ Modelli configurati: {MODEL_NAME}")
+    # /v1/embeddings: stesso modello e stessa cache persistente dell'ingestione
+    embedding_batcher = EmbeddingMicroBatcher(
+        llama_index_embed_fn(embed_model),
+        max_batch_size=EMBEDDINGS_MAX_BATCH,
+        max_wait=EMBEDDINGS_BATCH_WINDOW_MS / 1000,
+        concurrency=EMBED_CONCURRENCY,
+        requests_per_minute=EMBED_REQUESTS_PER_MINUTE,
+        tokens_per_minute=EMBED_TOKENS_PER_MINUTE,
+        cache=embedding_cache,
+        cache_model=embed_model.model_name,
+    )
     
-    # Carica o crea indice
-    if os.path.exists(PERSIST_DIR) and os.listdir(PERSIST_DIR):
+    print(f"✅ Modelli configurati: {MODEL_NAME}")
+    return llm
+
+
+def create_embedding_pipeline() -> EmbeddingPipeline:
+    """Pipeline di embedding concorrente e rate-limited per l'ingestione"""
+    embed_model = Settings.embed_model
+    cached = isinstance(embed_model, CachedEmbedding)
+    return EmbeddingPipeline(
+        # La pipeline consulta la cache prima delle quote: al modello arrivano solo i chunk mancanti
+        llama_index_embed_fn(embed_model.embed_model if cached else embed_model),
+        batch_size=EMBED_BATCH_SIZE,
+        concurrency=EMBED_CONCURRENCY,
+        requests_per_minute=EMBED_REQUESTS_PER_MINUTE,
+        tokens_per_minute=EMBED_TOKENS_PER_MINUTE,
+        cache=embedding_cache if cached else None,
+        cache_model=embed_model.model_name,
+    )
+
+
+def create_document_parser() -> DocumentParser:
+    """Lettura dei documenti in parallelo, con timeout e limite di memoria per file"""
+    return DocumentParser(workers=PARSE_WORKERS, timeout=PARSE_TIMEOUT, memory_limit_mb=PARSE_MEMORY_LIMIT_MB,
+                          cache=parsed_text_cache)
+
+
+def create_vector_store() -> "NumpyVectorStore":
+    """Vector store vuoto del tipo configurato (esatto o IVF)"""
+    if VECTOR_STORE_BACKEND == "ivf":
+        return IVFVectorStore(nlist=IVF_NLIST, nprobe=IVF_NPROBE)
+    return NumpyVectorStore()
+
+
+def load_vector_store(persist_dir: str) -> "NumpyVectorStore":
+    """Carica il vector store salvato in persist_dir con il tipo configurato"""
+    if VECTOR_STORE_BACKEND == "ivf":
+        return IVFVectorStore.from_persist_dir(persist_dir, nlist=IVF_NLIST, nprobe=IVF_NPROBE)
+    return NumpyVectorStore.from_persist_dir(persist_dir)
+
+
+def create_lexical_index(persist_dir: str) -> Optional["BM25Index"]:
+    """Indice BM25 in persist_dir (None se il retrieval ibrido è disattivato)"""
+    return BM25Index(persist_dir) if HYBRID_RETRIEVAL else None
+
+
+def create_deduplicator(persist_dir: str) -> Optional["NearDuplicateIndex"]:
+    """
+    Registro dei chunk quasi duplicati in persist_dir (None se la deduplica è
+    disattivata). Il suo dedup.sqlite, come bm25.sqlite, nasce prima
+    dell'indice: non va preso per un indice salvato (vedi has_persisted_index).
+    """
+    return NearDuplicateIndex(persist_dir, threshold=DEDUP_THRESHOLD) if DEDUP_ENABLED else None
+
+
+def persist_index(index, persist_dir: str):
+    """Salva l'indice e, con SHARED_INDEX, esporta il docstore per i worker"""
+    index.storage_context.persist(persist_dir=persist_dir)
+    if SHARED_INDEX:
+        export_docstore(index.docstore, persist_dir)
+
+
+def has_persisted_index(persist_dir: str) -> bool:
+    """
+    True se persist_dir contiene un indice salvato. Non basta una directory non
+    vuota: BM25 e registro dei duplicati (SQLite) vengono creati lì prima del
+    primo salvataggio dell'indice.
+    """
+    return all(os.path.exists(os.path.join(persist_dir, fname)) for fname in ("docstore.json", "index_store.json"))
+
+
+def load_or_build_index(persist_dir: str, force_reindex: bool = False, lexical_index: Optional["BM25Index"] = None,
+                        progress: Optional[LoadProgress] = None, read_only: bool = False,
+                        deduplicator: Optional["NearDuplicateIndex"] = None):
+    """
+    Carica l'indice da persist_dir e, se richiesto o assente, lo allinea ai documenti.
+
+    Con read_only il docstore viene aperto in memory-map dall'esportazione
+    condivisa e l'indice non viene mai modificato (worker che non hanno
+    costruito l'indice, vedi prepare_shared_index). Se la sincronizzazione
+    fallisce, l'indice restituito è l'ultimo salvato su disco (checkpoint o
+    versione precedente), non quello modificato a metà in memoria.
+    """
+    progress = progress or LoadProgress()
+    index = None
+    if has_persisted_index(persist_dir):
         try:
-            print(f"📂 Caricamento indice da: {PERSIST_DIR}")
-            storage_context = StorageContext.from_defaults(persist_dir=PERSIST_DIR)
+            progress.set_phase("load_index", persist_dir)
+            print(f"📂 Caricamento indice da: {persist_dir}")
+            vector_store = load_vector_store(persist_dir)
+            docstore = SharedDocumentStore(persist_dir) if read_only and has_shared_docstore(persist_dir) else None
+            storage_context = StorageContext.from_defaults(
+                persist_dir=persist_dir, vector_store=vector_store, docstore=docstore)
             index = load_index_from_storage(storage_context)
-            print("✅ Indice caricato dalla cache")
+            if vector_store.dirty and not read_only:
+                # Vector store convertito dal vecchio formato JSON: salvalo come .npy
+                storage_context.persist(persist_dir=persist_dir)
+            print(f"✅ Indice caricato dalla cache{' (docstore condiviso in memory-map)' if docstore else ''}")
+            num_nodes = len(index.index_struct.nodes_dict)
+            if not num_nodes:
+                # Indice vuoto (tutti i documenti rimossi): ricontrolla la cartella
+                index = None
+            elif lexical_index is not None and len(lexical_index) != num_nodes and not read_only:
+                # Indice creato prima del BM25 (o disallineato): ricostruiscilo dal docstore
+                progress.set_phase("lexical_index", f"{num_nodes} chunk")
+                print("🔤 Costruzione indice BM25 dal docstore...")
+                lexical_index.clear()
+                lexical_index.add_nodes(index.docstore.docs.values())
+            if index is not None and deduplicator is not None and not read_only and not len(deduplicator):
+                # Indice creato prima della deduplica: registra i chunk esistenti (nessun embedding)
+                progress.set_phase("dedup_index", f"{num_nodes} chunk")
+                print("🧬 Registrazione dei chunk esistenti per la deduplica...")
+                deduplicator.add(list(index.docstore.docs.values()))
+            if index is not None and SHARED_INDEX and not read_only and not has_shared_docstore(persist_dir):
+                # Indice salvato senza esportazione (versione precedente o altro tool)
+                export_docstore(index.docstore, persist_dir)
         except Exception as e:
             print(f"⚠️ Errore caricamento indice: {e}")
             traceback.print_exc()
             index = None
     
-    if index is None:
+    if read_only:
+        return index
+    
+    resume = index is not None and BuildCheckpoint.exists(persist_dir)
+    if resume and not force_reindex:
+        print(f"♻️ Costruzione dell'indice interrotta in {persist_dir}: ripresa dall'ultimo checkpoint")
+    if index is None or force_reindex or resume:
         # Carica documenti
         if not os.path.exists(DOCUMENTS_PATH):
             os.makedirs(DOCUMENTS_PATH, exist_ok=True)
             print(f"📁 Cartella documenti creata: {DOCUMENTS_PATH}")
         
         try:
-            reader = SimpleDirectoryReader(
-                input_dir=DOCUMENTS_PATH,
-                recursive=True,
-                required_exts=[".pdf", ".txt", ".docx", ".md"],
-            )
-            documents = reader.load_data()
+            manifest = IndexManifest.load(persist_dir) if index is not None else None
+            if index is None:
+                storage_context = StorageContext.from_defaults(vector_store=create_vector_store())
+                index = VectorStoreIndex(nodes=[], storage_context=storage_context)
+                manifest = IndexManifest()
+                # Nessun indice da riprendere: un eventuale checkpoint è superato
+                BuildCheckpoint.clear(persist_dir)
+                if lexical_index is not None:
+                    lexical_index.clear()
+                if deduplicator is not None:
+                    deduplicator.clear()
+            elif manifest is None:
+                # Indice creato prima del manifest: ricostruisci il manifest dal docstore
+                print("🧾 Manifest assente, ricostruzione dal docstore...")
+                manifest = bootstrap_manifest(index, DOCUMENTS_PATH, scan_documents(DOCUMENTS_PATH))
             
-            if documents:
-                print(f"📄 Caricati {len(documents)} documenti")
-                for doc in documents:
-                    print(f"   - {doc.metadata.get('file_name', 'unknown')}")
-                index = VectorStoreIndex.from_documents(documents, show_progress=True)
-                index.storage_context.persist(persist_dir=PERSIST_DIR)
-                print("✅ Nuovo indice creato e salvato")
+            pipeline = create_embedding_pipeline()
+            parser = create_document_parser()
+            progress.set_phase("sync", DOCUMENTS_PATH)
+            progress.pipeline, progress.parser = pipeline, parser
+            with INGESTION_DURATION.time():
+                stats = sync_index(index, DOCUMENTS_PATH, manifest, pipeline=pipeline, lexical_index=lexical_index,
+                                   parser=parser, batch_size=INGEST_BATCH_SIZE or None, queue_size=INGEST_QUEUE_SIZE,
+                                   deduplicator=deduplicator, checkpoint_dir=persist_dir,
+                                   checkpoint_interval=INDEX_CHECKPOINT_INTERVAL)
+            parse_failures.clear()
+            if parser.last_stats is not None:
+                parse_failures.update(parser.last_stats.failures)
+            for change in ("added", "changed", "removed", "failed"):
+                INGESTED_FILES.labels(change=change).inc(stats[change])
+            INGESTED_CHUNKS.inc(stats["chunks"])
+            INGESTED_DUPLICATES.inc(stats["duplicates"])
+            INGESTED_CACHED_EMBEDDINGS.inc(stats["embedding_cache_hits"])
+            for stage_name, throughput in stats.get("throughput", {}).items():
+                INGESTION_STAGE_THROUGHPUT.labels(stage=stage_name).set(throughput["per_second"])
+            if "throughput" in stats and stats["throughput"]["embed"]["items"]:
+                INGESTION_THROUGHPUT.set(stats["throughput"]["embed"]["per_second"])
+            persist_index(index, persist_dir)
+            manifest.save(persist_dir)
+            BuildCheckpoint.clear(persist_dir)
+            record_build("completed", stats["build"], checkpoints=stats["checkpoints"])
+            if manifest.entries:
+                print(f"✅ Indice aggiornato e salvato ({len(manifest.entries)} documenti, "
+                      f"{stats['added'] + stats['changed'] - stats['failed']} re-embeddati"
+                      f"{', ' + str(stats['duplicates']) + ' chunk quasi duplicati' if stats['duplicates'] else ''}"
+                      f"{', ' + str(stats['embedding_cache_hits']) + ' embedding dalla cache' if stats['embedding_cache_hits'] else ''}"
+                      f"{', ' + str(stats['failed']) + ' non leggibili' if stats['failed'] else ''})")
             else:
                 print("⚠️ Nessun documento trovato nella cartella")
+                index = None
         except Exception as e:
             print(f"⚠️ Errore caricamento documenti: {e}")
             traceback.print_exc()
+            checkpoint = BuildCheckpoint.load(persist_dir)
+            if checkpoint is not None:
+                print(f"💾 Avanzamento salvato: {checkpoint.files} file, {checkpoint.chunks} chunk "
+                      f"(la prossima sincronizzazione riprende da qui)")
+            record_build("interrupted", checkpoint.progress() if checkpoint is not None else {}, error=str(e))
+            # L'indice in memoria è a metà della sincronizzazione (file parziali,
+            # manifest non salvato): si riparte dall'ultimo stato salvato su disco
+            print("📂 Ripristino dell'indice dall'ultimo stato salvato...")
+            index = load_or_build_index(persist_dir, lexical_index=lexical_index, progress=progress, read_only=True)
     
-    # Crea query engine
-    if index is not None:
-        retriever = VectorIndexRetriever(index=index, similarity_top_k=5)  # Aumentato da 3 a 5
-        
-        # Prompt personalizzato per risposte più dettagliate
-        from llama_index.core import PromptTemplate
-        
-        qa_prompt_str = (
-            "Sei un assistente helpdesk esperto e cordiale. "
-            "Rispondi sempre in italiano in modo chiaro, dettagliato e professionale.\n\n"
-            "Informazioni di contesto dai documenti:\n"
-            "---------------------\n"
-            "{context_str}\n"
-            "---------------------\n\n"
-            "Usando SOLO le informazioni di contesto sopra (non conoscenze esterne), "
-            "rispondi alla seguente domanda in modo completo e ben formattato.\n"
-            "Se la risposta contiene passaggi o istruzioni, usa elenchi numerati.\n"
-            "Se non trovi informazioni sufficienti nel contesto, dillo chiaramente.\n\n"
-            "Domanda: {query_str}\n\n"
-            "Risposta dettagliata:"
-        )
-        qa_prompt = PromptTemplate(qa_prompt_str)
-        
-        query_engine = RetrieverQueryEngine.from_args(
-            retriever=retriever,
-            text_qa_template=qa_prompt,
+    return index
+
+
+def record_build(status: str, progress: Dict[str, Any], **extra: Any):
+    """Esito dell'ultima sincronizzazione per /reload e /health (vedi BuildCheckpoint.progress)"""
+    last_build.clear()
+    last_build.update(status=status, **progress, **extra)
+    INGESTION_BUILDS.labels(mode=progress.get("mode", "fresh"), result=status).inc()
+
+
+def create_query_engine(index, lexical_index: Optional["BM25Index"] = None):
+    """Crea il query engine (retriever + prompt personalizzato) per un indice"""
+    # Con MMR si recuperano molti candidati; la selezione dei SIMILARITY_TOP_K avviene dopo
+    top_k = max(MMR_CANDIDATES, SIMILARITY_TOP_K) if MMR_ENABLED else SIMILARITY_TOP_K
+    if lexical_index is not None:
+        # Più candidati vettoriali, poi fusione con BM25
+        retriever = HybridRetriever(
+            VectorIndexRetriever(index=index, similarity_top_k=max(HYBRID_CANDIDATES, top_k)),
+            lexical_index,
+            index.docstore,
+            similarity_top_k=top_k,
+            lexical_top_k=max(HYBRID_CANDIDATES, top_k),
+            rrf_k=RRF_K,
         )
-        print("✅ Query engine pronto (con prompt personalizzato)")
+    else:
+        retriever = VectorIndexRetriever(index=index, similarity_top_k=top_k)
+    
+    # Prompt personalizzato per risposte più dettagliate
+    qa_prompt = PromptTemplate(QA_PROMPT_STR)
+    
+    return RetrieverQueryEngine.from_args(
+        retriever=retriever,
+        text_qa_template=qa_prompt,
+    )
+
+
+def build_generation(persist_dir: str, force_reindex: bool = False,
+                     progress: Optional[LoadProgress] = None, read_only: bool = False) -> EngineGeneration:
+    """Costruisce una nuova generazione del motore RAG a partire da persist_dir"""
+    lexical_index = create_lexical_index(persist_dir)
+    deduplicator = create_deduplicator(persist_dir)
+    index = load_or_build_index(persist_dir, force_reindex, lexical_index, progress, read_only, deduplicator)
+    
+    query_engine = None
+    if index is not None:
+        query_engine = create_query_engine(index, lexical_index)
+        print(f"✅ Query engine pronto (con prompt personalizzato{', ibrido BM25 + vettoriale' if lexical_index else ''})")
     else:
         print("⚠️ Query engine non disponibile (nessun documento)")
+    
+    return EngineGeneration(
+        generation=engines.next_generation(),
+        index=index,
+        query_engine=query_engine,
+        llm=Settings.llm,
+        persist_dir=persist_dir,
+        lexical_index=lexical_index,
+        deduplicator=deduplicator,
+    )
+
+
+def recover_storage_dirs():
+    """Ripristina ./storage se un precedente swap blue/green è stato interrotto"""
+    if not os.path.exists(PERSIST_DIR) and os.path.exists(PERSIST_OLD_DIR):
+        print(f"♻️ Ripristino indice precedente da: {PERSIST_OLD_DIR}")
+        os.rename(PERSIST_OLD_DIR, PERSIST_DIR)
+
+
+def reindex_requested() -> bool:
+    """Controlla (e consuma) il flag di reindicizzazione dell'Admin Panel"""
+    reindex_flag = Path("./REINDEX_REQUIRED")
+    if reindex_flag.exists():
+        print("🔄 Reindicizzazione richiesta dall'Admin Panel!")
+        # Rimuovi il flag
+        reindex_flag.unlink()
+        return True
+    return False
+
+
+def prepare_shared_index(progress: LoadProgress):
+    """
+    Con più worker: il primo che prende il lock allinea ./storage ai
+    documenti (se richiesto o se manca l'esportazione condivisa) e pubblica
+    una nuova generazione; gli altri attendono il lock e trovano l'indice pronto.
+    """
+    with index_build_lock(INDEX_LOCK_PATH):
+        recover_storage_dirs()
+        force_reindex = reindex_requested()
+        if force_reindex or not has_shared_docstore(PERSIST_DIR):
+            load_or_build_index(PERSIST_DIR, force_reindex, create_lexical_index(PERSIST_DIR), progress,
+                                deduplicator=create_deduplicator(PERSIST_DIR))
+            index_generation.bump()
+        elif index_generation.read() is None:
+            index_generation.bump()
+
+
+def setup_rag(progress: Optional[LoadProgress] = None):
+    """
+    Inizializza il sistema RAG. All'avvio gira in background (vedi
+    lifespan): finché non termina /readyz risponde 503 e le query 503.
+    """
+    progress = progress or LoadProgress()
+    progress.set_phase("imports")
+    import_rag_libraries()
+    
+    progress.set_phase("models", MODEL_NAME)
+    configure_models()
+    if SHARED_INDEX:
+        prepare_shared_index(progress)
+        token = index_generation.read()
+        engines.swap(build_generation(PERSIST_DIR, progress=progress, read_only=True))
+        index_generation.mark_loaded(token)
+    else:
+        recover_storage_dirs()
+        # Controlla se è richiesta reindicizzazione (incrementale, vedi index_manifest.py)
+        engines.swap(build_generation(PERSIST_DIR, reindex_requested(), progress))
+    print(f"🧬 Generazione indice: {engines.generation}")
+    progress.set_phase("ready")
+
+
+def rebuild_index_blue_green():
+    """
+    Reindicizza senza interrompere il servizio (blue/green).
+
+    La nuova generazione viene costruita in PERSIST_STAGING_DIR, copia
+    dell'indice corrente, mentre la generazione attuale continua a
+    rispondere. Poi le directory vengono scambiate e la nuova generazione
+    sostituisce la vecchia in un solo passo; la vecchia directory viene
+    eliminata solo dopo il drain delle richieste ancora in corso.
+
+    Se la sincronizzazione si interrompe (es. quota Gemini esaurita) non
+    c'è scambio: lo staging resta su disco con il suo checkpoint e il
+    /reload successivo riprende da lì.
+    """
+    reindex_flag = Path("./REINDEX_REQUIRED")
+    if reindex_flag.exists():
+        reindex_flag.unlink()
+    
+    import_rag_libraries()
+    if Settings.llm is None or engines.current.llm is None:
+        configure_models()
+    if SHARED_INDEX:
+        # Un solo worker alla volta ricostruisce; gli altri rimappano via INDEX_GENERATION_PATH
+        with index_build_lock(INDEX_LOCK_PATH):
+            return _rebuild_index_blue_green()
+    return _rebuild_index_blue_green()
+
+
+def documents_unchanged() -> bool:
+    """
+    True se la generazione servita è allineata ai documenti: nessun file
+    nuovo, modificato o rimosso rispetto al manifest di ./storage e nessuna
+    costruzione interrotta da riprendere
+    """
+    if engines.current.index is None or SHARED_INDEX and index_generation.changed():
+        return False
+    if BuildCheckpoint.exists(PERSIST_STAGING_DIR) or BuildCheckpoint.exists(PERSIST_DIR):
+        return False
+    manifest = IndexManifest.load(PERSIST_DIR)
+    if manifest is None:
+        return False
+    if manifest.diff(DOCUMENTS_PATH, scan_documents(DOCUMENTS_PATH)).has_changes:
+        return False
+    # File solo "toccati": il mtime aggiornato evita di ricalcolarne l'hash al prossimo /reload
+    manifest.save(PERSIST_DIR)
+    return True
+
+
+def _rebuild_index_blue_green() -> EngineGeneration:
+    # 0. Documenti invariati: niente copia né scambio, la generazione corrente
+    #    (e con lei la cache delle risposte) resta in servizio
+    if documents_unchanged():
+        print("✅ Documenti invariati: la generazione corrente resta in servizio")
+        record_build("unchanged", {})
+        return engines.current
+    
+    # 1. Staging: copia dell'indice corrente, aggiornata in modo incrementale.
+    #    Uno staging con un checkpoint è una ricostruzione interrotta: si riprende
+    #    da lì (allineandolo ai documenti attuali) invece di ricopiare l'indice
+    if BuildCheckpoint.exists(PERSIST_STAGING_DIR):
+        print(f"♻️ Ripresa della nuova generazione interrotta in: {PERSIST_STAGING_DIR}")
+    else:
+        shutil.rmtree(PERSIST_STAGING_DIR, ignore_errors=True)
+        if os.path.exists(PERSIST_DIR):
+            shutil.copytree(PERSIST_DIR, PERSIST_STAGING_DIR)
+        else:
+            os.makedirs(PERSIST_STAGING_DIR)
+        print(f"🏗️ Costruzione nuova generazione in: {PERSIST_STAGING_DIR}")
+    if SHARED_INDEX:
+        # Solo su disco: la generazione servita viene caricata dopo lo scambio
+        load_or_build_index(PERSIST_STAGING_DIR, True, create_lexical_index(PERSIST_STAGING_DIR),
+                            deduplicator=create_deduplicator(PERSIST_STAGING_DIR))
+    else:
+        new_generation = build_generation(PERSIST_STAGING_DIR, force_reindex=True)
+    if BuildCheckpoint.exists(PERSIST_STAGING_DIR):
+        # Sincronizzazione interrotta: la generazione corrente resta in servizio,
+        # lo staging resta su disco per la ripresa al prossimo /reload
+        raise RuntimeError(f"{last_build.get('error', 'sincronizzazione interrotta')} "
+                           f"(avanzamento salvato: {last_build.get('files', 0)} file, "
+                           f"{last_build.get('chunks', 0)} chunk; il prossimo /reload riprende da lì)")
+    
+    # 2. Scambio delle directory su disco
+    release_mappings(engines.current, None if SHARED_INDEX else new_generation)
+    shutil.rmtree(PERSIST_OLD_DIR, ignore_errors=True)
+    if os.path.exists(PERSIST_DIR):
+        os.rename(PERSIST_DIR, PERSIST_OLD_DIR)
+    try:
+        os.rename(PERSIST_STAGING_DIR, PERSIST_DIR)
+    except OSError:
+        # Rimetti al suo posto l'indice servito: lo staging resta per il prossimo /reload
+        if os.path.exists(PERSIST_OLD_DIR) and not os.path.exists(PERSIST_DIR):
+            os.rename(PERSIST_OLD_DIR, PERSIST_DIR)
+        raise
+    if SHARED_INDEX:
+        # Pubblica la nuova versione agli altri worker e servila anche qui in memory-map
+        token = index_generation.bump()
+        new_generation = build_generation(PERSIST_DIR, read_only=True)
+        index_generation.mark_loaded(token)
+    else:
+        new_generation.persist_dir = PERSIST_DIR
+        if new_generation.lexical_index is not None:
+            new_generation.lexical_index.persist_dir = PERSIST_DIR
+        if new_generation.deduplicator is not None:
+            new_generation.deduplicator.persist_dir = PERSIST_DIR
+    
+    # 3. Scambio atomico in memoria
+    old_generation = engines.swap(new_generation)
+    print(f"🔀 Generazione {old_generation.generation} → {new_generation.generation}")
+    
+    # 4. Drain della vecchia generazione
+    if not old_generation.wait_drained(timeout=DRAIN_TIMEOUT):
+        print(f"⚠️ Generazione {old_generation.generation}: "
+              f"{old_generation.active_requests} richieste ancora attive dopo {DRAIN_TIMEOUT}s")
+    shutil.rmtree(PERSIST_OLD_DIR, ignore_errors=True)
+    return new_generation
+
+
+def release_mappings(*generations: Optional[EngineGeneration]):
+    """
+    Su Windows una directory con file mappati in memoria non si può
+    rinominare: prima dello swap le matrici .npy e il docstore condiviso
+    delle generazioni coinvolte vengono copiati in RAM (vedi
+    NumpyVectorStore.release_mmap e SharedDocumentStore.release_mmap).
+    Altrove il rename non tocca le mappe aperte e non serve.
+    """
+    if os.name != "nt":
+        return
+    for gen in generations:
+        index = getattr(gen, "index", None)
+        for store in (getattr(index, "vector_store", None), getattr(index, "docstore", None)):
+            if hasattr(store, "release_mmap"):
+                store.release_mmap()
+
+
+def remap_shared_index() -> EngineGeneration:
+    """Un altro worker ha pubblicato una nuova versione dell'indice: caricala in memory-map"""
+    with index_build_lock(INDEX_LOCK_PATH):
+        token = index_generation.read()
+        new_generation = build_generation(PERSIST_DIR, read_only=True)
+        index_generation.mark_loaded(token)
+    old_generation = engines.swap(new_generation)
+    print(f"🔀 Generazione {old_generation.generation} → {new_generation.generation} (indice aggiornato da un altro worker)")
+    return new_generation
+
+
+async def watch_index_generation():
+    """Controlla periodicamente INDEX_GENERATION_PATH e rimappa l'indice quando cambia"""
+    global reload_future
+    while True:
+        await asyncio.sleep(INDEX_WATCH_INTERVAL)
+        if not startup.ready or reload_in_progress() or not index_generation.changed():
+            continue
+        reload_future = reload_executor.submit(remap_shared_index)
+        try:
+            await asyncio.wrap_future(reload_future)
+        except Exception:
+            logger.exception("rimappatura dell'indice condiviso fallita")
 
 
 # ============================================================================
 # FASTAPI APP
 # ============================================================================
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Inizializzazione all'avvio"""
-    print("\n" + "="*60)
-    print("🚀 RAG API Server - Avvio")
-    print("="*60 + "\n")
+def run_startup():
+    """Caricamento iniziale (sull'executor delle reindicizzazioni)"""
     try:
-        setup_rag()
+        setup_rag(startup)
         print("\n" + "="*60)
-        print("✅ Server pronto!")
+        print(f"✅ Server pronto! (caricamento in {startup.snapshot()['elapsed_seconds']}s)")
         print("="*60 + "\n")
     except Exception as e:
+        startup.fail(e)
         print(f"\n❌ Errore durante l'avvio: {e}")
         traceback.print_exc()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Avvio non bloccante: il caricamento di librerie, modelli e indice parte
+    in background e il server accetta subito connessioni (/livez, /readyz).
+    Le /reload arrivate durante il caricamento attendono sullo stesso executor.
+    """
+    global startup_future
+    print("\n" + "="*60)
+    print("🚀 RAG API Server - Avvio")
+    print("="*60 + "\n")
+    startup_future = reload_executor.submit(run_startup)
+    watcher = asyncio.create_task(watch_index_generation()) if SHARED_INDEX and INDEX_WATCH_INTERVAL > 0 else None
     yield
     print("👋 Server in chiusura...")
+    if watcher is not None:
+        watcher.cancel()
+    if conversation_store is not None:
+        conversation_store.close()
+    shutdown_logging()
 
 
 app = FastAPI(
@@ -283,6 +1046,11 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Metriche HTTP per endpoint (richieste, durata, richieste in corso)
+app.add_middleware(MetricsMiddleware, registry=metrics, prefix="rag")
+# Request id, span per fase e log di accesso strutturato
+app.add_middleware(TracingMiddleware, server_timing=SERVER_TIMING_HEADER)
+
 # CORS per Open WebUI
 app.add_middleware(
     CORSMiddleware,
@@ -304,10 +1072,25 @@ async def root():
         "status": "ok",
         "service": "RAG API Server",
         "model": MODEL_NAME,
-        "rag_enabled": query_engine is not None
+        "rag_enabled": engines.current.query_engine is not None
     }
 
 
+@app.get("/livez")
+async def liveness():
+    """Liveness probe: il processo risponde (anche durante il caricamento dell'indice)"""
+    return {"status": "alive"}
+
+
+@app.get("/readyz")
+async def readiness():
+    """Readiness probe: 200 solo a caricamento completato, altrimenti 503 con l'avanzamento"""
+    body = {"ready": startup.ready, "startup": startup.snapshot(), "index_generation": engines.generation}
+    if not startup.ready:
+        return JSONResponse(status_code=503, content=body, headers={"Retry-After": "5"})
+    return body
+
+
 @app.get("/v1/models", response_model=ModelsResponse)
 @app.get("/api/models", response_model=ModelsResponse)
 async def list_models():
@@ -319,95 +1102,436 @@ async def list_models():
     return ModelsResponse(data=models)
 
 
-def run_query_sync(user_message: str, conversation_context: str = ""):
-    """Esegue la query in modo sincrono (per thread separato)"""
-    # Se c'è contesto conversazione, lo aggiungiamo alla query
+def format_history_message(role: str, content: str) -> Optional[str]:
+    """Riga della cronologia per un messaggio (None per i messaggi di sistema)"""
+    if role == "user":
+        return f"Utente: {content}"
+    if role == "assistant":
+        # Rimuovi le fonti dal contesto per non inquinare
+        content = content.split(SOURCES_HEADER.rstrip("\n"))[0] if content else ""
+        return f"Assistente: {content}"
+    return None
+
+
+def conversation_id_from(http_request: Request) -> Optional[str]:
+    """Id della conversazione inviato dal client (Open WebUI lo inoltra come X-OpenWebUI-Chat-Id)"""
+    value = http_request.headers.get("x-conversation-id") or http_request.headers.get("x-openwebui-chat-id")
+    return value[:128] if value else None
+
+
+def load_conversation(messages: List[tuple], conversation_id: Optional[str]) -> ConversationState:
+    """Cronologia elaborata dei messaggi precedenti la domanda (solo i nuovi se la conversazione è nota)"""
+    if conversation_store is None:
+        state = ConversationState()
+        state.extend(messages, format_history_message)
+        return state
+    return conversation_store.resume(messages, format_history_message, conversation_id)
+
+
+def remember_turn(state: ConversationState, conversation_id: Optional[str], user_message: str, answer: str,
+                  node_ids: Optional[List[str]]):
+    """Salva lo stato dopo la risposta; aggiorna il riassunto in background se servono"""
+    if conversation_store is None:
+        return
+    # Anche lo stato prima della domanda: se il client rimanda la risposta
+    # modificata, il turno successivo riparte da qui invece che da zero
+    conversation_store.save(state, conversation_id)
+    turn = state.copy()
+    turn.extend([("user", user_message), ("assistant", answer)], format_history_message)
+    if node_ids is not None:
+        turn.last_node_ids = node_ids
+    conversation_store.save(turn, conversation_id)
+    
+    if CONVERSATION_SUMMARY and turn.pending_summary(CONVERSATION_WINDOW):
+        # Contesto vuoto: la chiamata non appartiene più alla richiesta (span e usage)
+        task = asyncio.create_task(summarize_conversation(turn), context=contextvars.Context())
+        summary_tasks.add(task)
+        task.add_done_callback(summary_tasks.discard)
+
+
+def build_conversation_context(state: ConversationState) -> str:
+    """
+    Contesto della conversazione per la sintesi. Le righe uscite dalla
+    finestra restano finché il riassunto in background non le ha incorporate
+    (senza store il riassunto non esiste e bastano le ultime righe).
+    """
+    return state.context(CONVERSATION_WINDOW, pending=CONVERSATION_SUMMARY and conversation_store is not None)
+
+
+async def summarize_conversation(state: ConversationState):
+    """Incorpora nel riassunto le righe uscite dalla finestra di contesto"""
+    lines = state.pending_summary(CONVERSATION_WINDOW)
+    llm = engines.current.llm
+    if not lines or llm is None:
+        return
+    prompt = SUMMARY_PROMPT_STR.format(summary=state.summary or "(nessuno)", messages="\n".join(lines))
+    try:
+        response = await llm.acomplete(prompt)
+    except Exception:
+        logger.warning("aggiornamento del riassunto della conversazione fallito", exc_info=True)
+        return
+    state.summary = str(response).strip()
+    state.summarized += len(lines)
+
+
+def build_full_query(user_message: str, conversation_context: str = "") -> str:
+    """Aggiunge alla domanda il contesto della conversazione, se presente"""
     if conversation_context:
-        full_query = f"""Contesto della conversazione precedente:
+        return f"""Contesto della conversazione precedente:
 {conversation_context}
 
 Nuova domanda dell'utente: {user_message}
 
 Rispondi alla nuova domanda tenendo conto del contesto precedente."""
-    else:
-        full_query = user_message
+    return user_message
+
+
+def format_sources(source_nodes) -> str:
+    """Blocco testuale delle fonti accodato alla risposta"""
+    if not source_nodes:
+        return ""
+    sources_text = SOURCES_HEADER
+    for node in source_nodes:
+        filenames = ", ".join(source_files(node))
+        score = node.score if node.score else 0
+        sources_text += f"- {filenames} (rilevanza: {score:.2f})\n"
+    return sources_text
+
+
+def source_files(node) -> List[str]:
+    """File del chunk: il suo e quelli con lo stesso passaggio quasi identico (deduplica)"""
+    return [node.node.metadata.get('file_name', 'Documento')] + node.node.metadata.get("duplicate_files", [])
+
+
+def source_node_ids(source_nodes) -> List[str]:
+    """Id dei nodi recuperati (anche quelli uniti dal context assembly)"""
+    ids = []
+    for n in source_nodes:
+        ids.extend(n.node.metadata.get("merged_node_ids") or [n.node.node_id])
+    return ids
+
+
+def sources_summary(source_nodes) -> List[Dict[str, Any]]:
+    """Fonti in forma strutturata (nome file, altri file con lo stesso passaggio e rilevanza)"""
+    return [
+        {"file_name": n.node.metadata.get('file_name', 'Documento'),
+         "duplicate_files": n.node.metadata.get("duplicate_files", []), "score": n.score or 0}
+        for n in source_nodes
+    ]
+
+
+def collapse_duplicates(gen: EngineGeneration, source_nodes):
+    """Un solo candidato per gruppo di chunk quasi duplicati, con tutti i file del gruppo"""
+    if gen.deduplicator is None:
+        return source_nodes
+    with stage("dedup"):
+        return gen.deduplicator.collapse(source_nodes)
+
+
+def diversify(gen: EngineGeneration, query_bundle, source_nodes):
+    """MMR sui candidati recuperati, con gli embedding già salvati nel vector store"""
+    if mmr_reranker is None:
+        return source_nodes
+    with stage("rerank"):
+        return mmr_reranker.rerank(source_nodes, gen.index.vector_store, query_bundle.embedding)
+
+
+def assemble_context(source_nodes):
+    """Cutoff relativo, merge dei chunk sovrapposti e budget di token (vedi context_assembly.py)"""
+    with stage("assemble"):
+        nodes, stats = context_assembler.assemble(source_nodes)
+    CONTEXT_TOKENS.observe(stats["tokens"])
+    for reason in ("cutoff", "merged", "over_budget"):
+        if stats[reason]:
+            CONTEXT_CHUNKS_DROPPED.labels(reason=reason).inc(stats[reason])
+    logger.debug("contesto assemblato", extra=stats)
+    return nodes
+
+
+def record_usage() -> Usage:
+    """Token della richiesta corrente (chiamate al LLM registrate dal tracing), anche come metrica"""
+    trace = current_trace()
+    if trace is None:
+        return Usage()
+    usage = Usage(**trace.usage())
+    LLM_TOKENS.labels(kind="prompt").inc(usage.prompt_tokens)
+    LLM_TOKENS.labels(kind="completion").inc(usage.completion_tokens)
+    return usage
+
+
+async def retrieval_query(gen: EngineGeneration, user_message: str, conversation_context: str) -> str:
+    """
+    Testo usato per il retrieval: la sola domanda, riscritta come domanda
+    autonoma se è un follow-up. La cronologia va solo al prompt di sintesi.
+    """
+    if not CONDENSE_QUESTIONS or not conversation_context:
+        return user_message
+    with stage("condense"):
+        return await question_condenser.condense(gen.llm, user_message, conversation_context)
+
+
+async def lookup_answer_cache(gen: EngineGeneration, user_message: str, conversation_context: str,
+                              cache_context: str):
+    """
+    Cerca la risposta nella cache (livello esatto, poi semantico), con
+    cache_context come chiave della conversazione.
+    Restituisce (risposta in cache o None, query di retrieval): in caso di
+    miss la query contiene già l'embedding della domanda autonoma, riusato
+    dal retriever senza una seconda chiamata all'API di embedding.
+    """
+    cached = answer_cache.get(user_message, cache_context, gen.generation)
+    if cached is not None:
+        logger.info("risposta servita dalla cache")
+        return cached, None
+    query_bundle = QueryBundle(await retrieval_query(gen, user_message, conversation_context))
+    with stage("embed"):
+        query_bundle.embedding = await Settings.embed_model.aget_query_embedding(query_bundle.query_str)
+    cached = answer_cache.get_similar(query_bundle.embedding, cache_context, gen.generation)
+    if cached is not None:
+        logger.info("risposta servita dalla cache")
+    return cached, query_bundle
+
+
+async def run_query(user_message: str, conversation_context: str = "", cache_context: Optional[str] = None):
+    """
+    Esegue la query con le API asincrone di LlamaIndex (nessun thread
+    occupato durante l'attesa di Gemini). Il retrieval usa la domanda
+    autonoma; il prompt di sintesi riceve anche il contesto della conversazione.
+    La cache delle risposte usa cache_context (default: il contesto stesso).
+
+    Restituisce (risposta, numero di fonti, id dei nodi recuperati o None
+    se non c'è stato retrieval).
+    """
+    full_query = build_full_query(user_message, conversation_context)
+    if cache_context is None:
+        cache_context = conversation_context
+    
+    with engines.lease() as gen:
+        if gen.query_engine is not None:
+            cached, query_bundle = await lookup_answer_cache(gen, user_message, conversation_context, cache_context)
+            if cached is not None:
+                QUERIES.labels(mode="sync", result="cache_hit").inc()
+                return cached.answer, cached.num_sources, None
+            
+            with stage("retrieve"):
+                source_nodes = await gen.query_engine.aretrieve(query_bundle)
+            source_nodes = assemble_context(diversify(gen, query_bundle, collapse_duplicates(gen, source_nodes)))
+            with stage("synthesize"):
+                response = await gen.query_engine.asynthesize(QueryBundle(full_query), source_nodes)
+            answer = str(response)
+            with stage("format_sources"):
+                full_answer = answer + format_sources(source_nodes)
+            QUERIES.labels(mode="sync", result="rag").inc()
+            answer_cache.put(
+                user_message, cache_context, gen.generation, full_answer,
+                len(source_nodes), sources_summary(source_nodes), query_bundle.embedding,
+            )
+            return full_answer, len(source_nodes), source_node_ids(source_nodes)
+        elif gen.llm is not None:
+            QUERIES.labels(mode="sync", result="no_rag").inc()
+            with stage("synthesize"):
+                response = await gen.llm.acomplete(full_query)
+            return str(response) + NO_RAG_NOTICE, 0, None
+        else:
+            return NOT_INITIALIZED_MESSAGE, 0, None
+
+
+async def stream_query(user_message: str, conversation_context: str, cache_context: Optional[str] = None):
+    """
+    Esegue la query in streaming, come generatore asincrono di eventi
+    (kind, payload): "sources" (fonti recuperate, appena termina il
+    retrieval), "token" (testo generato) e infine "done" (id dei nodi
+    recuperati, None senza retrieval). Se il consumer
+    smette di iterare (client disconnesso) lo stream upstream viene chiuso
+    e la generazione Gemini interrotta. cache_context come in run_query.
+    """
+    full_query = build_full_query(user_message, conversation_context)
+    if cache_context is None:
+        cache_context = conversation_context
     
-    if query_engine is not None:
-        response = query_engine.query(full_query)
-        answer = str(response)
+    with engines.lease() as gen:
+        if gen.query_engine is not None:
+            cached, query_bundle = await lookup_answer_cache(gen, user_message, conversation_context, cache_context)
+            if cached is not None:
+                QUERIES.labels(mode="stream", result="cache_hit").inc()
+                yield "sources", cached.sources
+                yield "token", cached.answer
+                yield "done", None
+                return
+            
+            with stage("retrieve"):
+                source_nodes = await gen.query_engine.aretrieve(query_bundle)
+            source_nodes = assemble_context(diversify(gen, query_bundle, collapse_duplicates(gen, source_nodes)))
+            QUERIES.labels(mode="stream", result="rag").inc()
+            yield "sources", sources_summary(source_nodes)
+            synthesis_started = time.perf_counter()
+            synthesizer = get_response_synthesizer(
+                llm=gen.llm,
+                text_qa_template=PromptTemplate(QA_PROMPT_STR),
+                streaming=True,
+            )
+            response = await synthesizer.asynthesize(QueryBundle(full_query), source_nodes)
+            token_gen = response.async_response_gen()
+            with stage("format_sources"):
+                suffix = format_sources(source_nodes)
+        elif gen.llm is not None:
+            QUERIES.labels(mode="stream", result="no_rag").inc()
+            yield "sources", []
+            synthesis_started = time.perf_counter()
+            token_gen = (chunk.delta async for chunk in await gen.llm.astream_complete(full_query))
+            suffix = NO_RAG_NOTICE
+        else:
+            yield "sources", []
+            yield "token", NOT_INITIALIZED_MESSAGE
+            yield "done", None
+            return
         
-        sources_text = ""
-        if hasattr(response, 'source_nodes') and response.source_nodes:
-            sources_text = "\n\n---\n📚 **Fonti:**\n"
-            for i, node in enumerate(response.source_nodes, 1):
-                filename = node.node.metadata.get('file_name', 'Documento')
-                score = node.score if node.score else 0
-                sources_text += f"- {filename} (rilevanza: {score:.2f})\n"
+        tokens = []
+        try:
+            async for token in token_gen:
+                if token:
+                    tokens.append(token)
+                    yield "token", token
+        finally:
+            await token_gen.aclose()
+        synthesis_time = time.perf_counter() - synthesis_started
+        STAGE_LATENCY.labels(stage="synthesize").observe(synthesis_time)
+        trace = current_trace()
+        if trace is not None:
+            trace.add("synthesize", synthesis_time)
         
-        return answer + sources_text, len(response.source_nodes) if hasattr(response, 'source_nodes') and response.source_nodes else 0
-    elif llm is not None:
-        response = llm.complete(full_query)
-        return str(response) + "\n\n⚠️ *Risposta senza RAG (nessun documento caricato)*", 0
-    else:
-        return "❌ Sistema non inizializzato. Riavvia il server.", 0
+        yield "token", suffix
+        yield "done", source_node_ids(source_nodes) if gen.query_engine is not None else None
+        
+        if gen.query_engine is not None:
+            answer_cache.put(
+                user_message, cache_context, gen.generation, "".join(tokens) + suffix,
+                len(source_nodes), sources_summary(source_nodes), query_bundle.embedding,
+            )
+
+
+async def stream_chat_completion(http_request: Request, model: str, user_message: str,
+                                 conversation: ConversationState, conversation_id: Optional[str],
+                                 ticket: AdmissionTicket):
+    """Generatore SSE (formato OpenAI chat.completion.chunk) per stream=true"""
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    
+    def chunk(delta: DeltaMessage, finish_reason: Optional[str] = None, sources=None, timings=None,
+              usage=None) -> str:
+        data = ChatCompletionChunk(
+            id=completion_id,
+            model=model,
+            choices=[ChatCompletionChunkChoice(delta=delta, finish_reason=finish_reason)],
+            usage=usage,
+            sources=sources,
+            timings=timings,
+        )
+        payload = data.model_dump(exclude_none=True)
+        payload["choices"][0]["finish_reason"] = finish_reason
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    
+    events = stream_query(user_message, build_conversation_context(conversation), conversation.recent(CONVERSATION_WINDOW))
+    answer_parts = []
+    last_check = time.monotonic()
+    try:
+        async for kind, payload in events:
+            if kind == "sources":
+                yield chunk(DeltaMessage(role="assistant", content=""), sources=payload)
+            elif kind == "token":
+                answer_parts.append(payload)
+                yield chunk(DeltaMessage(content=payload))
+            elif kind == "done":
+                remember_turn(conversation, conversation_id, user_message, "".join(answer_parts), payload)
+                trace = current_trace()
+                timings = trace.breakdown() if trace is not None and SERVER_TIMING_HEADER else None
+                usage = record_usage()
+                yield chunk(DeltaMessage(), finish_reason="stop", timings=timings, usage=usage)
+                yield "data: [DONE]\n\n"
+                logger.info("streaming completato", extra=usage.model_dump())
+            
+            # Al massimo un controllo al secondo della disconnessione del client
+            if time.monotonic() - last_check >= 1.0:
+                last_check = time.monotonic()
+                if await http_request.is_disconnected():
+                    logger.info("client disconnesso, generazione interrotta")
+                    break
+    except Exception as e:
+        QUERIES.labels(mode="stream", result="error").inc()
+        logger.exception("errore nella generazione in streaming")
+        yield chunk(DeltaMessage(content=f"\n\n❌ Errore nella generazione: {e}"), finish_reason="stop")
+        yield "data: [DONE]\n\n"
+    finally:
+        # Fine normale, errore o disconnessione: chiude lo stream Gemini e libera il posto
+        await events.aclose()
+        ticket.release()
+
+
+def admission_error(e: AdmissionRejected) -> HTTPException:
+    ADMISSION_REJECTED.labels(status=e.status_code).inc()
+    logger.warning("richiesta rifiutata", extra={"status": e.status_code, "retry_after": e.retry_after})
+    return HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
 
 
 @app.post("/v1/chat/completions")
 @app.post("/api/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
+async def chat_completions(request: ChatCompletionRequest, http_request: Request):
     """
     Chat completions endpoint (OpenAI-compatible)
     Usa il sistema RAG per rispondere alle domande
     Supporta memoria conversazione tramite i messaggi precedenti
     """
-    print(f"\n{'='*60}")
-    print(f"📨 Nuova richiesta chat")
-    print(f"{'='*60}")
-    
-    # Estrai messaggi e costruisci contesto conversazione
-    user_message = None
-    system_prompt = None
-    conversation_history = []
-    
-    for msg in request.messages:
-        if msg.role == "user":
-            user_message = msg.content
-            conversation_history.append(f"Utente: {msg.content}")
-        elif msg.role == "assistant":
-            # Rimuovi le fonti dal contesto per non inquinare
-            content = msg.content.split("\n\n---\n📚 **Fonti:**")[0] if msg.content else ""
-            conversation_history.append(f"Assistente: {content}")
-        elif msg.role == "system":
-            system_prompt = msg.content
-    
-    if not user_message:
-        print("❌ Nessun messaggio utente trovato")
+    if not startup.finished:
+        # Caricamento iniziale in corso: il client (o il load balancer) riprova
+        raise HTTPException(status_code=503, detail="Indice in caricamento, riprova tra poco",
+                            headers={"Retry-After": "5"})
+    
+    # La domanda è l'ultimo messaggio utente; i messaggi precedenti sono la cronologia
+    messages = [(msg.role, msg.content) for msg in request.messages]
+    question_index = max((i for i, (role, _) in enumerate(messages) if role == "user"), default=None)
+    if question_index is None:
+        logger.warning("nessun messaggio utente trovato")
         raise HTTPException(status_code=400, detail="Nessun messaggio utente trovato")
+    user_message = messages[question_index][1]
     
-    # Costruisci contesto (escludi l'ultimo messaggio che è la domanda attuale)
-    # Prendi solo gli ultimi 6 messaggi per non superare limiti token
-    context_messages = conversation_history[:-1][-6:] if len(conversation_history) > 1 else []
-    conversation_context = "\n".join(context_messages)
+    # Con lo store si elaborano solo i messaggi nuovi rispetto al turno precedente;
+    # nel contesto vanno il riassunto e gli ultimi CONVERSATION_WINDOW messaggi
+    # (più quelli usciti dalla finestra finché il riassunto in background non li copre)
+    conversation_id = conversation_id_from(http_request)
+    conversation = load_conversation(messages[:question_index], conversation_id)
+    conversation_context = build_conversation_context(conversation)
     
-    print(f"💬 Domanda: {user_message[:100]}{'...' if len(user_message) > 100 else ''}")
-    if context_messages:
-        print(f"📝 Contesto conversazione: {len(context_messages)} messaggi precedenti")
+    logger.info("richiesta chat", extra={
+        "question": user_message[:100],
+        "context_messages": min(len(conversation.history), CONVERSATION_WINDOW),
+        "summary": bool(conversation.summary),
+        "stream": bool(request.stream),
+    })
     
+    # Admission control: posto di esecuzione o 429/503 immediato
     try:
-        print("🔍 Esecuzione query...")
-        
-        # Esegui la query in un thread separato per evitare conflitti asyncio
-        loop = asyncio.get_event_loop()
-        full_response, num_sources = await loop.run_in_executor(
-            executor, 
-            run_query_sync, 
-            user_message,
-            conversation_context
+        ticket = await admission.acquire()
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    
+    if request.stream:
+        return StreamingResponse(
+            stream_chat_completion(http_request, request.model, user_message, conversation, conversation_id, ticket),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            # Se il client si disconnette prima dell'inizio dello stream
+            background=BackgroundTask(ticket.release),
         )
-        
-        print(f"✅ Risposta ricevuta ({len(full_response)} caratteri)")
-        if num_sources > 0:
-            print(f"📚 Fonti trovate: {num_sources}")
+    
+    try:
+        full_response, num_sources, node_ids = await run_query(
+            user_message, conversation_context, conversation.recent(CONVERSATION_WINDOW))
+        remember_turn(conversation, conversation_id, user_message, full_response, node_ids)
+        usage = record_usage()
+        logger.info("risposta generata", extra={
+            "answer_chars": len(full_response),
+            "sources": num_sources,
+            **usage.model_dump(),
+        })
         
         result = ChatCompletionResponse(
             model=request.model,
@@ -417,36 +1541,89 @@ async def chat_completions(request: ChatCompletionRequest):
                     message=Message(role="assistant", content=full_response),
                     finish_reason="stop"
                 )
-            ]
+            ],
+            usage=usage,
         )
-        
-        print(f"✅ Risposta inviata con successo")
         return result.model_dump()
         
     except Exception as e:
-        print(f"❌ Errore durante la generazione: {e}")
-        traceback.print_exc()
+        QUERIES.labels(mode="sync", result="error").inc()
+        logger.exception("errore durante la generazione")
         raise HTTPException(status_code=500, detail=f"Errore nella generazione: {str(e)}")
+    finally:
+        ticket.release()
 
 
 @app.post("/v1/embeddings")
-async def create_embeddings(request: dict):
-    """Endpoint embeddings (placeholder)"""
-    return {"object": "list", "data": [], "model": EMBEDDING_MODEL}
+async def create_embeddings(request: EmbeddingRequest):
+    """
+    Embeddings endpoint (OpenAI-compatible)
+    Le richieste concorrenti vengono unite in micro-batch verso il modello
+    di embedding configurato, passando prima dalla cache persistente
+    """
+    if embedding_batcher is None:
+        raise HTTPException(status_code=503, detail=NOT_INITIALIZED_MESSAGE)
+    
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    if not texts or any(not text for text in texts):
+        raise HTTPException(status_code=400, detail="input deve contenere testi non vuoti")
+    if request.encoding_format not in (None, "float", "base64"):
+        raise HTTPException(status_code=400, detail=f"encoding_format non supportato: {request.encoding_format}")
+    
+    try:
+        vectors = await embedding_batcher.embed(texts)
+    except Exception as e:
+        logger.exception("errore nel calcolo degli embedding")
+        raise HTTPException(status_code=502, detail=f"Errore nel calcolo degli embedding: {str(e)}")
+    
+    def encode(vector):
+        if request.encoding_format == "base64":
+            return base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+        return vector
+    
+    prompt_tokens = sum(estimate_tokens(text) for text in texts)
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": encode(vector)}
+            for i, vector in enumerate(vectors)
+        ],
+        "model": EMBEDDING_MODEL,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
 
 
 @app.get("/health")
 async def health_check():
     """Health check dettagliato"""
+    gen = engines.current
     return {
         "status": "healthy",
-        "rag_enabled": query_engine is not None,
+        "rag_enabled": gen.query_engine is not None,
         "documents_path": DOCUMENTS_PATH,
-        "index_loaded": index is not None,
+        "index_loaded": gen.index is not None,
+        "index_generation": gen.generation,
+        "reload_in_progress": reload_in_progress(),
+        "startup": startup.snapshot(),
+        "parse_failures": parse_failures,
+        "last_build": last_build,
+        "admission": admission.stats(),
+        "answer_cache": answer_cache.stats(),
+        "question_condenser": question_condenser.stats(),
+        "conversations": conversation_store.stats() if conversation_store is not None else None,
+        "embedding_cache": embedding_cache.stats() if embedding_cache is not None else None,
+        "parsed_cache": parsed_text_cache.stats() if parsed_text_cache is not None else None,
+        "embeddings_endpoint": embedding_batcher.stats if embedding_batcher is not None else None,
         "model": MODEL_NAME
     }
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Metriche in formato Prometheus"""
+    return Response(content=metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+
 @app.get("/documents")
 async def list_documents():
     """Lista dei documenti indicizzati nel sistema RAG"""
@@ -470,11 +1647,12 @@ async def list_documents():
     
     # Info sull'indice
     index_info = None
+    index = engines.current.index
     if index is not None:
         try:
             # Ottieni info sui nodi nell'indice
-            docstore = index.storage_context.docstore
-            num_nodes = len(docstore.docs)
+            # Dall'index struct: con il docstore condiviso .docs leggerebbe tutti i nodi
+            num_nodes = len(index.index_struct.nodes_dict)
             index_info = {
                 "loaded": True,
                 "num_chunks": num_nodes
@@ -492,6 +1670,11 @@ async def list_documents():
     }
 
 
+def reload_in_progress() -> bool:
+    """True se una reindicizzazione è in corso o in coda"""
+    return reload_future is not None and not reload_future.done()
+
+
 @app.post("/reload")
 async def reload_index():
     """
@@ -502,24 +1685,32 @@ async def reload_index():
     print("🔄 RELOAD RICHIESTO - Reindicizzazione in corso...")
     print("="*60 + "\n")
     
+    global reload_future
     try:
-        # Crea il flag di reindicizzazione
-        reindex_flag = Path("./REINDEX_REQUIRED")
-        reindex_flag.write_text(f"Reindicizzazione richiesta il {time.time()}")
-        
-        # Esegui setup_rag in un thread separato per non bloccare
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(executor, setup_rag)
+        # Costruisci la nuova generazione sull'executor dedicato: le query
+        # continuano a essere servite dalla generazione corrente
+        reload_future = reload_executor.submit(rebuild_index_blue_green)
+        gen = await asyncio.wrap_future(reload_future)
         
         print("\n" + "="*60)
-        print("✅ RELOAD COMPLETATO - Sistema pronto!")
+        print(f"✅ RELOAD COMPLETATO - Sistema pronto! (generazione {gen.generation})")
         print("="*60 + "\n")
         
+        resumed = last_build.get("mode") == "resumed"
+        if last_build.get("status") == "unchanged":
+            message = "Documenti invariati: indice già aggiornato"
+        elif resumed:
+            message = "Reindicizzazione ripresa dall'ultimo checkpoint e completata"
+        else:
+            message = "Reindicizzazione completata con successo"
         return {
             "status": "success",
-            "message": "Reindicizzazione completata con successo",
-            "index_loaded": index is not None,
-            "query_engine_ready": query_engine is not None
+            "message": message,
+            "index_loaded": gen.index is not None,
+            "query_engine_ready": gen.query_engine is not None,
+            "index_generation": gen.generation,
+            "parse_failures": parse_failures,
+            "build": last_build,
         }
     except Exception as e:
         print(f"\n❌ ERRORE DURANTE RELOAD: {e}\n")
@@ -535,6 +1726,25 @@ async def reload_index():
 # ============================================================================
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    print("\n🚀 Avvio server su http://0.0.0.0:8000\n")
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+    
+    parser = argparse.ArgumentParser(description="RAG API Server (OpenAI-compatible)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processi uvicorn (condividono l'indice in memory-map, vedi SHARED_INDEX)")
+    args = parser.parse_args()
+    
+    print(f"\n🚀 Avvio server su http://{args.host}:{args.port} ({args.workers} worker)\n")
+    if args.workers > 1:
+        # I worker importano l'app in processi nuovi: il numero di worker arriva
+        # dall'ambiente (default di SHARED_INDEX)
+        os.environ["WEB_CONCURRENCY"] = str(args.workers)
+        shared_default = "true" if SHARED_INDEX_SUPPORTED else "false"
+        if os.getenv("SHARED_INDEX", shared_default).lower() not in ("1", "true", "yes"):
+            print("⚠️ SHARED_INDEX disattivato: ogni worker terrà una copia privata del docstore")
+        # Con più worker uvicorn importa l'app in ogni processo
+        uvicorn.run("api_server:app", host=args.host, port=args.port, workers=args.workers, log_level="info")
+    else:
+        uvicorn.run(app, host=args.host, port=args.port, log_level="info")
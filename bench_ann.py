@@ -0,0 +1,93 @@
+"""
+Benchmark ANN - Recall e latenza dell'indice IVF
+=================================================
+Confronta la ricerca approssimata (IVFVectorStore) con quella esatta
+(NumpyVectorStore) e riporta recall@k e latenza p50/p99 per diversi nprobe.
+
+Per eseguire:
+    python bench_ann.py                          # dati sintetici (200k x 768)
+    python bench_ann.py --vectors 1000000 --nprobe 4 8 16 32
+    python bench_ann.py --storage ./storage      # embedding reali dell'indice
+"""
+
+import os
+import time
+import argparse
+
+import numpy as np
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from numpy_vector_store import NumpyVectorStore, normalize_rows
+from ivf_vector_store import IVFVectorStore
+
+
+def synthetic_vectors(n: int, dim: int, clusters: int = 500, seed: int = 0) -> np.ndarray:
+    """Vettori raggruppati in cluster (più realistici di un rumore uniforme)"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=n)
+    vectors = centers[labels] + 0.6 * rng.normal(size=(n, dim)).astype(np.float32)
+    return normalize_rows(vectors).astype(np.float32)
+
+
+def fill_store(store: NumpyVectorStore, vectors: np.ndarray) -> NumpyVectorStore:
+    """Carica i vettori direttamente nella matrice (senza creare nodi LlamaIndex)"""
+    store._matrix = vectors
+    store._alive = np.ones(len(vectors), dtype=bool)
+    store._set_ids([str(i) for i in range(len(vectors))], ["bench"] * len(vectors))
+    return store
+
+
+def run_queries(store: NumpyVectorStore, queries: np.ndarray, k: int):
+    results, latencies = [], []
+    for q in queries:
+        query = VectorStoreQuery(query_embedding=q.tolist(), similarity_top_k=k)
+        started = time.perf_counter()
+        result = store.query(query)
+        latencies.append((time.perf_counter() - started) * 1000)
+        results.append(set(result.ids))
+    return results, np.asarray(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recall/latenza IVF vs ricerca esatta")
+    parser.add_argument("--vectors", type=int, default=200_000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32, 64])
+    parser.add_argument("--storage", help="Usa gli embedding di un indice salvato (es. ./storage)")
+    args = parser.parse_args()
+
+    if args.storage:
+        vectors = np.asarray(NumpyVectorStore.from_persist_dir(args.storage)._matrix, dtype=np.float32)
+        print(f"📂 {len(vectors)} embedding da {os.path.abspath(args.storage)}")
+    else:
+        print(f"🎲 Generazione di {args.vectors} vettori sintetici ({args.dim} dimensioni)...")
+        vectors = synthetic_vectors(args.vectors, args.dim)
+
+    rng = np.random.default_rng(1)
+    # Query vicine ai dati ma non identiche a nessun vettore indicizzato
+    picks = vectors[rng.choice(len(vectors), size=args.queries, replace=False)]
+    queries = normalize_rows(picks + 0.3 * rng.normal(size=picks.shape).astype(np.float32))
+
+    exact = fill_store(NumpyVectorStore(), vectors)
+    truth, exact_lat = run_queries(exact, queries, args.k)
+
+    ivf = fill_store(IVFVectorStore(nlist=args.nlist, min_train_size=0), vectors)
+    ivf.train()
+
+    print()
+    print(f"{'metodo':<18}{'recall@' + str(args.k):>10}{'p50 ms':>10}{'p99 ms':>10}")
+    print("-" * 48)
+    print(f"{'esatta':<18}{1.0:>10.3f}{np.percentile(exact_lat, 50):>10.2f}{np.percentile(exact_lat, 99):>10.2f}")
+    for nprobe in args.nprobe:
+        ivf.nprobe = nprobe
+        found, lat = run_queries(ivf, queries, args.k)
+        recall = np.mean([len(f & t) / len(t) for f, t in zip(found, truth)])
+        print(f"{'ivf nprobe=' + str(nprobe):<18}{recall:>10.3f}{np.percentile(lat, 50):>10.2f}{np.percentile(lat, 99):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""
+BM25 Index - Ricerca lessicale e retrieval ibrido
+==================================================
+Indice invertito BM25 costruito all'ingestione dagli stessi nodi del vector
+index. Serve per le domande con codici di errore, codici prodotto ed
+etichette di menu, che gli embedding recuperano male.
+
+- Persistenza incrementale: postings in SQLite (bm25.sqlite in ./storage),
+  aggiornati a ogni inserimento/rimozione di nodi, senza riscrivere l'indice
+- Caricamento lazy: le postings vengono lette in memoria alla prima query
+- HybridRetriever: VectorIndexRetriever e BM25 interrogati in parallelo,
+  risultati fusi con reciprocal rank fusion (RRF)
+"""
+
+import os
+import re
+import math
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+
+BM25_FILENAME = "bm25.sqlite"
+
+# Parole (o codici con separatori interni: E-1042, ABC/12.5, menu_item)
+# Metadato con la similarità coseno del ramo vettoriale (lo score fuso è RRF)
+VECTOR_SCORE_KEY = "vector_score"
+
+TOKEN_RE = re.compile(r"\w+(?:[-./_]\w+)*")
+SUBTOKEN_RE = re.compile(r"[^\W_]+")
+
+STOPWORDS = frozenset("""
+a ad al alla alle allo agli ai anche che chi ci come con cui da dal dalla dalle dai degli dei del della delle
+dello di e ed gli ha hanno ho i il in io la le lo loro ma mi ne nei nel nella nelle non o per più può quale
+quando quello questa queste questi questo se si sia sono su sul sulla sua sue suo tra tu un una uno è
+the of and to in is it for on that this with as be are or an by at from
+""".split())
+
+# Thread per la ricerca lessicale in parallelo al retrieval vettoriale
+_lexical_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bm25")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Token minuscoli senza accenti, senza stopword. I codici composti
+    ("E-1042") restano anche interi, oltre alle singole parti.
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    tokens = []
+    for match in TOKEN_RE.finditer(text):
+        token = match.group()
+        parts = SUBTOKEN_RE.findall(token)
+        if len(parts) > 1:
+            tokens.append(token)
+        tokens.extend(p for p in parts if p not in STOPWORDS)
+    return tokens
+
+
+class BM25Index:
+    """
+    Indice BM25 persistito in SQLite e tenuto in memoria dopo la prima query.
+
+    Args:
+        persist_dir: Directory dell'indice (il file è persist_dir/bm25.sqlite)
+        k1, b: Parametri BM25
+    """
+
+    def __init__(self, persist_dir: str, k1: float = 1.2, b: float = 0.75):
+        self.persist_dir = persist_dir
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._loaded = False
+        # Stato in memoria (valido solo se _loaded)
+        self._row_of: Dict[str, int] = {}
+        self._node_ids: List[Optional[str]] = []
+        self._lengths = np.zeros(0, dtype=np.float32)
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._total_length = 0
+
+        os.makedirs(persist_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS docs (
+                    row INTEGER PRIMARY KEY,
+                    node_id TEXT NOT NULL UNIQUE,
+                    length INTEGER NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL,
+                    row INTEGER NOT NULL,
+                    tf INTEGER NOT NULL,
+                    PRIMARY KEY (term, row)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_postings_row ON postings (row)")
+
+    @property
+    def db_path(self) -> str:
+        return os.path.join(self.persist_dir, BM25_FILENAME)
+
+    @contextmanager
+    def _connect(self):
+        """
+        Connessione breve in una transazione (commit all'uscita): la directory
+        può essere rinominata dallo swap blue/green, non si tengono file aperti
+        """
+        with closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
+            with conn:
+                yield conn
+
+    def __len__(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    # ------------------------------------------------------------------
+    # Aggiornamento incrementale
+    # ------------------------------------------------------------------
+
+    def add_nodes(self, nodes: Iterable) -> int:
+        """Indicizza i nodi (testo come lo vede l'embedding model); restituisce quanti"""
+        docs = []
+        for node in nodes:
+            terms = Counter(tokenize(node.get_content(metadata_mode=MetadataMode.EMBED)))
+            docs.append((node.node_id, terms))
+        if not docs:
+            return 0
+
+        with self._lock:
+            with self._connect() as conn:
+                self._delete_rows(conn, [node_id for node_id, _ in docs])
+                for node_id, terms in docs:
+                    row = conn.execute(
+                        "INSERT INTO docs (node_id, length) VALUES (?, ?)",
+                        (node_id, sum(terms.values())),
+                    ).lastrowid
+                    conn.executemany(
+                        "INSERT INTO postings (term, row, tf) VALUES (?, ?, ?)",
+                        [(term, row, tf) for term, tf in terms.items()],
+                    )
+                    if self._loaded:
+                        self._add_in_memory(row, node_id, terms)
+        return len(docs)
+
+    def delete_nodes(self, node_ids: List[str]):
+        with self._lock:
+            with self._connect() as conn:
+                self._delete_rows(conn, node_ids)
+
+    def retain(self, node_ids: Iterable[str]) -> int:
+        """Rimuove i nodi indicizzati che non sono fra node_ids (es. scritti dopo l'ultimo checkpoint)"""
+        keep = set(node_ids)
+        with self._lock:
+            with self._connect() as conn:
+                stale = [node_id for (node_id,) in conn.execute("SELECT node_id FROM docs") if node_id not in keep]
+                self._delete_rows(conn, stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM postings")
+                conn.execute("DELETE FROM docs")
+            self._loaded = False
+            self._reset_memory()
+
+    def _delete_rows(self, conn: sqlite3.Connection, node_ids: List[str]):
+        for start in range(0, len(node_ids), 500):
+            block = node_ids[start:start + 500]
+            placeholders = ",".join("?" * len(block))
+            rows = [r for (r,) in conn.execute(f"SELECT row FROM docs WHERE node_id IN ({placeholders})", block)]
+            if not rows:
+                continue
+            row_placeholders = ",".join("?" * len(rows))
+            if self._loaded:
+                for term, row in conn.execute(f"SELECT term, row FROM postings WHERE row IN ({row_placeholders})", rows):
+                    self._postings.get(term, {}).pop(row, None)
+                    self._arrays.pop(term, None)
+                for row in rows:
+                    self._total_length -= int(self._lengths[row])
+                    self._row_of.pop(self._node_ids[row], None)
+                    self._node_ids[row] = None
+                    self._lengths[row] = 0
+            conn.execute(f"DELETE FROM postings WHERE row IN ({row_placeholders})", rows)
+            conn.execute(f"DELETE FROM docs WHERE row IN ({row_placeholders})", rows)
+
+    # ------------------------------------------------------------------
+    # Stato in memoria
+    # ------------------------------------------------------------------
+
+    def _reset_memory(self):
+        self._row_of, self._node_ids = {}, []
+        self._lengths = np.zeros(0, dtype=np.float32)
+        self._postings, self._arrays = {}, {}
+        self._total_length = 0
+
+    def _add_in_memory(self, row: int, node_id: str, terms: Counter):
+        if row >= len(self._node_ids):
+            grow = max(row + 1, 2 * len(self._node_ids))
+            self._node_ids.extend([None] * (grow - len(self._node_ids)))
+            lengths = np.zeros(grow, dtype=np.float32)
+            lengths[:len(self._lengths)] = self._lengths
+            self._lengths = lengths
+        self._node_ids[row] = node_id
+        self._row_of[node_id] = row
+        length = sum(terms.values())
+        self._lengths[row] = length
+        self._total_length += length
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[row] = tf
+            self._arrays.pop(term, None)
+
+    def _ensure_loaded(self):
+        """Carica le postings da SQLite alla prima query"""
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._reset_memory()
+            with self._connect() as conn:
+                max_row = conn.execute("SELECT COALESCE(MAX(row), -1) FROM docs").fetchone()[0]
+                self._node_ids = [None] * (max_row + 1)
+                self._lengths = np.zeros(max_row + 1, dtype=np.float32)
+                for row, node_id, length in conn.execute("SELECT row, node_id, length FROM docs"):
+                    self._node_ids[row] = node_id
+                    self._row_of[node_id] = row
+                    self._lengths[row] = length
+                    self._total_length += length
+                for term, row, tf in conn.execute("SELECT term, row, tf FROM postings"):
+                    self._postings.setdefault(term, {})[row] = tf
+            self._loaded = True
+            print(f"🔤 Indice BM25 caricato: {len(self._row_of)} chunk, {len(self._postings)} termini")
+
+    def _term_arrays(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            postings = self._postings.get(term)
+            if not postings:
+                return None
+            arrays = self._arrays[term] = (
+                np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                np.fromiter(postings.values(), dtype=np.float32, count=len(postings)),
+            )
+        return arrays
+
+    # ------------------------------------------------------------------
+    # Ricerca
+    # ------------------------------------------------------------------
+
+    def search(self, query: str, top_k: int = 20) -> List[Tuple[str, float]]:
+        """Top-k (node_id, punteggio BM25) per la query"""
+        self._ensure_loaded()
+        terms = set(tokenize(query))
+        with self._lock:
+            n_docs = len(self._row_of)
+            if not terms or n_docs == 0:
+                return []
+            avg_length = self._total_length / n_docs
+            lengths = self._lengths
+            scores = np.zeros(len(lengths), dtype=np.float32)
+            for term in terms:
+                arrays = self._term_arrays(term)
+                if arrays is None:
+                    continue
+                rows, tf = arrays
+                idf = math.log(1.0 + (n_docs - len(rows) + 0.5) / (len(rows) + 0.5))
+                norm = self.k1 * (1.0 - self.b + self.b * lengths[rows] / avg_length)
+                scores[rows] += idf * tf * (self.k1 + 1.0) / (tf + norm)
+            node_ids = self._node_ids
+
+        hits = np.flatnonzero(scores)
+        if len(hits) == 0:
+            return []
+        if len(hits) > top_k:
+            hits = hits[np.argpartition(-scores[hits], top_k - 1)[:top_k]]
+        hits = hits[np.argsort(-scores[hits])]
+        return [(node_ids[row], float(scores[row])) for row in hits]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retrieval ibrido: vettoriale + BM25 interrogati in parallelo e fusi con
+    reciprocal rank fusion (score = Σ 1 / (rrf_k + rank)).
+
+    Il punteggio restituito è normalizzato in [0, 1] (1 = primo in entrambe
+    le liste), così resta leggibile come "rilevanza" nelle fonti. È un
+    punteggio di rango, non una similarità: i nodi trovati dal vettoriale
+    conservano il coseno originale nei metadati (VECTOR_SCORE_KEY, escluso
+    da prompt ed embedding) per chi deve confrontare similarità.
+    """
+
+    def __init__(self, vector_retriever: BaseRetriever, lexical_index: BM25Index, docstore,
+                 similarity_top_k: int = 5, lexical_top_k: int = 20, rrf_k: int = 60):
+        self._vector_retriever = vector_retriever
+        self._lexical_index = lexical_index
+        self._docstore = docstore
+        self._similarity_top_k = similarity_top_k
+        self._lexical_top_k = lexical_top_k
+        self._rrf_k = rrf_k
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        lexical_future = _lexical_executor.submit(self._search_lexical, query_bundle.query_str)
+        vector_nodes = self._vector_retriever.retrieve(query_bundle)
+        return self._fuse(vector_nodes, lexical_future.result())
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        import asyncio
+        import contextvars
+        # Il contesto (request id della richiesta) segue la ricerca nel thread
+        context = contextvars.copy_context()
+        lexical_task = asyncio.get_running_loop().run_in_executor(
+            _lexical_executor, context.run, self._search_lexical, query_bundle.query_str)
+        vector_nodes = await self._vector_retriever.aretrieve(query_bundle)
+        return self._fuse(vector_nodes, await lexical_task)
+
+    def _search_lexical(self, query: str) -> List[Tuple[str, float]]:
+        try:
+            return self._lexical_index.search(query, self._lexical_top_k)
+        except sqlite3.Error as e:
+            # Indice lessicale non disponibile: si prosegue con il solo vettoriale
+            print(f"⚠️ Ricerca BM25 non disponibile: {e}")
+            return []
+
+    def _fuse(self, vector_nodes: List[NodeWithScore], lexical_hits: List[Tuple[str, float]]) -> List[NodeWithScore]:
+        fused: Dict[str, float] = {}
+        nodes: Dict[str, NodeWithScore] = {}
+        for rank, node in enumerate(vector_nodes):
+            fused[node.node.node_id] = 1.0 / (self._rrf_k + rank + 1)
+            nodes[node.node.node_id] = node
+            if node.score is not None:
+                node.node.metadata[VECTOR_SCORE_KEY] = node.score
+                for keys in (node.node.excluded_llm_metadata_keys, node.node.excluded_embed_metadata_keys):
+                    if VECTOR_SCORE_KEY not in keys:
+                        keys.append(VECTOR_SCORE_KEY)
+        for rank, (node_id, _) in enumerate(lexical_hits):
+            fused[node_id] = fused.get(node_id, 0.0) + 1.0 / (self._rrf_k + rank + 1)
+
+        best = sorted(fused, key=fused.get, reverse=True)[:self._similarity_top_k]
+        missing = [node_id for node_id in best if node_id not in nodes]
+        if missing:
+            for node in self._docstore.get_nodes(missing, raise_error=False):
+                if node is not None:
+                    nodes[node.node_id] = NodeWithScore(node=node)
+
+        max_score = 2.0 / (self._rrf_k + 1)
+        return [
+            NodeWithScore(node=nodes[node_id].node, score=fused[node_id] / max_score)
+            for node_id in best if node_id in nodes
+        ]
@@ -0,0 +1,99 @@
+"""
+Condense - Domanda autonoma per il retrieval
+=============================================
+Nelle conversazioni le domande di follow-up ("e per la versione 2?") non
+sono ricercabili da sole. Invece di embeddare tutta la cronologia insieme
+alla domanda, il LLM riscrive il follow-up come domanda autonoma, usata
+solo per il retrieval; la cronologia resta nel prompt di sintesi.
+
+Le riscritture sono in cache per hash di (cronologia, domanda): Open WebUI
+rimanda l'intera conversazione a ogni richiesta (e la rigenera quando si
+ripete una risposta), quindi la stessa riscrittura non viene ricalcolata.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict
+
+from answer_cache import AnswerCache
+from tracing import logger
+
+CONDENSE_PROMPT_STR = (
+    "Data la conversazione seguente e una nuova domanda dell'utente, riscrivi "
+    "la nuova domanda in modo che sia comprensibile da sola, senza la "
+    "conversazione: sostituisci pronomi e riferimenti impliciti con ciò a cui "
+    "si riferiscono. Non rispondere alla domanda. Se è già autonoma, "
+    "restituiscila invariata. Rispondi solo con la domanda riscritta, in italiano.\n\n"
+    "Conversazione:\n"
+    "{conversation}\n\n"
+    "Nuova domanda: {question}\n\n"
+    "Domanda autonoma:"
+)
+
+
+class QuestionCondenser:
+    """
+    Riscrittura dei follow-up in domande autonome, con cache LRU.
+
+    Args:
+        max_entries: Riscritture mantenute in cache
+        max_chars: Lunghezza massima accettata per la riscrittura (oltre, si usa la domanda originale)
+    """
+
+    def __init__(self, max_entries: int = 1000, max_chars: int = 1000):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def condense(self, llm, question: str, conversation_context: str) -> str:
+        """Domanda autonoma per il retrieval (la domanda stessa se non c'è cronologia)"""
+        if not conversation_context:
+            return question
+
+        # Stessa chiave della cache delle risposte: domanda e cronologia normalizzate
+        key = AnswerCache.make_key(question, conversation_context)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        prompt = CONDENSE_PROMPT_STR.format(conversation=conversation_context, question=question)
+        try:
+            response = await llm.acomplete(prompt)
+        except Exception:
+            # Meglio un retrieval sulla sola domanda che una richiesta fallita
+            self.errors += 1
+            logger.warning("riscrittura della domanda fallita", exc_info=True)
+            return question
+
+        condensed = str(response).strip().strip('"').strip()
+        if not condensed or len(condensed) > self.max_chars:
+            condensed = question
+        with self._lock:
+            self._entries[key] = condensed
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        logger.debug("domanda riscritta", extra={"question": question[:100], "condensed": condensed[:200]})
+        return condensed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
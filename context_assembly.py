@@ -0,0 +1,181 @@
+"""
+Context Assembly - Contesto per il LLM entro un budget di token
+================================================================
+Fase tra retrieval e sintesi: decide quali chunk recuperati arrivano
+davvero a Gemini.
+
+1. Cutoff relativo: scarta i chunk con similarità < relative_cutoff ×
+   similarità del migliore (il numero di chunk si adatta alla query invece
+   di essere sempre similarity_top_k). Ha senso solo su similarità: con il
+   retrieval ibrido lo score è RRF (un chunk trovato da una sola lista vale
+   al più ~0.5), quindi il cutoff usa il coseno del ramo vettoriale
+   (VECTOR_SCORE_KEY) e non tocca i chunk trovati solo dal BM25
+2. Merge dei vicini: chunk dello stesso file che si sovrappongono (il
+   chunk_overlap dello splitter) o sono contigui diventano un solo blocco
+   di testo, senza ripetere la parte in comune
+3. Budget: i blocchi entrano in ordine di score finché i loro token
+   (contati con il tokenizer di LlamaIndex) restano entro token_budget;
+   il primo blocco entra sempre, troncato se necessario
+
+    assembler = ContextAssembler(token_budget=3000, relative_cutoff=0.5)
+    nodes, stats = assembler.assemble(nodes)
+"""
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llama_index.core.schema import MetadataMode, NodeWithScore, TextNode
+from llama_index.core.utils import get_tokenizer
+
+from bm25_index import VECTOR_SCORE_KEY
+
+
+def _span(node_with_score: NodeWithScore):
+    node = node_with_score.node
+    return getattr(node, "start_char_idx", None), getattr(node, "end_char_idx", None)
+
+
+def _merge_pair(first: NodeWithScore, second: NodeWithScore) -> NodeWithScore:
+    """Unisce due chunk consecutivi dello stesso file (first inizia prima)"""
+    start_a, end_a = _span(first)
+    start_b, end_b = _span(second)
+    text_a, text_b = first.node.get_content(), second.node.get_content()
+    overlap = max(0, end_a - start_b)
+    if end_b <= end_a:
+        # second interamente contenuto in first
+        text, end = text_a, end_a
+    else:
+        separator = "" if overlap else "\n"
+        text, end = text_a + separator + text_b[min(overlap, len(text_b)):], end_b
+
+    merged = TextNode(
+        id_=first.node.node_id,
+        text=text,
+        metadata=dict(first.node.metadata),
+        excluded_embed_metadata_keys=list(first.node.excluded_embed_metadata_keys),
+        excluded_llm_metadata_keys=list(first.node.excluded_llm_metadata_keys),
+        relationships=dict(first.node.relationships),
+        start_char_idx=start_a,
+        end_char_idx=end,
+    )
+    merged_ids = first.node.metadata.get("merged_node_ids") or [first.node.node_id]
+    merged.metadata["merged_node_ids"] = merged_ids + (
+        second.node.metadata.get("merged_node_ids") or [second.node.node_id]
+    )
+    merged.excluded_llm_metadata_keys.append("merged_node_ids")
+    merged.excluded_embed_metadata_keys.append("merged_node_ids")
+    return NodeWithScore(node=merged, score=max(first.score or 0.0, second.score or 0.0))
+
+
+def merge_neighbours(nodes: List[NodeWithScore], max_gap: int = 1) -> List[NodeWithScore]:
+    """
+    Unisce i chunk dello stesso documento che si sovrappongono o distano al
+    più max_gap caratteri. Il blocco unito prende lo score migliore e la
+    posizione del suo chunk migliore nell'ordine originale.
+    """
+    groups = {}
+    for position, item in enumerate(nodes):
+        start, end = _span(item)
+        ref = item.node.ref_doc_id
+        if ref is None or start is None or end is None:
+            groups[("", position)] = [(position, item)]
+        else:
+            groups.setdefault(ref, []).append((position, item))
+
+    merged = []
+    for items in groups.values():
+        items.sort(key=lambda pair: _span(pair[1])[0] if _span(pair[1])[0] is not None else 0)
+        position, current = items[0]
+        for next_position, item in items[1:]:
+            if _span(item)[0] <= _span(current)[1] + max_gap:
+                best = position if (current.score or 0) >= (item.score or 0) else next_position
+                current, position = _merge_pair(current, item), best
+            else:
+                merged.append((position, current))
+                position, current = next_position, item
+        merged.append((position, current))
+
+    merged.sort(key=lambda pair: pair[0])
+    return [item for _, item in merged]
+
+
+class ContextAssembler:
+    """
+    Cutoff relativo, merge dei vicini e budget di token sui nodi recuperati.
+    Senza stato per richiesta: la stessa istanza serve query concorrenti.
+
+    Args:
+        token_budget: Token massimi di contesto passati al LLM
+        relative_cutoff: Frazione della similarità migliore sotto cui un chunk è scartato (0 = nessun cutoff)
+        metadata_mode: Come il synthesizer rende i nodi nel prompt (i metadati contano nel budget)
+    """
+
+    def __init__(self, token_budget: int = 3000, relative_cutoff: float = 0.0,
+                 metadata_mode: MetadataMode = MetadataMode.LLM, tokenizer: Optional[Callable] = None):
+        self.token_budget = token_budget
+        self.relative_cutoff = relative_cutoff
+        self.metadata_mode = metadata_mode
+        self._tokenizer = tokenizer or get_tokenizer()
+
+    def assemble(self, nodes: List[NodeWithScore]) -> Tuple[List[NodeWithScore], Dict[str, int]]:
+        """Nodi da passare al synthesizer (in ordine di score) e statistiche della selezione"""
+        stats = {"retrieved": len(nodes), "cutoff": 0, "merged": 0, "over_budget": 0, "selected": 0, "tokens": 0}
+        if not nodes:
+            return nodes, stats
+
+        ranked = sorted(nodes, key=lambda n: n.score or 0.0, reverse=True)
+        if self.relative_cutoff > 0:
+            ranked = self._cutoff(ranked, stats)
+
+        blocks = merge_neighbours(ranked)
+        stats["merged"] = len(ranked) - len(blocks)
+
+        selected, used = [], 0
+        for block in blocks:
+            tokens = len(self._tokenizer(block.node.get_content(metadata_mode=self.metadata_mode)))
+            if used + tokens <= self.token_budget:
+                selected.append(block)
+                used += tokens
+            elif not selected:
+                # Il chunk migliore entra sempre, troncato al budget
+                selected.append(self._truncate(block, self.token_budget))
+                used = self.token_budget
+            else:
+                stats["over_budget"] += 1
+
+        stats["selected"] = len(selected)
+        stats["tokens"] = used
+        return selected, stats
+
+    def _cutoff(self, ranked: List[NodeWithScore], stats: Dict[str, int]) -> List[NodeWithScore]:
+        """
+        Cutoff relativo sulla similarità: il coseno vettoriale se il retriever
+        lo ha conservato (score fuso RRF), altrimenti lo score del nodo. I
+        nodi senza similarità (solo BM25) restano: il cutoff non li misura.
+        """
+        fused = any(VECTOR_SCORE_KEY in n.node.metadata for n in ranked)
+
+        def similarity(item: NodeWithScore) -> Optional[float]:
+            if fused:
+                return item.node.metadata.get(VECTOR_SCORE_KEY)
+            return item.score or 0.0
+
+        top_score = max((s for s in map(similarity, ranked) if s is not None), default=0.0)
+        if top_score <= 0:
+            return ranked
+        kept = [n for n in ranked if similarity(n) is None or similarity(n) >= self.relative_cutoff * top_score]
+        stats["cutoff"] = len(ranked) - len(kept)
+        return kept
+
+    def _truncate(self, block: NodeWithScore, budget: int) -> NodeWithScore:
+        node = block.node
+        header_tokens = len(self._tokenizer(node.get_content(metadata_mode=self.metadata_mode))) - len(
+            self._tokenizer(node.get_content())
+        )
+        text = node.get_content()
+        available = max(1, budget - max(0, header_tokens))
+        # Taglio proporzionale in caratteri, poi ritocco finché il testo entra nel budget
+        while text and len(self._tokenizer(text)) > available:
+            text = text[: int(len(text) * available / len(self._tokenizer(text)) * 0.95)]
+        truncated = node.model_copy()
+        truncated.set_content(text)
+        return NodeWithScore(node=truncated, score=block.score)
@@ -0,0 +1,263 @@
+"""
+Conversation Store - Stato delle conversazioni lato server
+===========================================================
+Open WebUI rimanda l'intera lista di messaggi a ogni turno. Lo store
+conserva, per ogni conversazione, la cronologia già elaborata (messaggi
+formattati, fonti rimosse), un riassunto progressivo dei turni usciti
+dalla finestra di contesto e gli id dei nodi recuperati nell'ultimo turno:
+a ogni richiesta si elaborano solo i messaggi nuovi.
+
+Chiave della conversazione:
+- id esplicito (header X-Conversation-ID), se il client lo invia
+- altrimenti hash a catena dei messaggi precedenti: lo stato salvato dopo
+  un turno ha come chiave l'hash di (messaggi + risposta), che è il
+  prefisso della richiesta successiva
+
+In entrambi i casi il prefisso viene verificato con l'hash: se il client
+ha modificato o rigenerato un messaggio la cronologia viene ricostruita.
+
+Gli stati vivono in memoria (LRU + TTL); con db_path quelli espulsi dalla
+memoria (e tutti, alla chiusura) vengono salvati in SQLite e ricaricati
+alla richiesta successiva della stessa conversazione.
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+EMPTY_PREFIX = hashlib.sha256(b"conversation").hexdigest()
+
+
+def chain_hash(previous: str, role: str, content: str) -> str:
+    """Hash del prefisso esteso con un messaggio"""
+    digest = hashlib.sha256(previous.encode("ascii"))
+    digest.update(b"\x00" + role.encode("utf-8") + b"\x00" + content.encode("utf-8"))
+    return digest.hexdigest()
+
+
+@dataclass
+class ConversationState:
+    """Cronologia elaborata di una conversazione fino a un certo messaggio"""
+    prefix_hash: str = EMPTY_PREFIX
+    processed: int = 0
+    history: List[str] = field(default_factory=list)
+    summary: str = ""
+    summarized: int = 0  # righe di history già incluse nel riassunto
+    last_node_ids: List[str] = field(default_factory=list)
+    updated_at: float = field(default_factory=time.time)
+
+    def copy(self) -> "ConversationState":
+        """Copia indipendente: le conversazioni che divergono non condividono le liste"""
+        return ConversationState(
+            prefix_hash=self.prefix_hash,
+            processed=self.processed,
+            history=list(self.history),
+            summary=self.summary,
+            summarized=self.summarized,
+            last_node_ids=list(self.last_node_ids),
+            updated_at=self.updated_at,
+        )
+
+    def extend(self, messages: Sequence[Tuple[str, str]], format_message: Callable[[str, str], Optional[str]]):
+        """Elabora i messaggi (role, content) successivi a quelli già visti"""
+        for role, content in messages:
+            self.prefix_hash = chain_hash(self.prefix_hash, role, content)
+            line = format_message(role, content)
+            if line is not None:
+                self.history.append(line)
+        self.processed += len(messages)
+        self.updated_at = time.time()
+
+    def context(self, window: int, pending: bool = False) -> str:
+        """
+        Contesto per la sintesi: riassunto dei turni precedenti + ultime
+        window righe. Con pending=True anche le righe uscite dalla finestra
+        ma non ancora nel riassunto (aggiornato in background), che
+        altrimenti sparirebbero finché il riassunto non arriva.
+        """
+        start = len(self.history) - window if window > 0 else len(self.history)
+        if pending:
+            start = min(start, self.summarized)
+        recent = self.history[max(0, start):]
+        if self.summary:
+            return f"Riassunto della conversazione precedente: {self.summary}\n" + "\n".join(recent)
+        return "\n".join(recent)
+
+    def recent(self, window: int) -> str:
+        """
+        Ultime window righe, senza riassunto: chiave di contesto per la cache
+        delle risposte (il riassunto è testo del LLM, diverso a ogni
+        rigenerazione, e quando arriva non deve invalidare le risposte)
+        """
+        return "\n".join(self.history[-window:]) if window > 0 else ""
+
+    def pending_summary(self, window: int) -> List[str]:
+        """Righe uscite dalla finestra e non ancora incluse nel riassunto"""
+        return self.history[self.summarized:max(self.summarized, len(self.history) - window)]
+
+
+class ConversationStore:
+    """
+    Stati delle conversazioni in memoria (LRU + TTL), con spill opzionale
+    su SQLite.
+
+    Args:
+        max_entries: Stati mantenuti in memoria
+        ttl_seconds: Inattività dopo la quale uno stato viene scartato
+        db_path: Database SQLite per gli stati espulsi dalla memoria (None = solo memoria)
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 24 * 3600, db_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, ConversationState]" = OrderedDict()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.spilled = 0
+
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            conn = self._conn()
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    key TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations (updated_at)")
+            conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        """Una connessione per thread (le connessioni sqlite3 non sono condivisibili)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ------------------------------------------------------------------
+    # API pubblica
+    # ------------------------------------------------------------------
+
+    def resume(self, messages: Sequence[Tuple[str, str]], format_message: Callable[[str, str], Optional[str]],
+               conversation_id: Optional[str] = None) -> ConversationState:
+        """
+        Stato della conversazione dopo i messaggi indicati (tutti tranne la
+        domanda corrente): riprende lo stato salvato ed elabora solo i
+        messaggi nuovi, o ricostruisce da zero se il prefisso non coincide.
+        """
+        state = None
+        if conversation_id:
+            state = self._verified(self.get(f"id:{conversation_id}"), messages)
+        if state is None:
+            # Prefissi dal più lungo: lo stato salvato dopo l'ultimo turno copre tutti i messaggi
+            prefixes = [EMPTY_PREFIX]
+            for role, content in messages:
+                prefixes.append(chain_hash(prefixes[-1], role, content))
+            for processed in range(len(messages), 0, -1):
+                candidate = self.get(f"prefix:{prefixes[processed]}", spilled=processed == len(messages))
+                if candidate is not None and candidate.processed == processed:
+                    state = candidate
+                    break
+
+        if state is None:
+            if messages:
+                self.misses += 1
+            state = ConversationState()
+        else:
+            self.hits += 1
+            state = state.copy()
+        state.extend(messages[state.processed:], format_message)
+        return state
+
+    def save(self, state: ConversationState, conversation_id: Optional[str] = None):
+        """Salva lo stato con chiave hash del prefisso (e id della conversazione, se noto)"""
+        self.put(f"prefix:{state.prefix_hash}", state)
+        if conversation_id:
+            self.put(f"id:{conversation_id}", state)
+
+    def get(self, key: str, spilled: bool = True) -> Optional[ConversationState]:
+        with self._lock:
+            state = self._entries.get(key)
+            if state is not None:
+                if time.time() - state.updated_at > self.ttl_seconds:
+                    del self._entries[key]
+                    state = None
+                else:
+                    self._entries.move_to_end(key)
+                    return state
+        if spilled and self.db_path:
+            state = self._load(key)
+            if state is not None:
+                self.put(key, state)
+                return state
+        return None
+
+    def put(self, key: str, state: ConversationState):
+        evicted = []
+        with self._lock:
+            self._entries[key] = state
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False))
+        if evicted and self.db_path:
+            self._spill(evicted)
+
+    def close(self):
+        """Salva in SQLite tutti gli stati in memoria (alla chiusura del server)"""
+        if not self.db_path:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+        self._spill(entries)
+        conn = self._conn()
+        conn.execute("DELETE FROM conversations WHERE updated_at < ?", (time.time() - self.ttl_seconds,))
+        conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "spilled": self.spilled,
+            "persistent": bool(self.db_path),
+        }
+
+    # ------------------------------------------------------------------
+    # Interni
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _verified(state: Optional[ConversationState], messages: Sequence[Tuple[str, str]]) -> Optional[ConversationState]:
+        """Lo stato di una conversazione con id vale solo se i messaggi ne sono un'estensione"""
+        if state is None or state.processed > len(messages):
+            return None
+        prefix = EMPTY_PREFIX
+        for role, content in messages[:state.processed]:
+            prefix = chain_hash(prefix, role, content)
+        return state if prefix == state.prefix_hash else None
+
+    def _spill(self, entries: List[Tuple[str, ConversationState]]):
+        rows = [(key, json.dumps(asdict(state), ensure_ascii=False), state.updated_at) for key, state in entries]
+        conn = self._conn()
+        conn.executemany("INSERT OR REPLACE INTO conversations (key, state, updated_at) VALUES (?, ?, ?)", rows)
+        conn.commit()
+        self.spilled += len(rows)
+
+    def _load(self, key: str) -> Optional[ConversationState]:
+        row = self._conn().execute("SELECT state, updated_at FROM conversations WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl_seconds:
+            return None
+        return ConversationState(**json.loads(row[0]))
@@ -0,0 +1,297 @@
+"""
+Document Parser - Estrazione del testo in un pool di processi
+=============================================================
+SimpleDirectoryReader(...).load_data() legge PDF e DOCX uno dopo l'altro
+nel processo chiamante: un solo core, e un PDF patologico di 800 pagine
+blocca l'intera reindicizzazione.
+
+DocumentParser distribuisce i file su un pool di processi (uno per core):
+- ogni file ha un timeout e un limite di memoria propri (nel processo
+  worker: SIGALRM e RLIMIT_AS, dove il sistema operativo li supporta)
+- un file che fallisce (eccezione, timeout, memoria, worker terminato)
+  viene riportato come errore di quel file, senza interrompere gli altri
+- i risultati vengono restituiti appena ogni file è pronto, così il
+  chunking procede mentre gli altri file sono ancora in lettura
+
+    parser = DocumentParser(workers=4, timeout=120)
+    for result in parser.parse(paths):
+        if result.ok:
+            nodes += splitter.get_nodes_from_documents(result.documents)
+
+Con una ParsedTextCache (vedi parsed_cache.py) i file già letti in
+passato, con lo stesso contenuto, non vengono riletti: si paga solo
+l'hash del file.
+
+I worker sono avviati con "spawn": il server ha già thread attivi
+(uvicorn, executor), e un fork in quello stato non è sicuro.
+"""
+
+import os
+import time
+import signal
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows: nessun limite di memoria per processo
+    resource = None
+
+# Margine oltre il timeout prima che il processo principale consideri
+# bloccato un worker (il timeout interno non ha effetto dentro codice C)
+HARD_TIMEOUT_GRACE = 30.0
+
+
+@dataclass
+class ParseResult:
+    """Esito della lettura di un file"""
+    path: Path
+    documents: List[Any] = field(default_factory=list)
+    error: Optional[str] = None
+    seconds: float = 0.0
+    sha256: Optional[str] = None
+    cached: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class ParseStats:
+    """Statistiche di un'esecuzione del parser"""
+    files: int = 0
+    parsed: int = 0
+    cached: int = 0
+    failed: int = 0
+    documents: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: Optional[float] = None
+    failures: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def files_per_second(self) -> float:
+        return (self.parsed + self.failed) / self.elapsed if self.elapsed > 0 else 0.0
+
+
+# ============================================================================
+# WORKER
+# ============================================================================
+
+def _init_worker(memory_limit_mb: int):
+    """Limite di memoria del processo worker (spazio di indirizzamento) e import dei reader"""
+    if resource is not None and memory_limit_mb > 0:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    # Import qui, fuori dal timeout del primo file letto dal worker
+    from llama_index.core import SimpleDirectoryReader  # noqa: F401
+
+
+def describe_error(e: BaseException) -> str:
+    """Messaggio dell'errore di lettura (SimpleDirectoryReader avvolge la causa reale)"""
+    cause = e.__cause__ or e
+    return f"{type(cause).__name__}: {cause}"
+
+
+def _on_timeout(signum, frame):
+    raise TimeoutError("tempo massimo di lettura superato")
+
+
+def read_file(path: str) -> List[Any]:
+    """Legge un file con SimpleDirectoryReader (stessi metadati e id della lettura in blocco)"""
+    from llama_index.core import SimpleDirectoryReader
+
+    # raise_on_error: senza, un file illeggibile verrebbe saltato in silenzio (0 documenti)
+    return SimpleDirectoryReader(input_files=[path], filename_as_id=True, raise_on_error=True).load_data()
+
+
+def _parse_in_worker(path: str, timeout: float) -> List[Any]:
+    alarm = hasattr(signal, "setitimer") and timeout > 0
+    if alarm:
+        signal.signal(signal.SIGALRM, _on_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return read_file(path)
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+# ============================================================================
+# PARSER
+# ============================================================================
+
+class DocumentParser:
+    """
+    Lettura dei documenti in parallelo, con isolamento per file.
+
+    Args:
+        workers: Processi del pool (None = numero di CPU, 0 = lettura nel processo chiamante)
+        timeout: Secondi massimi per file (0 = nessun limite)
+        memory_limit_mb: Memoria massima per worker in MB (0 = nessun limite)
+        cache: ParsedTextCache per non rileggere i file già estratti (opzionale)
+    """
+
+    def __init__(self, workers: Optional[int] = None, timeout: float = 300.0, memory_limit_mb: int = 4096,
+                 cache=None):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.cache = cache
+        self.last_stats: Optional[ParseStats] = None
+
+    def parse(self, paths: Iterable[Path]) -> Iterator[ParseResult]:
+        """Legge i file e restituisce un ParseResult per ciascuno, in ordine di completamento"""
+        paths = [Path(p) for p in paths]
+        stats = self.last_stats = ParseStats(files=len(paths))
+        try:
+            for result in self._parse_cached(paths):
+                if result.ok:
+                    stats.parsed += 1
+                    stats.cached += result.cached
+                    stats.documents += len(result.documents)
+                else:
+                    stats.failed += 1
+                    stats.failures[str(result.path)] = result.error
+                    print(f"   ❌ {result.path}: {result.error}")
+                yield result
+        finally:
+            stats.finished_at = time.monotonic()
+        if len(paths) > 1:
+            print(f"📑 Lettura completata: {stats.parsed}/{stats.files} file in {stats.elapsed:.1f}s "
+                  f"({stats.files_per_second:.1f} file/s, {stats.cached} dalla cache, {stats.failed} errori)")
+
+    def _parse_cached(self, paths: List[Path]) -> Iterator[ParseResult]:
+        """Prima i file presenti in cache (per hash del contenuto), poi la lettura degli altri"""
+        hashes: Dict[Path, str] = {}
+        if self.cache is not None:
+            from index_manifest import file_sha256
+
+            missing = []
+            for path in paths:
+                started = time.monotonic()
+                try:
+                    hashes[path] = file_sha256(path)
+                except OSError as e:
+                    yield ParseResult(path, error=describe_error(e))
+                    continue
+                documents = self.cache.get(hashes[path], path)
+                if documents is None:
+                    missing.append(path)
+                else:
+                    yield ParseResult(path, documents, seconds=time.monotonic() - started,
+                                      sha256=hashes[path], cached=True)
+            paths = missing
+
+        results = self._parse_inline(paths) if self.workers <= 0 or not paths else self._parse_pool(paths)
+        for result in results:
+            if result.ok and self.cache is not None:
+                result.sha256 = hashes[result.path]
+                if result.documents:
+                    self.cache.put(result.sha256, result.path, result.documents)
+            yield result
+
+    def _parse_inline(self, paths: List[Path]) -> Iterator[ParseResult]:
+        for path in paths:
+            started = time.monotonic()
+            try:
+                documents = read_file(str(path))
+            except Exception as e:
+                yield ParseResult(path, error=describe_error(e), seconds=time.monotonic() - started)
+            else:
+                yield ParseResult(path, documents, seconds=time.monotonic() - started)
+
+    def _create_pool(self, workers: int) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.memory_limit_mb,),
+        )
+
+    def _parse_pool(self, paths: List[Path]) -> Iterator[ParseResult]:
+        workers = min(self.workers, len(paths))
+        pending = list(reversed(paths))
+        retry: List[Path] = []  # file interrotti da un worker morto, riletti da soli
+        attempts: Dict[Path, int] = {}
+        running: Dict[Any, tuple] = {}  # future → (path, avvio)
+        pool = self._create_pool(workers)
+
+        def submit(path: Path):
+            attempts[path] = attempts.get(path, 0) + 1
+            running[pool.submit(_parse_in_worker, str(path), self.timeout)] = (path, time.monotonic())
+
+        def fill():
+            # Al più un file per worker in volo: l'ora di invio è l'ora di inizio della lettura.
+            # I file da ritentare vanno da soli: se il worker muore ancora, il colpevole è certo
+            if retry:
+                if not running:
+                    submit(retry.pop())
+                return
+            while pending and len(running) < workers:
+                submit(pending.pop())
+
+        try:
+            fill()
+            while running:
+                done, _ = wait(running, timeout=1.0, return_when=FIRST_COMPLETED)
+                broken = []
+                for future in done:
+                    path, started = running.pop(future)
+                    seconds = time.monotonic() - started
+                    try:
+                        result = ParseResult(path, future.result(), seconds=seconds)
+                    except BrokenProcessPool:
+                        broken.append(path)
+                        continue
+                    except MemoryError:
+                        result = ParseResult(path, error=f"memoria oltre {self.memory_limit_mb} MB", seconds=seconds)
+                    except Exception as e:
+                        result = ParseResult(path, error=describe_error(e), seconds=seconds)
+                    yield result
+
+                hung = []
+                if self.timeout > 0:
+                    now = time.monotonic()
+                    hung = [f for f, (_, started) in running.items()
+                            if now - started > self.timeout + HARD_TIMEOUT_GRACE]
+                if broken or hung:
+                    # Un worker è morto (es. ucciso dal sistema) o non risponde: nuovo pool.
+                    # I file interrotti vengono ritentati una volta, da soli; quelli bloccati no.
+                    for future in hung:
+                        path, started = running.pop(future)
+                        yield ParseResult(path, error=f"timeout ({self.timeout:.0f}s)",
+                                          seconds=time.monotonic() - started)
+                    interrupted = broken + [path for path, _ in running.values()]
+                    running.clear()
+                    self._terminate(pool)
+                    pool = self._create_pool(workers)
+                    for path in interrupted:
+                        if attempts[path] >= 2:
+                            yield ParseResult(path, error="worker terminato durante la lettura")
+                        else:
+                            retry.append(path)
+
+                fill()
+        finally:
+            if running:
+                self._terminate(pool)
+            else:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def _terminate(pool: ProcessPoolExecutor):
+        """Chiude il pool senza attendere i worker bloccati"""
+        processes = list(getattr(pool, "_processes", {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
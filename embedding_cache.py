@@ -0,0 +1,241 @@
+"""
+Embedding Cache - Cache persistente degli embedding
+====================================================
+Cache su disco (SQLite) degli embedding, con chiave (modello di embedding,
+hash del testo normalizzato). Sopravvive ai riavvii ed è condivisa tra più
+processi uvicorn: SQLite in modalità WAL gestisce letture concorrenti e
+scritture serializzate tra processi.
+
+CachedEmbedding avvolge l'embedding model configurato in Settings, così il
+retriever (embedding di query) e l'indicizzazione dei chunk (embedding di
+testo) consultano la cache prima di chiamare l'API di embedding: un chunk
+con lo stesso testo di uno già embeddato (pagina invariata di un manuale
+modificato, indice ricostruito) non costa una nuova chiamata.
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from typing import Any, List, Optional
+
+import numpy as np
+from pydantic import Field, PrivateAttr
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+
+# Ogni quanti inserimenti controllare il limite di dimensione
+EVICTION_CHECK_INTERVAL = 100
+# Aggiorna last_used al massimo una volta ogni N secondi per voce (meno scritture concorrenti)
+TOUCH_INTERVAL = 60.0
+
+
+def normalize_for_embedding(text: str) -> str:
+    """Normalizzazione unicode e degli spazi (non cambia maiuscole/minuscole)"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(normalize_for_embedding(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Cache SQLite degli embedding, sicura tra thread e processi.
+
+    Args:
+        db_path: Percorso del database SQLite
+        max_entries: Numero massimo di embedding; oltre, vengono eliminati i meno usati
+    """
+
+    def __init__(self, db_path: str, max_entries: int = 200_000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        """Una connessione per thread (le connessioni sqlite3 non sono condivisibili)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        return self.get_many(model, [text])[0]
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """Embedding in cache per ogni testo (None se assente)"""
+        if not texts:
+            return []
+        keys = [text_key(t) for t in texts]
+        conn = self._conn()
+        found = {}
+        # Limite di parametri SQLite: interroga a blocchi
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), 500):
+            block = unique_keys[start:start + 500]
+            placeholders = ",".join("?" * len(block))
+            rows = conn.execute(
+                f"SELECT text_hash, vector, last_used FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                [model, *block],
+            ).fetchall()
+            for text_hash, vector, last_used in rows:
+                found[text_hash] = (vector, last_used)
+
+        now = time.time()
+        stale = [k for k, (_, last_used) in found.items() if now - last_used > TOUCH_INTERVAL]
+        if stale:
+            try:
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, k) for k in stale],
+                )
+                conn.commit()
+            except sqlite3.OperationalError:
+                # Database occupato da un altro processo: l'aggiornamento LRU può attendere
+                conn.rollback()
+
+        results = []
+        for k in keys:
+            if k in found:
+                self.hits += 1
+                results.append(np.frombuffer(found[k][0], dtype=np.float32).tolist())
+            else:
+                self.misses += 1
+                results.append(None)
+        return results
+
+    def put(self, model: str, text: str, embedding: List[float]):
+        self.put_many(model, [text], [embedding])
+
+    def put_many(self, model: str, texts: List[str], embeddings: List[List[float]]):
+        now = time.time()
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32)
+            rows.append((model, text_key(text), int(vector.shape[0]), vector.tobytes(), now))
+        conn = self._conn()
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        conn.commit()
+
+        self._puts += len(rows)
+        if self._puts >= EVICTION_CHECK_INTERVAL:
+            self._puts = 0
+            self.evict()
+
+    def evict(self):
+        """Elimina gli embedding meno usati oltre max_entries"""
+        conn = self._conn()
+        (count,) = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN "
+                "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            conn.commit()
+
+    def stats(self) -> dict:
+        (count,) = self._conn().execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Embedding model che consulta EmbeddingCache prima di chiamare il modello reale"""
+
+    embed_model: BaseEmbedding = Field(description="Embedding model reale")
+    _cache: Any = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, cache: EmbeddingCache, **kwargs: Any):
+        super().__init__(
+            embed_model=embed_model,
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            **kwargs,
+        )
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    @property
+    def query_cache_model(self) -> str:
+        # Gli embedding di query (RETRIEVAL_QUERY) differiscono da quelli dei documenti
+        return f"{self.model_name}#query"
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        cached = self._cache.get(self.query_cache_model, query)
+        if cached is not None:
+            return cached
+        embedding = self.embed_model.get_query_embedding(query)
+        self._cache.put(self.query_cache_model, query, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        cached = self._cache.get(self.query_cache_model, query)
+        if cached is not None:
+            return cached
+        embedding = await self.embed_model.aget_query_embedding(query)
+        self._cache.put(self.query_cache_model, query, embedding)
+        return embedding
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        cached = self._cache.get_many(self.model_name, texts)
+        missing = list(dict.fromkeys(t for t, vector in zip(texts, cached) if vector is None))
+        computed = {}
+        if missing:
+            computed = dict(zip(missing, self.embed_model.get_text_embedding_batch(missing)))
+            self._cache.put_many(self.model_name, missing, [computed[t] for t in missing])
+        return [vector if vector is not None else computed[t] for t, vector in zip(texts, cached)]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        cached = self._cache.get_many(self.model_name, texts)
+        missing = list(dict.fromkeys(t for t, vector in zip(texts, cached) if vector is None))
+        computed = {}
+        if missing:
+            computed = dict(zip(missing, await self.embed_model.aget_text_embedding_batch(missing)))
+            self._cache.put_many(self.model_name, missing, [computed[t] for t in missing])
+        return [vector if vector is not None else computed[t] for t, vector in zip(texts, cached)]
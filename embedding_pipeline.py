@@ -0,0 +1,463 @@
+"""
+Embedding Pipeline - Embedding concorrente dei chunk in ingestione
+===================================================================
+Calcola gli embedding dei chunk a batch di dimensione configurabile, con N
+richieste in volo in parallelo, limitate da due token bucket (richieste al
+minuto e token al minuto). Gli errori di quota (429 / ResourceExhausted)
+vengono ritentati con backoff esponenziale con jitter; durante
+l'esecuzione viene stampato il throughput (chunk/s). Con una
+EmbeddingCache i testi già embeddati (stesso modello, stesso testo
+normalizzato) non vengono inviati al modello né contati nelle quote.
+
+La funzione di embedding è un callable asincrono (testi → vettori), quindi
+la pipeline si può provare contro un server finto locale:
+
+    python fake_embedding_server.py --port 8001 --error-rate 0.2
+    python embedding_pipeline.py --url http://localhost:8001 --chunks 5000
+
+EmbeddingMicroBatcher serve invece l'endpoint /v1/embeddings: unisce le
+richieste concorrenti arrivate in pochi millisecondi in un'unica chiamata.
+"""
+
+import time
+import random
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional, Sequence
+
+EmbedFn = Callable[[List[str]], Awaitable[List[List[float]]]]
+
+
+# ============================================================================
+# RATE LIMITING
+# ============================================================================
+
+class TokenBucket:
+    """Token bucket asincrono: capacity unità ricaricate linearmente ogni periodo"""
+
+    def __init__(self, capacity: float, period: float = 60.0):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.0):
+        # Una richiesta più grande della capacità attende il bucket pieno
+        amount = min(amount, self.capacity)
+        while True:
+            async with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                wait = (amount - self._tokens) / self.rate
+            # Attesa fuori dal lock: intanto una richiesta più piccola può passare con la ricarica
+            await asyncio.sleep(wait)
+
+
+def estimate_tokens(text: str) -> int:
+    """Stima grossolana dei token (circa 4 caratteri per token)"""
+    return max(1, len(text) // 4)
+
+
+def is_quota_error(exc: BaseException) -> bool:
+    """True per errori di quota / rate limit (HTTP 429, ResourceExhausted)"""
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    if status == 429:
+        return True
+    response = getattr(exc, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    text = f"{type(exc).__name__} {exc}"
+    return any(marker in text for marker in ("429", "ResourceExhausted", "RESOURCE_EXHAUSTED", "quota", "rate limit"))
+
+
+# ============================================================================
+# PIPELINE
+# ============================================================================
+
+@dataclass
+class PipelineStats:
+    """Statistiche di un'esecuzione della pipeline"""
+    chunks: int = 0
+    embedded: int = 0
+    cache_hits: int = 0
+    batches: int = 0
+    retries: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.embedded / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def cache_hit_rate(self) -> float:
+        return self.cache_hits / self.chunks if self.chunks else 0.0
+
+
+class EmbeddingPipeline:
+    """
+    Embedding a batch concorrenti con limiti RPM/TPM e retry su errori di quota.
+
+    Args:
+        embed_fn: Callable asincrono che restituisce un vettore per ogni testo
+        batch_size: Testi per richiesta
+        concurrency: Richieste in volo contemporaneamente
+        requests_per_minute: Limite di richieste al minuto
+        tokens_per_minute: Limite (stimato) di token al minuto
+        max_retries: Tentativi massimi per batch sugli errori di quota
+        base_delay / max_delay: Parametri del backoff esponenziale (secondi)
+        report_interval: Ogni quanti secondi stampare il throughput
+        cache: EmbeddingCache consultata prima del modello (opzionale)
+        cache_model: Nome del modello usato come chiave nella cache
+    """
+
+    def __init__(self, embed_fn: EmbedFn, batch_size: int = 100, concurrency: int = 4,
+                 requests_per_minute: int = 1500, tokens_per_minute: int = 1_000_000,
+                 max_retries: int = 8, base_delay: float = 1.0, max_delay: float = 60.0,
+                 report_interval: float = 5.0, cache=None, cache_model: str = ""):
+        self.embed_fn = embed_fn
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.report_interval = report_interval
+        self.cache = cache
+        self.cache_model = cache_model
+        self.last_stats: Optional[PipelineStats] = None
+        self._bucket_loop = None
+        self._bucket_pair = None
+
+    async def aembed(self, texts: Sequence[str], stats: Optional[PipelineStats] = None) -> List[List[float]]:
+        """
+        Embedding di tutti i testi, nello stesso ordine.
+
+        Con stats, le statistiche si accumulano su più chiamate (ingestione a
+        batch successivi, vedi ingestion.py) e il riepilogo non viene stampato.
+        """
+        own_stats = stats is None
+        if own_stats:
+            stats = PipelineStats(chunks=len(texts))
+        else:
+            stats.chunks += len(texts)
+        self.last_stats = stats
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        if not texts:
+            stats.finished_at = time.monotonic()
+            return []
+
+        pending = list(range(len(texts)))
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get_many, self.cache_model, list(texts))
+            pending = []
+            for i, vector in enumerate(cached):
+                if vector is None:
+                    pending.append(i)
+                else:
+                    results[i] = vector
+            stats.cache_hits += len(texts) - len(pending)
+
+        rpm, tpm = self._buckets()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_batch(indices: List[int]):
+            batch = [texts[i] for i in indices]
+            tokens = sum(estimate_tokens(t) for t in batch)
+            async with semaphore:
+                for attempt in range(self.max_retries + 1):
+                    await rpm.acquire(1)
+                    await tpm.acquire(tokens)
+                    try:
+                        vectors = await self.embed_fn(batch)
+                        break
+                    except Exception as e:
+                        if not is_quota_error(e) or attempt == self.max_retries:
+                            raise
+                        stats.retries += 1
+                        # Backoff esponenziale con "full jitter"
+                        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                        await asyncio.sleep(delay)
+            if len(vectors) != len(batch):
+                raise ValueError(f"Embedding restituiti {len(vectors)} per {len(batch)} testi")
+            for i, vector in zip(indices, vectors):
+                results[i] = vector
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.put_many, self.cache_model, batch, vectors)
+            stats.embedded += len(batch)
+            stats.batches += 1
+
+        reporter = asyncio.create_task(self._report(stats)) if own_stats else None
+        try:
+            await asyncio.gather(*(run_batch(pending[start:start + self.batch_size])
+                                   for start in range(0, len(pending), self.batch_size)))
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            stats.finished_at = time.monotonic()
+
+        if not own_stats:
+            return results
+        print(f"🧮 Embedding completati: {stats.embedded} chunk in {stats.elapsed:.1f}s "
+              f"({stats.chunks_per_second:.1f} chunk/s, {stats.batches} batch, {stats.retries} retry"
+              f"{f', {stats.cache_hits} dalla cache' if self.cache is not None else ''})")
+        return results
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        """Versione sincrona di aembed (utilizzabile anche dentro un event loop attivo)"""
+        return run_coroutine_sync(self.aembed(texts))
+
+    def embed_nodes(self, nodes) -> int:
+        """
+        Calcola l'embedding dei nodi che ne sono privi (in place).
+        I nodi con embedding vengono poi inseriti nell'indice senza
+        ulteriori chiamate al modello.
+
+        Returns:
+            Numero di nodi embeddati
+        """
+        return run_coroutine_sync(self.aembed_nodes(nodes))
+
+    async def aembed_nodes(self, nodes, stats: Optional[PipelineStats] = None) -> int:
+        """Versione asincrona di embed_nodes (stats: vedi aembed)"""
+        from llama_index.core.schema import MetadataMode
+
+        pending = [node for node in nodes if node.embedding is None]
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in pending]
+        for node, vector in zip(pending, await self.aembed(texts, stats)):
+            node.embedding = vector
+        return len(pending)
+
+    def _buckets(self):
+        """
+        Token bucket RPM/TPM dell'event loop corrente: condivisi tra le
+        chiamate nello stesso loop (i batch successivi di un'ingestione
+        restano entro le quote), ricreati per un nuovo loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._bucket_loop is not loop:
+            self._bucket_loop = loop
+            self._bucket_pair = (TokenBucket(self.requests_per_minute), TokenBucket(self.tokens_per_minute))
+        return self._bucket_pair
+
+    async def _report(self, stats: PipelineStats):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            print(f"   🧮 {stats.embedded + stats.cache_hits}/{stats.chunks} chunk "
+                  f"({stats.chunks_per_second:.1f} chunk/s, {stats.retries} retry)")
+
+
+# ============================================================================
+# MICRO-BATCHING (endpoint /v1/embeddings)
+# ============================================================================
+
+class EmbeddingMicroBatcher:
+    """
+    Raggruppa richieste di embedding concorrenti in un'unica chiamata al modello.
+
+    La prima richiesta apre una finestra di max_wait secondi; tutte quelle
+    che arrivano nel frattempo (o finché si raggiungono max_batch_size
+    testi) vengono unite, deduplicate, cercate nella cache persistente e
+    inviate al modello in un solo batch. I vettori sono poi restituiti a
+    ogni richiesta nel proprio ordine.
+
+    Args:
+        embed_fn: Callable asincrono testi → vettori
+        max_batch_size: Testi massimi per chiamata al modello
+        max_wait: Finestra di raccolta in secondi
+        concurrency: Chiamate al modello in volo contemporaneamente
+        requests_per_minute / tokens_per_minute: Limiti di quota (condivisi tra i batch)
+        cache: EmbeddingCache opzionale
+        cache_model: Nome del modello usato come chiave nella cache
+    """
+
+    def __init__(self, embed_fn: EmbedFn, max_batch_size: int = 100, max_wait: float = 0.005,
+                 concurrency: int = 4, requests_per_minute: int = 1500, tokens_per_minute: int = 1_000_000,
+                 max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 30.0,
+                 cache=None, cache_model: str = ""):
+        self.embed_fn = embed_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cache = cache
+        self.cache_model = cache_model
+        self.stats = {"requests": 0, "texts": 0, "batches": 0, "model_calls": 0, "cache_hits": 0}
+
+        self._pending: List[tuple] = []
+        self._pending_texts = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        # Creati al primo uso: appartengono all'event loop del server
+        self._rpm: Optional[TokenBucket] = None
+        self._tpm: Optional[TokenBucket] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        """Embedding dei testi di una richiesta (attende il batch in cui viene raccolta)"""
+        if not texts:
+            return []
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((list(texts), future))
+        self._pending_texts += len(texts)
+        self.stats["requests"] += 1
+        self.stats["texts"] += len(texts)
+
+        if self._pending_texts >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending, self._pending_texts = self._pending, [], 0
+        if pending:
+            task = asyncio.ensure_future(self._run_batch(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, pending: List[tuple]):
+        self.stats["batches"] += 1
+        try:
+            unique = list(dict.fromkeys(text for texts, _ in pending for text in texts))
+            vectors = await self._embed_unique(unique)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for texts, future in pending:
+            # Richieste annullate (client disconnesso) vengono ignorate
+            if not future.done():
+                future.set_result([vectors[text] for text in texts])
+
+    async def _embed_unique(self, texts: List[str]) -> dict:
+        vectors = {}
+        missing = texts
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get_many, self.cache_model, texts)
+            missing = []
+            for text, vector in zip(texts, cached):
+                if vector is None:
+                    missing.append(text)
+                else:
+                    vectors[text] = vector
+            self.stats["cache_hits"] += len(texts) - len(missing)
+
+        if missing:
+            blocks = [missing[i:i + self.max_batch_size] for i in range(0, len(missing), self.max_batch_size)]
+            results = await asyncio.gather(*(self._call_model(block) for block in blocks))
+            computed = [vector for block_vectors in results for vector in block_vectors]
+            vectors.update(zip(missing, computed))
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.put_many, self.cache_model, missing, computed)
+        return vectors
+
+    async def _call_model(self, texts: List[str]) -> List[List[float]]:
+        if self._semaphore is None:
+            self._rpm = TokenBucket(self.requests_per_minute)
+            self._tpm = TokenBucket(self.tokens_per_minute)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        tokens = sum(estimate_tokens(t) for t in texts)
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._rpm.acquire(1)
+                await self._tpm.acquire(tokens)
+                try:
+                    self.stats["model_calls"] += 1
+                    vectors = await self.embed_fn(texts)
+                    break
+                except Exception as e:
+                    if not is_quota_error(e) or attempt == self.max_retries:
+                        raise
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                    await asyncio.sleep(delay)
+        if len(vectors) != len(texts):
+            raise ValueError(f"Embedding restituiti {len(vectors)} per {len(texts)} testi")
+        return vectors
+
+
+def run_coroutine_sync(coro):
+    """Esegue una coroutine da codice sincrono, anche se un event loop è già attivo nel thread"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+
+# ============================================================================
+# FUNZIONI DI EMBEDDING
+# ============================================================================
+
+def llama_index_embed_fn(embed_model) -> EmbedFn:
+    """Adatta un embedding model LlamaIndex (es. GoogleGenAIEmbedding) alla pipeline"""
+    async def embed(texts: List[str]) -> List[List[float]]:
+        return await embed_model.aget_text_embedding_batch(texts)
+    return embed
+
+
+def http_embed_fn(base_url: str, model: str = "fake-embedding", timeout: float = 60.0) -> EmbedFn:
+    """Client per un endpoint /v1/embeddings OpenAI-compatible (es. fake_embedding_server.py)"""
+    import httpx
+
+    async def embed(texts: List[str]) -> List[List[float]]:
+        async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as client:
+            response = await client.post("/v1/embeddings", json={"model": model, "input": texts})
+            response.raise_for_status()
+            data = sorted(response.json()["data"], key=lambda item: item["index"])
+            return [item["embedding"] for item in data]
+
+    return embed
+
+
+# ============================================================================
+# MAIN (prova contro un server di embedding locale)
+# ============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prova la pipeline di embedding contro un server locale")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rpm", type=int, default=600)
+    parser.add_argument("--tpm", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    texts = [f"Chunk di prova numero {i}: " + "testo " * random.randint(20, 120) for i in range(args.chunks)]
+    pipeline = EmbeddingPipeline(
+        http_embed_fn(args.url),
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        report_interval=1.0,
+    )
+    vectors = pipeline.embed(texts)
+    assert len(vectors) == len(texts) and all(v is not None for v in vectors)
+    print(f"✅ {len(vectors)} embedding ricevuti")
@@ -0,0 +1,151 @@
+"""
+Engine State - Generazioni del motore RAG
+==========================================
+Stato del motore RAG (indice, query engine, LLM) raggruppato in
+"generazioni" immutabili. Una reindicizzazione costruisce una nuova
+generazione in background e la sostituisce alla corrente con un unico
+scambio atomico; le richieste in corso continuano a usare la generazione
+con cui sono partite, tracciata con un contatore di riferimenti, finché
+non terminano (drain).
+
+LoadProgress descrive il caricamento iniziale, eseguito in background
+mentre il server accetta già connessioni (/livez, /readyz).
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+
+@dataclass
+class EngineGeneration:
+    """Una generazione del motore RAG: non viene mai modificata dopo la creazione"""
+    generation: int
+    index: Any = None
+    query_engine: Any = None
+    llm: Any = None
+    persist_dir: Optional[str] = None
+    lexical_index: Any = None
+    deduplicator: Any = None
+    _refs: int = field(default=0, repr=False)
+    _cond: threading.Condition = field(default_factory=threading.Condition, repr=False)
+
+    @property
+    def active_requests(self) -> int:
+        return self._refs
+
+    def _acquire(self):
+        with self._cond:
+            self._refs += 1
+
+    def _release(self):
+        with self._cond:
+            self._refs -= 1
+            if self._refs == 0:
+                self._cond.notify_all()
+
+    def wait_drained(self, timeout: Optional[float] = None) -> bool:
+        """Attende che tutte le richieste su questa generazione siano terminate"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._refs == 0, timeout=timeout)
+
+
+class EngineHolder:
+    """Contenitore della generazione corrente, con scambio atomico"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = EngineGeneration(generation=0)
+
+    @property
+    def current(self) -> EngineGeneration:
+        return self._current
+
+    @property
+    def generation(self) -> int:
+        return self._current.generation
+
+    def next_generation(self) -> int:
+        return self._current.generation + 1
+
+    @contextmanager
+    def lease(self):
+        """
+        Acquisisce la generazione corrente per la durata di una richiesta.
+        Uno swap concorrente non influenza chi ha già acquisito il lease.
+        """
+        with self._lock:
+            gen = self._current
+            gen._acquire()
+        try:
+            yield gen
+        finally:
+            gen._release()
+
+    def swap(self, new_generation: EngineGeneration) -> EngineGeneration:
+        """Sostituisce la generazione corrente e restituisce la precedente"""
+        with self._lock:
+            old, self._current = self._current, new_generation
+        return old
+
+
+class LoadProgress:
+    """
+    Avanzamento del caricamento del motore: fase corrente, durata delle
+    fasi concluse ed eventuale errore. Il parser dei documenti e la
+    pipeline di embedding in uso (se presenti) forniscono l'avanzamento dei
+    file e dei chunk durante la sincronizzazione.
+    """
+
+    def __init__(self):
+        self.phase = "starting"
+        self.detail = ""
+        self.error: Optional[str] = None
+        self.pipeline: Any = None
+        self.parser: Any = None
+        self._started = time.monotonic()
+        self._phase_started = self._started
+        self._phases: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.phase == "ready"
+
+    @property
+    def finished(self) -> bool:
+        return self.phase in ("ready", "failed")
+
+    def set_phase(self, phase: str, detail: str = ""):
+        with self._lock:
+            now = time.monotonic()
+            self._phases.append((self.phase, now - self._phase_started))
+            self.phase, self.detail, self._phase_started = phase, detail, now
+            if phase in ("ready", "failed"):
+                self.pipeline = self.parser = None
+
+    def fail(self, error: BaseException):
+        self.error = f"{type(error).__name__}: {error}"
+        self.set_phase("failed")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            data = {
+                "phase": self.phase,
+                "detail": self.detail,
+                "elapsed_seconds": round(now - self._started, 2),
+                "phase_seconds": round(now - self._phase_started, 2),
+                "completed_phases": {name: round(duration, 2) for name, duration in self._phases},
+            }
+            stats = getattr(self.pipeline, "last_stats", None)
+            parse_stats = getattr(self.parser, "last_stats", None)
+        if parse_stats is not None:
+            data["parsing"] = {"parsed": parse_stats.parsed, "failed": parse_stats.failed, "files": parse_stats.files}
+        if stats is not None:
+            data["embedding"] = {"embedded": stats.embedded, "chunks": stats.chunks}
+        if self.error:
+            data["error"] = self.error
+        return data
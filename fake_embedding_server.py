@@ -0,0 +1,88 @@
+"""
+Fake Embedding Server - Server di embedding finto per i test
+=============================================================
+Endpoint /v1/embeddings OpenAI-compatible che restituisce vettori
+deterministici (derivati dall'hash del testo), con latenza e percentuale di
+errori 429 configurabili. Serve a provare embedding_pipeline.py senza
+consumare quota Gemini.
+
+Per eseguire:
+    python fake_embedding_server.py --port 8001 --latency 0.2 --error-rate 0.1
+"""
+
+import random
+import asyncio
+import hashlib
+import argparse
+from typing import List, Union
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+DIMENSIONS = 768
+LATENCY = 0.1
+ERROR_RATE = 0.0
+
+app = FastAPI(title="Fake Embedding Server")
+stats = {"requests": 0, "texts": 0, "rate_limited": 0}
+
+
+class EmbeddingRequest(BaseModel):
+    model: str = "fake-embedding"
+    input: Union[str, List[str]]
+
+
+def fake_vector(text: str) -> List[float]:
+    """Vettore deterministico e normalizzato derivato dal testo"""
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    vector = [rng.gauss(0, 1) for _ in range(DIMENSIONS)]
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector]
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: EmbeddingRequest):
+    stats["requests"] += 1
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    await asyncio.sleep(LATENCY)
+
+    if random.random() < ERROR_RATE:
+        stats["rate_limited"] += 1
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"message": "Quota exceeded (fake)", "code": 429}},
+            headers={"Retry-After": "1"},
+        )
+
+    stats["texts"] += len(texts)
+    return {
+        "object": "list",
+        "model": request.model,
+        "data": [
+            {"object": "embedding", "index": i, "embedding": fake_vector(text)}
+            for i, text in enumerate(texts)
+        ],
+        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Server di embedding finto per i test")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="Secondi di latenza per richiesta")
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE, help="Frazione di richieste con 429")
+    parser.add_argument("--dimensions", type=int, default=DIMENSIONS)
+    args = parser.parse_args()
+
+    LATENCY, ERROR_RATE, DIMENSIONS = args.latency, args.error_rate, args.dimensions
+    print(f"\n🧪 Fake Embedding Server su http://localhost:{args.port} "
+          f"(latenza {LATENCY}s, errori 429: {ERROR_RATE:.0%})\n")
+    uvicorn.run(app, host="0.0.0.0", port=args.port, log_level="warning")
@@ -0,0 +1,473 @@
+"""
+Index Manifest - Reindicizzazione Incrementale
+===============================================
+Tiene traccia dei file già indicizzati (percorso, dimensione, mtime, hash del
+contenuto → id dei documenti e dei nodi LlamaIndex) in un manifest JSON
+salvato accanto all'indice in ./storage.
+
+Alla reindicizzazione vengono letti ed embeddati solo i file nuovi o
+modificati; i nodi dei file eliminati vengono rimossi da docstore e vector
+store. I documenti invariati non vengono mai ri-embeddati.
+
+Una sincronizzazione lunga salva periodicamente indice e manifest
+(checkpoint.json segna la costruzione come non conclusa): dopo un errore
+(quota Gemini) o un crash, la sincronizzazione successiva riparte
+dall'ultimo checkpoint invece che da zero.
+"""
+
+import os
+import json
+import time
+import hashlib
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import List, Dict, Optional, Any, Tuple
+
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+CHECKPOINT_FILENAME = "checkpoint.json"
+SUPPORTED_EXTENSIONS = [".pdf", ".txt", ".docx", ".md"]
+
+
+# ============================================================================
+# MANIFEST
+# ============================================================================
+
+def file_sha256(path: Path, block_size: int = 1024 * 1024) -> str:
+    """Calcola l'hash SHA-256 del contenuto di un file (a blocchi)"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass
+class FileEntry:
+    """Stato di un file al momento dell'indicizzazione"""
+    path: str
+    size: int
+    mtime: float
+    sha256: str
+    doc_ids: List[str] = field(default_factory=list)
+    node_ids: List[str] = field(default_factory=list)
+
+
+@dataclass
+class ManifestDiff:
+    """Differenze tra il manifest e il contenuto attuale della cartella documenti"""
+    added: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+
+class IndexManifest:
+    """Manifest persistente dei file indicizzati, indicizzato per percorso relativo"""
+
+    def __init__(self, entries: Optional[Dict[str, FileEntry]] = None):
+        self.entries: Dict[str, FileEntry] = entries or {}
+
+    @classmethod
+    def load(cls, persist_dir: str) -> Optional["IndexManifest"]:
+        """Carica il manifest da persist_dir (None se assente o illeggibile)"""
+        manifest_path = Path(persist_dir) / MANIFEST_FILENAME
+        if not manifest_path.exists():
+            return None
+        try:
+            data = json.loads(manifest_path.read_text(encoding="utf-8"))
+            entries = {
+                rel_path: FileEntry(**entry)
+                for rel_path, entry in data.get("files", {}).items()
+            }
+            return cls(entries)
+        except (ValueError, TypeError) as e:
+            print(f"⚠️ Manifest non valido ({e}), verrà ricostruito")
+            return None
+
+    def save(self, persist_dir: str):
+        """Salva il manifest in modo atomico (scrittura su file temporaneo + rename)"""
+        os.makedirs(persist_dir, exist_ok=True)
+        manifest_path = Path(persist_dir) / MANIFEST_FILENAME
+        tmp_path = manifest_path.with_suffix(".json.tmp")
+        data = {
+            "version": MANIFEST_VERSION,
+            "files": {rel_path: asdict(entry) for rel_path, entry in sorted(self.entries.items())},
+        }
+        tmp_path.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, manifest_path)
+
+    def diff(self, documents_path: str, files: List[Path]) -> ManifestDiff:
+        """
+        Confronta i file presenti su disco con il manifest.
+
+        Dimensione e mtime invariati → file invariato, senza rileggerlo.
+        Altrimenti si calcola l'hash: se coincide il file è solo stato
+        "toccato" e nel manifest viene aggiornato il solo mtime.
+        """
+        result = ManifestDiff()
+        seen = set()
+
+        for path in files:
+            rel_path = relative_key(documents_path, path)
+            seen.add(rel_path)
+            entry = self.entries.get(rel_path)
+            if entry is None:
+                result.added.append(rel_path)
+                continue
+
+            stat = path.stat()
+            if stat.st_size == entry.size and stat.st_mtime == entry.mtime:
+                result.unchanged.append(rel_path)
+                continue
+
+            if stat.st_size == entry.size and file_sha256(path) == entry.sha256:
+                entry.mtime = stat.st_mtime
+                result.unchanged.append(rel_path)
+            else:
+                result.changed.append(rel_path)
+
+        result.removed = [rel_path for rel_path in self.entries if rel_path not in seen]
+        return result
+
+
+@dataclass
+class BuildCheckpoint:
+    """
+    Sincronizzazione non ancora conclusa in persist_dir.
+
+    Su disco indice e manifest sono quelli dell'ultimo checkpoint; partial
+    elenca i file di cui l'indice salvato può contenere solo una parte dei
+    nodi (file in corso, o completati dopo il manifest salvato): alla
+    ripresa vengono rimossi e reindicizzati per intero.
+    """
+    started_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    files: int = 0  # file indicizzati dall'inizio della costruzione, anche nei tentativi precedenti
+    chunks: int = 0
+    resumes: int = 0
+    resumed_files: int = 0  # avanzamento al momento dell'ultima ripresa
+    resumed_chunks: int = 0
+    partial: Dict[str, Dict[str, List[str]]] = field(default_factory=dict)  # percorso → doc_ids, node_ids
+    partial_done: List[str] = field(default_factory=list)  # parziali già completati (contati in files)
+
+    @staticmethod
+    def exists(persist_dir: str) -> bool:
+        return (Path(persist_dir) / CHECKPOINT_FILENAME).exists()
+
+    @classmethod
+    def load(cls, persist_dir: str) -> Optional["BuildCheckpoint"]:
+        """Checkpoint di una costruzione interrotta in persist_dir (None se non ce n'è)"""
+        path = Path(persist_dir) / CHECKPOINT_FILENAME
+        if not path.exists():
+            return None
+        try:
+            return cls(**json.loads(path.read_text(encoding="utf-8")))
+        except (ValueError, TypeError) as e:
+            print(f"⚠️ Checkpoint non valido ({e}), ripresa dallo stato salvato")
+            return cls()
+
+    def save(self, persist_dir: str):
+        os.makedirs(persist_dir, exist_ok=True)
+        path = Path(persist_dir) / CHECKPOINT_FILENAME
+        tmp_path = path.with_suffix(".json.tmp")
+        self.updated_at = time.time()
+        tmp_path.write_text(json.dumps(asdict(self), ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def clear(persist_dir: str):
+        """Costruzione conclusa (da chiamare dopo il salvataggio finale di indice e manifest)"""
+        try:
+            os.remove(Path(persist_dir) / CHECKPOINT_FILENAME)
+        except FileNotFoundError:
+            pass
+
+    def progress(self) -> Dict[str, Any]:
+        return {"mode": "resumed" if self.resumes else "fresh", "resumes": self.resumes,
+                "resumed_files": self.resumed_files, "resumed_chunks": self.resumed_chunks,
+                "files": self.files, "chunks": self.chunks,
+                "started_at": self.started_at, "updated_at": self.updated_at}
+
+
+def relative_key(documents_path: str, path: Path) -> str:
+    """Chiave del manifest: percorso relativo alla cartella documenti, in formato posix"""
+    return Path(path).resolve().relative_to(Path(documents_path).resolve()).as_posix()
+
+
+def scan_documents(documents_path: str, extensions: List[str] = SUPPORTED_EXTENSIONS) -> List[Path]:
+    """Elenca ricorsivamente i file supportati (stesse regole di SimpleDirectoryReader)"""
+    root = Path(documents_path)
+    if not root.exists():
+        return []
+    files = []
+    for path in sorted(root.rglob("*")):
+        if not path.is_file() or path.suffix.lower() not in extensions:
+            continue
+        # SimpleDirectoryReader esclude i file nascosti
+        if any(part.startswith(".") for part in path.relative_to(root).parts):
+            continue
+        files.append(path)
+    return files
+
+
+# ============================================================================
+# SINCRONIZZAZIONE INDICE
+# ============================================================================
+
+def bootstrap_manifest(index, documents_path: str, files: List[Path]) -> IndexManifest:
+    """
+    Crea un manifest per un indice costruito prima dell'introduzione del
+    manifest, usando ref_doc_info del docstore (metadata file_path).
+
+    I file presenti nell'indice vengono considerati aggiornati; quelli non
+    presenti risulteranno "nuovi" al prossimo diff.
+    """
+    manifest = IndexManifest()
+    by_path: Dict[str, Dict[str, Any]] = {}
+
+    for ref_doc_id, info in (index.ref_doc_info or {}).items():
+        file_path = (info.metadata or {}).get("file_path")
+        if not file_path:
+            continue
+        try:
+            rel_path = relative_key(documents_path, Path(file_path))
+        except ValueError:
+            continue
+        slot = by_path.setdefault(rel_path, {"doc_ids": [], "node_ids": []})
+        slot["doc_ids"].append(ref_doc_id)
+        slot["node_ids"].extend(info.node_ids)
+
+    for path in files:
+        rel_path = relative_key(documents_path, path)
+        if rel_path not in by_path:
+            continue
+        stat = path.stat()
+        manifest.entries[rel_path] = FileEntry(
+            path=rel_path,
+            size=stat.st_size,
+            mtime=stat.st_mtime,
+            sha256=file_sha256(path),
+            **by_path.pop(rel_path),
+        )
+
+    # File indicizzati ma non più presenti su disco: verranno rimossi
+    for rel_path, ids in by_path.items():
+        manifest.entries[rel_path] = FileEntry(path=rel_path, size=-1, mtime=0.0, sha256="", **ids)
+
+    return manifest
+
+
+def sync_index(index, documents_path: str, manifest: IndexManifest, extensions: List[str] = SUPPORTED_EXTENSIONS,
+               pipeline=None, lexical_index=None, parser=None, batch_size: Optional[int] = None,
+               queue_size: int = 8, deduplicator=None, checkpoint_dir: Optional[str] = None,
+               checkpoint_interval: float = 300.0) -> Dict[str, Any]:
+    """
+    Allinea l'indice al contenuto della cartella documenti.
+
+    Args:
+        index: VectorStoreIndex da aggiornare (modificato in place)
+        documents_path: Cartella dei documenti
+        manifest: Manifest corrente (aggiornato in place)
+        extensions: Estensioni supportate
+        pipeline: EmbeddingPipeline per embeddare i chunk a batch concorrenti
+            (se None, embedding sequenziale di LlamaIndex)
+        lexical_index: BM25Index da aggiornare con gli stessi nodi (opzionale)
+        parser: DocumentParser per leggere i file (se None, pool di processi
+            con le impostazioni predefinite)
+        batch_size: Chunk per batch di embedding e scrittura (None = automatico)
+        queue_size: Capacità delle code tra lettura, chunking ed embedding
+        deduplicator: NearDuplicateIndex da aggiornare con gli stessi nodi; i chunk
+            quasi duplicati riusano l'embedding del loro originale (opzionale)
+        checkpoint_dir: Directory in cui salvare periodicamente indice e manifest
+            (di solito il persist_dir dell'indice). Se contiene il checkpoint di
+            una sincronizzazione interrotta, questa riprende da lì. Dopo il
+            salvataggio finale il chiamante rimuove il checkpoint
+            (BuildCheckpoint.clear). None = nessun checkpoint
+        checkpoint_interval: Secondi minimi tra due checkpoint (0 = solo in caso di errore)
+
+    Returns:
+        Dict con il numero di file aggiunti, modificati, rimossi, invariati
+        e non leggibili, di chunk indicizzati, di quelli quasi duplicati
+        (embedding riusato) e di quelli trovati nella cache degli embedding
+        ("embedding_cache_hits"), più il throughput di ogni stadio
+        ("throughput"). I file non leggibili restano fuori dal manifest (o
+        con la versione precedente, se modificati) e vengono ritentati alla
+        sincronizzazione successiva. Con checkpoint_dir, anche i checkpoint
+        salvati ("checkpoints") e l'avanzamento complessivo della
+        costruzione, ripresa o da zero ("build", BuildCheckpoint.progress).
+    """
+    from llama_index.core import Settings
+    from document_parser import DocumentParser
+    from ingestion import FileInfo, StreamingIngestion
+
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = BuildCheckpoint.load(checkpoint_dir)
+        if checkpoint is not None:
+            checkpoint.resumes += 1
+            resume_from_checkpoint(index, manifest, checkpoint, lexical_index, deduplicator)
+            checkpoint.resumed_files, checkpoint.resumed_chunks = checkpoint.files, checkpoint.chunks
+            print(f"♻️ Ripresa della sincronizzazione interrotta: {checkpoint.files} file e "
+                  f"{checkpoint.chunks} chunk già indicizzati dall'ultimo checkpoint")
+        else:
+            checkpoint = BuildCheckpoint()
+        # Segna subito la costruzione come in corso: indice e manifest su disco sono coerenti
+        checkpoint.save(checkpoint_dir)
+
+    files = scan_documents(documents_path, extensions)
+    diff = manifest.diff(documents_path, files)
+    stats = {
+        "added": len(diff.added),
+        "changed": len(diff.changed),
+        "removed": len(diff.removed),
+        "unchanged": len(diff.unchanged),
+        "failed": 0,
+        "chunks": 0,
+        "duplicates": 0,
+        "embedding_cache_hits": 0,
+        "checkpoints": 0,
+    }
+    print(f"🧾 Manifest: {stats['added']} nuovi, {stats['changed']} modificati, "
+          f"{stats['removed']} rimossi, {stats['unchanged']} invariati")
+
+    def remove(rel_path: str):
+        entry = manifest.entries.pop(rel_path)
+        for doc_id in entry.doc_ids:
+            index.delete_ref_doc(doc_id, delete_from_docstore=True)
+        if lexical_index is not None:
+            lexical_index.delete_nodes(entry.node_ids)
+        if deduplicator is not None:
+            deduplicator.delete_nodes(entry.node_ids)
+
+    # 1. Rimuovi i nodi dei file eliminati
+    for rel_path in diff.removed:
+        remove(rel_path)
+        print(f"   🗑️ {rel_path}")
+
+    # 2. Leggi ed embedda solo i file nuovi o modificati, a flusso: lettura,
+    #    chunking ed embedding procedono insieme con code limitate (ingestion.py)
+    to_index = diff.added + diff.changed
+    done_since_checkpoint: Dict[str, Dict[str, List[str]]] = {}
+    if to_index:
+        root = Path(documents_path)
+        rel_by_path = {str(root / rel_path): rel_path for rel_path in to_index}
+        parser = parser or DocumentParser()
+
+        def on_file_start(info: FileInfo):
+            # I file modificati perdono i vecchi nodi solo se la nuova versione è leggibile
+            rel_path = rel_by_path[str(info.path)]
+            if rel_path in manifest.entries:
+                remove(rel_path)
+
+        def on_file_done(info: FileInfo, node_ids: List[str]):
+            rel_path = rel_by_path[str(info.path)]
+            stat = info.path.stat()
+            manifest.entries[rel_path] = FileEntry(
+                path=rel_path,
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                sha256=info.sha256 or file_sha256(info.path),
+                doc_ids=info.doc_ids,
+                node_ids=node_ids,
+            )
+            done_since_checkpoint[rel_path] = {"doc_ids": info.doc_ids, "node_ids": node_ids}
+            print(f"   📄 {rel_path} ({len(node_ids)} chunk{', testo dalla cache' if info.cached else ''})")
+
+        files_before, chunks_before = (checkpoint.files, checkpoint.chunks) if checkpoint else (0, 0)
+
+        def on_checkpoint(in_progress: List[Tuple[FileInfo, List[str]]], progress):
+            started = time.monotonic()
+            checkpoint.files = files_before + progress.files
+            checkpoint.chunks = chunks_before + progress.chunks
+            save_checkpoint(index, manifest, checkpoint, checkpoint_dir, done_since_checkpoint, {
+                rel_by_path[str(info.path)]: {"doc_ids": info.doc_ids, "node_ids": node_ids}
+                for info, node_ids in in_progress
+            })
+            done_since_checkpoint.clear()
+            stats["checkpoints"] += 1
+            print(f"   💾 Checkpoint: {checkpoint.files} file, {checkpoint.chunks} chunk "
+                  f"({time.monotonic() - started:.1f}s)")
+
+        ingestion = StreamingIngestion(index, Settings.node_parser, pipeline=pipeline, lexical_index=lexical_index,
+                                       deduplicator=deduplicator, batch_size=batch_size, queue_size=queue_size,
+                                       checkpoint_interval=checkpoint_interval)
+        result = ingestion.run(parser.parse(root / rel_path for rel_path in to_index),
+                               on_file_start=on_file_start, on_file_done=on_file_done,
+                               on_checkpoint=on_checkpoint if checkpoint is not None else None)
+        stats["failed"] = result.failed
+        stats["chunks"] = result.chunks
+        stats["duplicates"] = result.duplicates
+        stats["embedding_cache_hits"] = result.embedding_cache_hits
+        stats["throughput"] = result.throughput()
+        if checkpoint is not None:
+            checkpoint.files = files_before + result.files
+            checkpoint.chunks = chunks_before + result.chunks
+
+    if checkpoint is not None:
+        # I file completati dall'ultimo checkpoint restano "parziali" finché il
+        # chiamante non ha salvato indice e manifest (poi BuildCheckpoint.clear)
+        checkpoint.partial = dict(done_since_checkpoint)
+        checkpoint.partial_done = list(done_since_checkpoint)
+        checkpoint.save(checkpoint_dir)
+        stats["build"] = checkpoint.progress()
+    return stats
+
+
+def save_checkpoint(index, manifest: IndexManifest, checkpoint: BuildCheckpoint, persist_dir: str,
+                    done: Dict[str, Dict[str, List[str]]], in_progress: Dict[str, Dict[str, List[str]]]):
+    """
+    Salva indice e manifest in persist_dir senza mai lasciare su disco nodi
+    non descritti da manifest o checkpoint. L'ordine conta, perché i tre
+    file non si scrivono in modo atomico insieme:
+    1. checkpoint con parziali i file in corso e quelli completati dopo l'ultimo manifest
+    2. indice
+    3. manifest (da qui i file completati sono descritti dal manifest)
+    4. checkpoint con parziali i soli file in corso
+    Un crash tra 1 e 3 lascia al più file completati ma non nel manifest,
+    che resume_from_checkpoint rimuove e reindicizza.
+    """
+    checkpoint.partial = {**done, **in_progress}
+    checkpoint.partial_done = list(done)
+    checkpoint.save(persist_dir)
+    index.storage_context.persist(persist_dir=persist_dir)
+    manifest.save(persist_dir)
+    checkpoint.partial = dict(in_progress)
+    checkpoint.partial_done = []
+    checkpoint.save(persist_dir)
+
+
+def resume_from_checkpoint(index, manifest: IndexManifest, checkpoint: BuildCheckpoint,
+                           lexical_index=None, deduplicator=None):
+    """
+    Riporta l'indice caricato dall'ultimo checkpoint a uno stato coerente con
+    il manifest: via i nodi dei file parziali (non nel manifest), che il
+    diff successivo vede come nuovi. La loro rilettura e i loro embedding
+    vengono dalle cache del testo estratto e degli embedding, se attive.
+    I nodi e i file rimossi escono anche dai contatori del checkpoint:
+    reindicizzati, verranno contati di nuovo.
+    """
+    nodes_before = len(index.index_struct.nodes_dict)
+    for rel_path, ids in checkpoint.partial.items():
+        if rel_path in manifest.entries:
+            # Completato e salvato nel manifest (crash dopo il passo 3 di save_checkpoint)
+            continue
+        for doc_id in ids.get("doc_ids", []):
+            index.delete_ref_doc(doc_id, delete_from_docstore=True)
+        if lexical_index is not None:
+            lexical_index.delete_nodes(ids.get("node_ids", []))
+        if deduplicator is not None:
+            deduplicator.delete_nodes(ids.get("node_ids", []))
+        if rel_path in checkpoint.partial_done:
+            checkpoint.files -= 1
+    checkpoint.chunks -= nodes_before - len(index.index_struct.nodes_dict)
+    checkpoint.partial, checkpoint.partial_done = {}, []
+    # BM25 e registro dei duplicati (SQLite) vengono aggiornati a ogni batch, anche dopo l'ultimo checkpoint
+    node_ids = set(index.index_struct.nodes_dict.values())
+    for store in (lexical_index, deduplicator):
+        if store is not None:
+            store.retain(node_ids)
@@ -0,0 +1,411 @@
+"""
+Ingestion - Pipeline di ingestione a flusso con memoria limitata
+================================================================
+Invece di leggere tutti i documenti, poi suddividerli tutti in chunk e
+poi embeddarli tutti (memoria proporzionale al corpus), l'ingestione è una
+catena di stadi collegati da code limitate:
+
+    lettura file → pagine → chunk → deduplica → embedding → scrittura indice
+    (thread)       (thread)          (thread principale, a batch)
+
+- lettura: DocumentParser (pool di processi), un risultato per file
+- chunking: una pagina (Document) alla volta con il node parser
+- deduplica (opzionale): i chunk quasi identici a uno già indicizzato o
+  a uno precedente nel batch riusano il suo embedding (near_duplicates.py)
+- embedding + scrittura: i chunk si accumulano fino a batch_size, vengono
+  embeddati (EmbeddingPipeline) e inseriti in indice e BM25, poi rilasciati
+
+Le code hanno dimensione fissa: se l'embedding rallenta (quote Gemini) la
+lettura si ferma, invece di accumulare pagine in memoria. La memoria di
+lavoro dipende da batch_size e dalle code, non dal numero di file; resta
+solo ciò che l'indice stesso conserva (docstore e vettori).
+
+I callback on_file_start / on_file_done girano nel thread di scrittura:
+il primo prima dei chunk del file (es. rimozione dei nodi della versione
+precedente), il secondo quando tutti i suoi chunk sono nell'indice.
+on_checkpoint viene chiamato tra due batch, al più ogni checkpoint_interval
+secondi e comunque se l'ingestione si interrompe per un errore: l'indice
+contiene allora tutti i chunk dei file completati e una parte di quelli in
+corso, passati al callback con i loro nodi (vedi index_manifest.sync_index).
+"""
+
+import time
+import queue
+import asyncio
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from embedding_pipeline import PipelineStats
+
+_DONE = object()
+# Metadati che dipendono dal nome del file, non dal contenuto
+PATH_METADATA_KEYS = ("file_path",)
+
+
+def exclude_path_metadata(document):
+    """
+    Esclude il percorso del file dal testo embeddato e dal prompt. Il
+    splitter sottrae la lunghezza dei metadati da quella dei chunk: con il
+    percorso incluso, una copia con un nome più lungo (es. nome_YYYYMMDD_HHMMSS
+    dell'Admin Panel) avrebbe confini dei chunk via via spostati e nessun
+    chunk riconoscibile come duplicato. Applicata sempre, con o senza
+    deduplica: il testo embeddato (e le chiavi della cache degli embedding)
+    non deve dipendere da DEDUP_ENABLED.
+    """
+    for keys in (document.excluded_embed_metadata_keys, document.excluded_llm_metadata_keys):
+        keys.extend(key for key in PATH_METADATA_KEYS if key not in keys)
+
+
+@dataclass
+class StageStats:
+    """Throughput di uno stadio: elementi elaborati e tempo di lavoro effettivo"""
+    name: str
+    unit: str
+    items: int = 0
+    busy_seconds: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.items / self.busy_seconds if self.busy_seconds > 0 else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"items": self.items, "unit": self.unit, "busy_seconds": round(self.busy_seconds, 2),
+                "per_second": round(self.rate, 1)}
+
+
+@dataclass
+class IngestionStats:
+    """Statistiche di un'esecuzione della pipeline di ingestione"""
+    stages: Dict[str, StageStats] = field(default_factory=lambda: {
+        "parse": StageStats("parse", "file"),
+        "chunk": StageStats("chunk", "chunk"),
+        "dedup": StageStats("dedup", "chunk"),
+        "embed": StageStats("embed", "chunk"),
+        "write": StageStats("write", "chunk"),
+    })
+    files: int = 0
+    failed: int = 0
+    chunks: int = 0
+    duplicates: int = 0
+    embedded: int = 0
+    embedding_cache_hits: int = 0
+    batches: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def embedding_cache_hit_rate(self) -> float:
+        lookups = self.embedded + self.embedding_cache_hits
+        return self.embedding_cache_hits / lookups if lookups else 0.0
+
+    def throughput(self) -> Dict[str, Dict[str, Any]]:
+        return {name: stage.to_dict() for name, stage in self.stages.items()}
+
+    def summary(self) -> str:
+        return " · ".join(f"{name} {stage.rate:.1f} {stage.unit}/s" for name, stage in self.stages.items()
+                          if stage.items)
+
+
+@dataclass
+class FileInfo:
+    """Un file letto, senza il suo testo (che non deve restare in memoria fino alla scrittura)"""
+    path: Path
+    sha256: Optional[str]
+    cached: bool
+    doc_ids: List[str]
+
+
+class StreamingIngestion:
+    """
+    Ingestione a stadi con code limitate.
+
+    Args:
+        index: VectorStoreIndex in cui inserire i nodi
+        node_parser: Splitter dei documenti in chunk (es. Settings.node_parser)
+        pipeline: EmbeddingPipeline (se None, embedding sequenziale di LlamaIndex in insert_nodes)
+        lexical_index: BM25Index da aggiornare con gli stessi nodi (opzionale)
+        deduplicator: NearDuplicateIndex per non embeddare i chunk quasi duplicati (opzionale)
+        batch_size: Chunk per batch di embedding e scrittura (None = batch_size × concurrency della pipeline)
+        queue_size: Capacità delle code tra gli stadi
+        report_interval: Ogni quanti secondi stampare l'avanzamento
+        checkpoint_interval: Secondi minimi tra due chiamate di on_checkpoint (0 = solo in caso di errore)
+    """
+
+    def __init__(self, index, node_parser, pipeline=None, lexical_index=None, deduplicator=None,
+                 batch_size: Optional[int] = None, queue_size: int = 8, report_interval: float = 10.0,
+                 checkpoint_interval: float = 0.0):
+        self.index = index
+        self.node_parser = node_parser
+        self.pipeline = pipeline
+        self.lexical_index = lexical_index
+        self.deduplicator = deduplicator
+        if batch_size is None:
+            batch_size = pipeline.batch_size * pipeline.concurrency if pipeline is not None else 256
+        self.batch_size = max(1, batch_size)
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.last_stats: Optional[IngestionStats] = None
+
+    def run(self, results: Iterable[Any], on_file_start: Optional[Callable[[FileInfo], None]] = None,
+            on_file_done: Optional[Callable[[FileInfo, List[str]], None]] = None,
+            on_checkpoint: Optional[Callable[[List[Tuple[FileInfo, List[str]]], IngestionStats], None]] = None
+            ) -> IngestionStats:
+        """
+        Consuma i ParseResult (di solito DocumentParser.parse) fino all'ultimo
+        file. I file non letti vengono solo contati.
+        """
+        stats = self.last_stats = IngestionStats()
+        stop = threading.Event()
+        errors: List[BaseException] = []
+        files: "queue.Queue" = queue.Queue(maxsize=max(1, self.queue_size // 4))
+        chunks: "queue.Queue" = queue.Queue(maxsize=self.queue_size)
+
+        threads = [
+            threading.Thread(target=self._read_stage, args=(results, files, stats, stop, errors),
+                             name="ingest-parse", daemon=True),
+            threading.Thread(target=self._chunk_stage, args=(files, chunks, stats, stop, errors),
+                             name="ingest-chunk", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        # Un solo event loop per tutta l'ingestione: client e rate limit condivisi tra i batch
+        loop = asyncio.new_event_loop()
+        try:
+            self._write_stage(chunks, stats, loop, stop, on_file_start, on_file_done, on_checkpoint)
+        finally:
+            stop.set()
+            for thread in threads:
+                # In caso di errore la lettura in corso può durare fino al timeout del
+                # parser: il thread termina da solo, chiudendo il pool
+                thread.join(timeout=5.0)
+            loop.close()
+            stats.finished_at = time.monotonic()
+        if errors:
+            raise errors[0]
+
+        if stats.chunks:
+            print(f"📊 Ingestione: {stats.files} file, {stats.chunks} chunk in {stats.elapsed:.1f}s"
+                  f"{f', {stats.duplicates} quasi duplicati (embedding riusato)' if stats.duplicates else ''} "
+                  f"({stats.summary()})")
+        if getattr(self.pipeline, "cache", None) is not None and stats.embedded + stats.embedding_cache_hits:
+            print(f"🧮 Cache embedding: {stats.embedding_cache_hits}/{stats.embedded + stats.embedding_cache_hits} "
+                  f"chunk già embeddati (hit rate {stats.embedding_cache_hit_rate:.0%})")
+        return stats
+
+    # ------------------------------------------------------------------
+    # Stadi
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _put(q: "queue.Queue", item: Any, stop: threading.Event) -> bool:
+        """Inserimento bloccante che si interrompe se la pipeline viene fermata"""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read_stage(self, results, files: "queue.Queue", stats: IngestionStats,
+                    stop: threading.Event, errors: List[BaseException]):
+        parse = stats.stages["parse"]
+        iterator = iter(results)
+        try:
+            while not stop.is_set():
+                started = time.monotonic()
+                result = next(iterator, _DONE)
+                parse.busy_seconds += time.monotonic() - started
+                if result is _DONE:
+                    break
+                parse.items += 1
+                if not result.ok:
+                    stats.failed += 1
+                    continue
+                if not self._put(files, result, stop):
+                    break
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                # Generatore del parser: chiude il pool di processi anche in caso di errore
+                close()
+            self._put(files, _DONE, stop)
+
+    def _chunk_stage(self, files: "queue.Queue", chunks: "queue.Queue", stats: IngestionStats,
+                     stop: threading.Event, errors: List[BaseException]):
+        chunk = stats.stages["chunk"]
+        try:
+            while not stop.is_set():
+                try:
+                    result = files.get(timeout=0.2)
+                except queue.Empty:
+                    continue
+                if result is _DONE:
+                    break
+                info = FileInfo(result.path, getattr(result, "sha256", None), getattr(result, "cached", False),
+                                [doc.doc_id for doc in result.documents])
+                documents, result.documents = result.documents[::-1], []
+                if not self._put(chunks, ("start", info), stop):
+                    break
+                while documents:
+                    # Una pagina alla volta; quelle già suddivise vengono rilasciate
+                    document = documents.pop()
+                    exclude_path_metadata(document)
+                    started = time.monotonic()
+                    nodes = self.node_parser.get_nodes_from_documents([document])
+                    chunk.busy_seconds += time.monotonic() - started
+                    chunk.items += len(nodes)
+                    if not self._put(chunks, ("nodes", info, nodes), stop):
+                        return
+                if not self._put(chunks, ("done", info), stop):
+                    break
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            self._put(chunks, _DONE, stop)
+
+    def _write_stage(self, chunks: "queue.Queue", stats: IngestionStats, loop: asyncio.AbstractEventLoop,
+                     stop: threading.Event, on_file_start, on_file_done, on_checkpoint=None):
+        embedding_stats = PipelineStats()
+        batch: List[Any] = []
+        node_ids: Dict[Path, List[str]] = {}
+        started_files: Dict[Path, FileInfo] = {}
+        completed: List[FileInfo] = []
+        last_report = last_checkpoint = time.monotonic()
+
+        def checkpoint():
+            # File iniziati ma non ancora passati a on_file_done, con i nodi già ricevuti
+            # (anche quelli del batch non scritto: la loro rimozione alla ripresa è innocua)
+            on_checkpoint([(started_files[path], list(ids)) for path, ids in node_ids.items()], stats)
+
+        def flush():
+            if batch:
+                dedup, embed, write = stats.stages["dedup"], stats.stages["embed"], stats.stages["write"]
+                plan = None
+                to_embed = batch
+                if self.deduplicator is not None:
+                    started = time.monotonic()
+                    plan = self.deduplicator.plan(batch)
+                    to_embed = self._reuse_embeddings(batch, plan)
+                    dedup.busy_seconds += time.monotonic() - started
+                    dedup.items += len(batch)
+                    stats.duplicates += plan.duplicates
+                if self.pipeline is not None and to_embed:
+                    started = time.monotonic()
+                    loop.run_until_complete(self.pipeline.aembed_nodes(to_embed, embedding_stats))
+                    embed.busy_seconds += time.monotonic() - started
+                    embed.items += len(to_embed)
+                    stats.embedded = embedding_stats.embedded
+                    stats.embedding_cache_hits = embedding_stats.cache_hits
+                if plan is not None:
+                    self._copy_batch_embeddings(batch, plan)
+                started = time.monotonic()
+                self.index.insert_nodes(batch)
+                if self.lexical_index is not None:
+                    self.lexical_index.add_nodes(batch)
+                if plan is not None:
+                    self.deduplicator.add(batch, plan)
+                write.busy_seconds += time.monotonic() - started
+                write.items += len(batch)
+                stats.chunks += len(batch)
+                stats.batches += 1
+                batch.clear()
+            # I file completati prima di questo flush hanno ora tutti i chunk nell'indice
+            for info in completed:
+                stats.files += 1
+                started_files.pop(info.path, None)
+                if on_file_done is not None:
+                    on_file_done(info, node_ids.pop(info.path, []))
+            completed.clear()
+
+        def interrupted():
+            if on_checkpoint is not None:
+                print("💾 Ingestione interrotta: salvataggio dell'avanzamento...")
+                try:
+                    checkpoint()
+                except Exception as e:
+                    # Resta valido il checkpoint precedente; l'errore originale ha la precedenza
+                    print(f"⚠️ Checkpoint non salvato: {e}")
+
+        try:
+            while True:
+                try:
+                    item = chunks.get(timeout=0.2)
+                except queue.Empty:
+                    if stop.is_set():
+                        # Errore in uno stadio precedente: run() lo rilancia
+                        interrupted()
+                        return
+                    continue
+                if item is _DONE:
+                    break
+                kind, info = item[0], item[1]
+                if kind == "start":
+                    node_ids[info.path] = []
+                    started_files[info.path] = info
+                    if on_file_start is not None:
+                        on_file_start(info)
+                elif kind == "nodes":
+                    batch.extend(item[2])
+                    node_ids[info.path].extend(node.node_id for node in item[2])
+                    if len(batch) >= self.batch_size:
+                        flush()
+                        if (on_checkpoint is not None and self.checkpoint_interval > 0
+                                and time.monotonic() - last_checkpoint >= self.checkpoint_interval):
+                            checkpoint()
+                            last_checkpoint = time.monotonic()
+                else:
+                    completed.append(info)
+
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    print(f"   📊 {stats.files} file, {stats.chunks} chunk scritti "
+                          f"(code: {chunks.qsize()} pagine in attesa; {stats.summary()})")
+            flush()
+        except Exception:
+            interrupted()
+            raise
+
+    # ------------------------------------------------------------------
+    # Quasi duplicati
+    # ------------------------------------------------------------------
+
+    def _reuse_embeddings(self, batch: List[Any], plan) -> List[Any]:
+        """
+        Copia nei quasi duplicati di chunk già indicizzati l'embedding salvato
+        nel vector store. Restituisce i nodi da embeddare: i nuovi e quelli il
+        cui originale non è leggibile dal vector store (es. backend diverso).
+        """
+        in_batch = {node.node_id for node in batch}
+        external = [(node, match) for node, match in zip(batch, plan.matches)
+                    if match is not None and match not in in_batch]
+        if external:
+            try:
+                vectors = self.index.vector_store.get_embeddings([match for _, match in external])
+            except (AttributeError, KeyError):
+                vectors = None
+            if vectors is not None:
+                for (node, _), vector in zip(external, vectors):
+                    node.embedding = vector.tolist()
+        return [node for node, match in zip(batch, plan.matches)
+                if node.embedding is None and (match is None or match not in in_batch)]
+
+    @staticmethod
+    def _copy_batch_embeddings(batch: List[Any], plan):
+        """Embedding dei rappresentanti copiato ai loro quasi duplicati nello stesso batch"""
+        by_id = {node.node_id: node for node in batch}
+        for node, match in zip(batch, plan.matches):
+            source = by_id.get(match) if match is not None else None
+            if source is not None and node.embedding is None and source.embedding is not None:
+                node.embedding = list(source.embedding)
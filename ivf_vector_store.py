@@ -0,0 +1,208 @@
+"""
+IVF Vector Store - Ricerca approssimata (ANN) per corpus molto grandi
+======================================================================
+Estende NumpyVectorStore con un indice IVF (inverted file): i vettori sono
+raggruppati con k-means sferico in nlist cluster e una query confronta solo
+i vettori dei nprobe cluster più vicini, invece di tutta la matrice.
+
+- nlist: numero di cluster (0 = automatico, circa 4·√N)
+- nprobe: cluster visitati per query (più alto = recall migliore, più lento)
+
+L'indice è incrementale: i nuovi nodi vengono assegnati al centroide più
+vicino; i centroidi vengono riaddestrati al salvataggio quando il numero di
+vettori è raddoppiato dall'ultimo addestramento. Centroidi e assegnazioni
+sono salvati in ./storage accanto alla matrice degli embedding.
+
+Sotto min_train_size vettori la ricerca resta esatta.
+"""
+
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from pydantic import Field, PrivateAttr
+from llama_index.core.vector_stores.types import VectorStoreQuery, VectorStoreQueryMode, VectorStoreQueryResult
+
+from numpy_vector_store import NumpyVectorStore, normalize_rows
+
+BLOCK_ROWS = 65536  # righe per blocco nelle assegnazioni (limita la memoria temporanea)
+
+
+def spherical_kmeans(x: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """K-means su vettori normalizzati (similarità coseno); restituisce i centroidi normalizzati"""
+    rng = np.random.default_rng(seed)
+    centroids = np.array(x[rng.choice(len(x), size=k, replace=False)], dtype=np.float32)
+    for _ in range(iterations):
+        assign = assign_to_centroids(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        # Somme per cluster con un'unica reduceat sulle righe ordinate per cluster
+        order = np.argsort(assign, kind="stable")
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        sums = np.zeros_like(centroids)
+        sums[nonempty] = np.add.reduceat(x[order], starts, axis=0)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            # Cluster vuoti: reinizializzati su punti casuali
+            sums[empty] = x[rng.choice(len(x), size=len(empty), replace=False)]
+        centroids = normalize_rows(sums).astype(np.float32)
+    return centroids
+
+
+def assign_to_centroids(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Indice del centroide più vicino per ogni riga di x, a blocchi"""
+    assign = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), BLOCK_ROWS):
+        block = np.asarray(x[start:start + BLOCK_ROWS], dtype=np.float32)
+        assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+class IVFVectorStore(NumpyVectorStore):
+    """NumpyVectorStore con ricerca approssimata IVF (nlist / nprobe configurabili)"""
+
+    nlist: int = Field(default=0, description="Numero di cluster (0 = automatico)")
+    nprobe: int = Field(default=16, description="Cluster visitati per query")
+    min_train_size: int = Field(default=10_000, description="Vettori minimi per addestrare l'IVF")
+    train_iterations: int = Field(default=10)
+    max_train_points_per_list: int = Field(default=256)
+
+    _centroids: Optional[np.ndarray] = PrivateAttr(default=None)
+    _assign: Optional[np.ndarray] = PrivateAttr(default=None)
+    _lists: Optional[List[np.ndarray]] = PrivateAttr(default=None)
+    _trained_size: int = PrivateAttr(default=0)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "IVFVectorStore"
+
+    @property
+    def is_trained(self) -> bool:
+        return self._centroids is not None
+
+    # ------------------------------------------------------------------
+    # Addestramento
+    # ------------------------------------------------------------------
+
+    def train(self):
+        """Addestra i centroidi su un campione e riassegna tutti i vettori"""
+        with self._lock:
+            if self._deleted:
+                self._compact()
+            n = self._size
+            if n == 0:
+                return
+            nlist = self.nlist or int(min(65536, max(16, 4 * np.sqrt(n))))
+            nlist = min(nlist, n)
+            started = time.perf_counter()
+
+            sample_size = min(n, nlist * self.max_train_points_per_list)
+            rng = np.random.default_rng(0)
+            sample_rows = np.sort(rng.choice(n, size=sample_size, replace=False))
+            sample = np.asarray(self._matrix[sample_rows], dtype=np.float32)
+
+            self._centroids = spherical_kmeans(sample, nlist, iterations=self.train_iterations)
+            self._assign = assign_to_centroids(self._matrix[:n], self._centroids)
+            self._lists = None
+            self._trained_size = n
+            self._dirty = True
+            print(f"🧭 IVF addestrato: {n} vettori, {nlist} cluster ({time.perf_counter() - started:.1f}s)")
+
+    def maybe_train(self):
+        """Addestra (o riaddestra) se i vettori bastano o sono raddoppiati"""
+        live = len(self)
+        if live < self.min_train_size:
+            return
+        if not self.is_trained or live >= 2 * self._trained_size:
+            self.train()
+
+    def _inverted_lists(self) -> List[np.ndarray]:
+        """Righe per cluster, ricalcolate solo dopo inserimenti/compattazioni"""
+        lists = self._lists
+        if lists is None:
+            assign = self._assign[:self._size]
+            order = np.argsort(assign, kind="stable")
+            bounds = np.searchsorted(assign[order], np.arange(len(self._centroids) + 1))
+            lists = self._lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(self._centroids))]
+        return lists
+
+    # ------------------------------------------------------------------
+    # Hook di NumpyVectorStore
+    # ------------------------------------------------------------------
+
+    def _on_add(self, start: int, vectors: np.ndarray):
+        if not self.is_trained:
+            return
+        new_assign = np.argmax(vectors @ self._centroids.T, axis=1).astype(np.int32)
+        self._assign = np.concatenate([np.asarray(self._assign[:start]), new_assign])
+        self._lists = None
+
+    def _on_compact(self, keep: np.ndarray):
+        if self.is_trained:
+            self._assign = np.asarray(self._assign)[keep]
+            self._lists = None
+
+    def _on_clear(self):
+        self._centroids = self._assign = self._lists = None
+        self._trained_size = 0
+
+    def _persist_extra(self, persist_path: str) -> Dict[str, Any]:
+        self.maybe_train()
+        if not self.is_trained:
+            return {}
+        base = os.path.splitext(persist_path)[0]
+        for suffix, array in ((".centroids.npy", self._centroids), (".assign.npy", self._assign[:self._size])):
+            tmp_path = base + suffix + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, base + suffix)
+        return {"ivf": {"nlist": int(len(self._centroids)), "trained_size": self._trained_size}}
+
+    def _load_extra(self, data: Dict[str, Any], persist_path: str, mmap: bool):
+        ivf = data.get("ivf")
+        base = os.path.splitext(persist_path)[0]
+        if ivf and os.path.exists(base + ".centroids.npy"):
+            self._centroids = np.load(base + ".centroids.npy")
+            self._assign = np.load(base + ".assign.npy")
+            self._trained_size = ivf.get("trained_size", self._size)
+        else:
+            # Store exact esistente passato a IVF: addestra subito se abbastanza grande
+            self.maybe_train()
+
+    # ------------------------------------------------------------------
+    # Ricerca
+    # ------------------------------------------------------------------
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """Top-k approssimato sui nprobe cluster più vicini (esatto se non addestrato)"""
+        if not self.is_trained or query.node_ids is not None or query.filters is not None:
+            return super().query(query, **kwargs)
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Modalità di query non supportata: {query.mode}")
+
+        with self._lock:
+            matrix, alive, ids, centroids = self._matrix, self._alive, self._ids, self._centroids
+            lists = self._inverted_lists()
+
+        q = np.asarray(query.query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(q)
+        if norm > 0:
+            q = q / norm
+
+        nprobe = min(self.nprobe, len(centroids))
+        probe = np.argpartition(-(centroids @ q), nprobe - 1)[:nprobe]
+        candidates = np.concatenate([lists[c] for c in probe])
+        if self._deleted:
+            candidates = candidates[alive[candidates]]
+        if len(candidates) == 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        scores = matrix[candidates] @ q
+        k = min(query.similarity_top_k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return VectorStoreQueryResult(
+            similarities=scores[top].astype(float).tolist(),
+            ids=[ids[r] for r in candidates[top]],
+        )
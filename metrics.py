@@ -0,0 +1,239 @@
+"""
+Metrics - Metriche in formato Prometheus
+=========================================
+Contatori, gauge e istogrammi thread-safe esposti in formato testo
+Prometheus (endpoint /metrics), senza dipendenze esterne.
+
+    registry = MetricsRegistry()
+    requests = registry.counter("rag_requests_total", "Richieste", ["endpoint"])
+    requests.labels(endpoint="/v1/chat/completions").inc()
+
+    latency = registry.histogram("rag_stage_duration_seconds", "Durata", ["stage"])
+    with latency.labels(stage="retrieve").time():
+        ...
+
+MetricsMiddleware (ASGI) conta richieste, durata e richieste in corso per
+endpoint; il testo da esporre si ottiene con registry.render().
+"""
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], "_Metric"] = {}
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> List[Tuple[str, str, float]]:
+        """(suffisso, etichette formattate, valore) per ogni serie"""
+        samples = []
+        children = [((), self)] if not self.labelnames else list(self._children.items())
+        for key, child in children:
+            samples.extend(child._child_samples(self.labelnames, key))
+        return samples
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._value = 0.0
+
+    def _new_child(self):
+        return Counter(self.name, self.documentation)
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def _child_samples(self, labelnames, key):
+        return [("", _format_labels(labelnames, key), self._value)]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, function: Optional[Callable[[], float]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._value = 0.0
+        self._function = function
+
+    def _new_child(self):
+        return Gauge(self.name, self.documentation)
+
+    def set(self, value: float):
+        self._value = float(value)
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]):
+        """Valore calcolato a ogni lettura di /metrics"""
+        self._function = function
+
+    def _child_samples(self, labelnames, key):
+        value = self._value
+        if self._function is not None:
+            try:
+                value = float(self._function())
+            except Exception:
+                value = float("nan")
+        return [("", _format_labels(labelnames, key), value)]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0.0
+
+    def _new_child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets[:-1])
+
+    def observe(self, value: float):
+        with self._lock:
+            self._sum += value
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def _child_samples(self, labelnames, key):
+        names = labelnames
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            samples.append(("_bucket", _format_labels(names, key, f'le="{_format_value(bound)}"'), cumulative))
+        samples.append(("_sum", _format_labels(names, key), total))
+        samples.append(("_count", _format_labels(names, key), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Insieme delle metriche di un processo, esportate da render()"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, function=function))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI: richieste per endpoint e status, durata e richieste in
+    corso. Le risposte in streaming restano "in corso" fino all'ultimo byte.
+
+    L'endpoint è il percorso della route (es. /delete/{doc_id}), non l'URL,
+    per non creare una serie per ogni id; le richieste senza route finiscono
+    sotto "other".
+    """
+
+    def __init__(self, app, registry: MetricsRegistry, prefix: str):
+        self.app = app
+        self.requests = registry.counter(f"{prefix}_http_requests_total", "Richieste HTTP", ["endpoint", "status"])
+        self.duration = registry.histogram(
+            f"{prefix}_http_request_duration_seconds", "Durata delle richieste HTTP", ["endpoint"])
+        self.in_flight = registry.gauge(f"{prefix}_http_requests_in_flight", "Richieste HTTP in corso")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        self.in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.in_flight.dec()
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or "other"
+            self.requests.labels(endpoint=endpoint, status=status["code"]).inc()
+            self.duration.labels(endpoint=endpoint).observe(time.perf_counter() - started)
@@ -0,0 +1,328 @@
+"""
+Near Duplicates - Chunk quasi identici tra versioni dello stesso documento
+==========================================================================
+La cartella documenti contiene molte revisioni dello stesso manuale (e
+l'Admin Panel, a ogni ricaricamento, crea copie nome_YYYYMMDD_HHMMSS):
+la maggior parte dei chunk si ripete quasi uguale in più file. Senza
+deduplica ogni copia viene embeddata (quota Gemini) e i risultati del
+retrieval si riempiono dello stesso paragrafo.
+
+Tra chunking ed embedding ogni chunk riceve una firma MinHash (num_perm
+permutazioni sugli shingle di 3 parole). Con il locality-sensitive
+hashing (firma divisa in bande, un bucket per banda) si trovano in tempo
+costante i chunk già indicizzati con firma simile; se la similarità di
+Jaccard stimata supera la soglia il chunk entra nel gruppo del primo:
+
+- solo il rappresentante viene embeddato; gli altri membri del gruppo
+  riusano il suo vettore, senza chiamate all'API
+- tutti i membri restano nell'indice, ciascuno col proprio file: la
+  rimozione di un file (index_manifest.py) non tocca le altre copie
+- al retrieval i membri dello stesso gruppo diventano un solo risultato,
+  e le fonti citate elencano tutti i file del gruppo (collapse)
+
+Registro persistito in persist_dir/dedup.sqlite, accanto al BM25.
+
+    dedup = NearDuplicateIndex("./storage", threshold=0.9)
+    plan = dedup.plan(nodes)   # plan.matches[i]: nodo di cui nodes[i] è copia (None = nuovo)
+    ...                        # embedding dei nuovi, copia del vettore per gli altri, inserimento
+    dedup.add(nodes, plan)     # registrazione, dopo l'inserimento nell'indice
+"""
+
+import os
+import re
+import zlib
+import sqlite3
+import hashlib
+import threading
+from contextlib import closing, contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+DEDUP_FILENAME = "dedup.sqlite"
+SHINGLE_SIZE = 3
+# Primo di Mersenne 2^31 - 1: a·x + b resta entro uint64 con x, a, b < 2^31
+_PRIME = np.uint64((1 << 31) - 1)
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> List[str]:
+    """Sequenze di size parole consecutive (testi più corti: le parole stesse)"""
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < size:
+        return words
+    return [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+
+class MinHasher:
+    """
+    Firme MinHash con permutazioni fisse (seed costante): le firme salvate
+    restano confrontabili tra esecuzioni e processi diversi.
+    """
+
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self._a = rng.randint(1, int(_PRIME), size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, int(_PRIME), size=num_perm).astype(np.uint64)
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """Firma (num_perm,) uint32 del testo; None se non contiene parole"""
+        items = set(shingles(text))
+        if not items:
+            return None
+        x = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in items), dtype=np.uint64, count=len(items))
+        x &= _PRIME
+        hashed = (self._a[:, None] * x[None, :] + self._b[:, None]) % _PRIME
+        return hashed.min(axis=1).astype(np.uint32)
+
+
+def estimated_jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.mean(a == b))
+
+
+@dataclass
+class DedupPlan:
+    """
+    Esito di plan() per un batch di nodi, nello stesso ordine:
+    per ogni nodo il nodo già noto di cui è copia (None = rappresentante)
+    e il gruppo a cui appartiene.
+    """
+    signatures: List[Optional[np.ndarray]] = field(default_factory=list)
+    matches: List[Optional[str]] = field(default_factory=list)
+    groups: List[Optional[str]] = field(default_factory=list)
+
+    @property
+    def duplicates(self) -> int:
+        return sum(match is not None for match in self.matches)
+
+
+class NearDuplicateIndex:
+    """
+    Registro dei chunk indicizzati: firma, gruppo e file di provenienza.
+
+    Args:
+        persist_dir: Directory dell'indice (il file è persist_dir/dedup.sqlite)
+        threshold: Similarità di Jaccard stimata oltre la quale due chunk sono lo stesso
+        num_perm: Permutazioni MinHash (lunghezza della firma)
+        bands: Bande LSH (num_perm deve esserne multiplo); più bande = più candidati
+    """
+
+    def __init__(self, persist_dir: str, threshold: float = 0.9, num_perm: int = 64, bands: int = 16):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) deve essere multiplo di bands ({bands})")
+        self.persist_dir = persist_dir
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        self._lock = threading.Lock()
+
+        os.makedirs(persist_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    node_id TEXT PRIMARY KEY,
+                    group_id TEXT NOT NULL,
+                    file_name TEXT,
+                    signature BLOB NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_group ON chunks (group_id)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS bands (
+                    band INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    node_id TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_bands_bucket ON bands (band, bucket)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_bands_node ON bands (node_id)")
+
+    @property
+    def db_path(self) -> str:
+        return os.path.join(self.persist_dir, DEDUP_FILENAME)
+
+    @contextmanager
+    def _connect(self):
+        """Connessione breve, come BM25Index: la directory può essere rinominata dallo swap blue/green"""
+        with closing(sqlite3.connect(self.db_path, timeout=30.0)) as conn:
+            with conn:
+                yield conn
+
+    def __len__(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def _buckets(self, signature: np.ndarray) -> List[int]:
+        """Bucket LSH di ogni banda (interi a 64 bit con segno, come li salva SQLite)"""
+        return [
+            int.from_bytes(hashlib.blake2b(signature[i * self.rows:(i + 1) * self.rows].tobytes(),
+                                           digest_size=8).digest(), "big", signed=True)
+            for i in range(self.bands)
+        ]
+
+    # ------------------------------------------------------------------
+    # Ingestione
+    # ------------------------------------------------------------------
+
+    def plan(self, nodes: List[Any]) -> DedupPlan:
+        """
+        Cerca per ogni nodo un chunk quasi identico, già registrato o
+        precedente nello stesso batch. Non modifica il registro: i nodi
+        vanno registrati con add() solo dopo l'inserimento nell'indice.
+        """
+        from llama_index.core.schema import MetadataMode
+
+        plan = DedupPlan()
+        # Nodi del batch: bucket → indici nel batch
+        local: Dict[tuple, List[int]] = {}
+        with self._connect() as conn:
+            for i, node in enumerate(nodes):
+                signature = self.hasher.signature(node.get_content(metadata_mode=MetadataMode.NONE))
+                plan.signatures.append(signature)
+                plan.matches.append(None)
+                plan.groups.append(None)
+                if signature is None:
+                    continue
+                buckets = self._buckets(signature)
+
+                best, best_group, best_score = None, None, self.threshold
+                candidates = {j for band, bucket in enumerate(buckets) for j in local.get((band, bucket), ())}
+                for j in sorted(candidates):
+                    score = estimated_jaccard(signature, plan.signatures[j])
+                    if score >= best_score:
+                        best, best_group, best_score = nodes[j].node_id, plan.groups[j], score
+                if best is None:
+                    for node_id, group_id, blob in self._candidates(conn, buckets):
+                        score = estimated_jaccard(signature, np.frombuffer(blob, dtype=np.uint32))
+                        if score >= best_score:
+                            best, best_group, best_score = node_id, group_id, score
+
+                plan.matches[i] = best
+                plan.groups[i] = best_group if best is not None else node.node_id
+                for band, bucket in enumerate(buckets):
+                    local.setdefault((band, bucket), []).append(i)
+        return plan
+
+    @staticmethod
+    def _candidates(conn: sqlite3.Connection, buckets: List[int]):
+        clauses = " OR ".join("(b.band = ? AND b.bucket = ?)" for _ in buckets)
+        params = [value for band, bucket in enumerate(buckets) for value in (band, bucket)]
+        return conn.execute(
+            f"SELECT DISTINCT c.node_id, c.group_id, c.signature FROM bands b "
+            f"JOIN chunks c ON c.node_id = b.node_id WHERE {clauses}",
+            params,
+        ).fetchall()
+
+    def add(self, nodes: List[Any], plan: Optional[DedupPlan] = None) -> int:
+        """Registra i nodi (già nell'indice) con i gruppi calcolati da plan(); restituisce quanti"""
+        plan = plan or self.plan(nodes)
+        rows, band_rows = [], []
+        for node, signature, group_id in zip(nodes, plan.signatures, plan.groups):
+            if signature is None:
+                continue
+            rows.append((node.node_id, group_id, node.metadata.get("file_name"), signature.tobytes()))
+            band_rows.extend((band, bucket, node.node_id) for band, bucket in enumerate(self._buckets(signature)))
+        if not rows:
+            return 0
+        with self._lock:
+            with self._connect() as conn:
+                self._delete_rows(conn, [row[0] for row in rows])
+                conn.executemany("INSERT INTO chunks (node_id, group_id, file_name, signature) VALUES (?, ?, ?, ?)",
+                                 rows)
+                conn.executemany("INSERT INTO bands (band, bucket, node_id) VALUES (?, ?, ?)", band_rows)
+        return len(rows)
+
+    def delete_nodes(self, node_ids: List[str]):
+        """Rimuove i nodi dal registro; gli altri membri dei loro gruppi restano"""
+        with self._lock:
+            with self._connect() as conn:
+                self._delete_rows(conn, node_ids)
+
+    def retain(self, node_ids: Iterable[str]) -> int:
+        """Rimuove i nodi registrati che non sono fra node_ids (es. scritti dopo l'ultimo checkpoint)"""
+        keep = set(node_ids)
+        with self._lock:
+            with self._connect() as conn:
+                stale = [node_id for (node_id,) in conn.execute("SELECT node_id FROM chunks") if node_id not in keep]
+                self._delete_rows(conn, stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM bands")
+                conn.execute("DELETE FROM chunks")
+
+    @staticmethod
+    def _delete_rows(conn: sqlite3.Connection, node_ids: List[str]):
+        for start in range(0, len(node_ids), 500):
+            block = node_ids[start:start + 500]
+            placeholders = ",".join("?" * len(block))
+            conn.execute(f"DELETE FROM bands WHERE node_id IN ({placeholders})", block)
+            conn.execute(f"DELETE FROM chunks WHERE node_id IN ({placeholders})", block)
+
+    # ------------------------------------------------------------------
+    # Retrieval
+    # ------------------------------------------------------------------
+
+    def groups(self, node_ids: Iterable[str]) -> Dict[str, str]:
+        """Gruppo di ogni nodo registrato (i nodi assenti non compaiono)"""
+        node_ids = list(node_ids)
+        result: Dict[str, str] = {}
+        with self._connect() as conn:
+            for start in range(0, len(node_ids), 500):
+                block = node_ids[start:start + 500]
+                placeholders = ",".join("?" * len(block))
+                result.update(conn.execute(
+                    f"SELECT node_id, group_id FROM chunks WHERE node_id IN ({placeholders})", block))
+        return result
+
+    def group_files(self, group_ids: Iterable[str]) -> Dict[str, List[str]]:
+        """File che contengono ogni gruppo, in ordine alfabetico"""
+        group_ids = list(set(group_ids))
+        result: Dict[str, set] = {}
+        with self._connect() as conn:
+            for start in range(0, len(group_ids), 500):
+                block = group_ids[start:start + 500]
+                placeholders = ",".join("?" * len(block))
+                for group_id, file_name in conn.execute(
+                        f"SELECT group_id, file_name FROM chunks WHERE group_id IN ({placeholders})", block):
+                    if file_name:
+                        result.setdefault(group_id, set()).add(file_name)
+        return {group_id: sorted(files) for group_id, files in result.items()}
+
+    def collapse(self, nodes: List[Any]) -> List[Any]:
+        """
+        Un solo risultato per gruppo (il primo, cioè il più rilevante se i
+        nodi sono ordinati per score). Se il gruppo compare in altri file,
+        il nodo tenuto riceve nei metadati "duplicate_files" (esclusi dal
+        prompt e dall'embedding) per le fonti citate.
+        """
+        if not nodes:
+            return nodes
+        groups = self.groups(n.node.node_id for n in nodes)
+        if not groups:
+            return nodes
+        files = self.group_files(groups.values())
+
+        kept, seen = [], set()
+        for item in nodes:
+            group_id = groups.get(item.node.node_id)
+            if group_id is None:
+                kept.append(item)
+                continue
+            if group_id in seen:
+                continue
+            seen.add(group_id)
+            own = item.node.metadata.get("file_name")
+            others = [name for name in files.get(group_id, []) if name != own]
+            if others:
+                item.node.metadata["duplicate_files"] = others
+                for keys in (item.node.excluded_llm_metadata_keys, item.node.excluded_embed_metadata_keys):
+                    if "duplicate_files" not in keys:
+                        keys.append("duplicate_files")
+            kept.append(item)
+        return kept
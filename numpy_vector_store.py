@@ -0,0 +1,342 @@
+"""
+NumPy Vector Store - Ricerca esatta vettorizzata
+=================================================
+Vector store per VectorStoreIndex che tiene gli embedding, già normalizzati,
+in un'unica matrice float32 contigua con un array parallelo di id.
+
+La ricerca top-k è un singolo prodotto matrice-vettore seguito da
+argpartition (niente cicli Python per nodo). La matrice viene salvata in
+formato .npy accanto all'indice e ricaricata in memory-map, quindi
+l'avvio non deve deserializzare un JSON con tutti gli embedding.
+
+Il testo dei nodi resta nel docstore (stores_text = False), come con il
+SimpleVectorStore di default: VectorIndexRetriever funziona senza modifiche.
+"""
+
+import os
+import json
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+DEFAULT_NAMESPACE = "default"
+VECTOR_STORE_FNAME = "vector_store.json"
+STORE_FORMAT = "numpy"
+MIN_CAPACITY = 1024
+
+
+def matrix_path(persist_path: str) -> str:
+    """Percorso del file .npy associato al JSON del vector store"""
+    return os.path.splitext(persist_path)[0] + ".npy"
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """
+    Vector store in-memory (o memory-mapped) basato su una matrice NumPy.
+
+    Gli embedding sono normalizzati all'inserimento, quindi il prodotto
+    scalare equivale alla similarità coseno del SimpleVectorStore.
+    """
+
+    stores_text: bool = False
+
+    _matrix: Optional[np.ndarray] = PrivateAttr(default=None)
+    _alive: Optional[np.ndarray] = PrivateAttr(default=None)
+    _size: int = PrivateAttr(default=0)
+    _deleted: int = PrivateAttr(default=0)
+    _ids: List[str] = PrivateAttr(default_factory=list)
+    _ref_doc_ids: List[str] = PrivateAttr(default_factory=list)
+    _row_of: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _rows_by_ref: Dict[str, List[int]] = PrivateAttr(default_factory=dict)
+    _dirty: bool = PrivateAttr(default=False)
+    _source_path: Optional[str] = PrivateAttr(default=None)
+    _lock: Any = PrivateAttr(default_factory=threading.RLock)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "NumpyVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def __len__(self) -> int:
+        return self._size - self._deleted
+
+    def __bool__(self) -> bool:
+        # Vuoto ma valido: StorageContext.from_defaults(vector_store=...) usa
+        # "vector_store or SimpleVectorStore()" e scarterebbe uno store vuoto
+        return True
+
+    @property
+    def dirty(self) -> bool:
+        """True se ci sono modifiche non ancora salvate su disco"""
+        return self._dirty
+
+    @property
+    def nbytes(self) -> int:
+        """Byte occupati dagli embedding attivi"""
+        return 0 if self._matrix is None else int(self._matrix[:self._size].nbytes)
+
+    # ------------------------------------------------------------------
+    # Scrittura
+    # ------------------------------------------------------------------
+
+    def _reserve(self, extra: int, dim: int):
+        """Garantisce spazio per extra righe (crescita geometrica, materializza un memmap)"""
+        capacity = 0 if self._matrix is None else self._matrix.shape[0]
+        needed = self._size + extra
+        if self._matrix is not None and needed <= capacity and not isinstance(self._matrix, np.memmap):
+            return
+        new_capacity = max(needed, 2 * capacity, MIN_CAPACITY)
+        matrix = np.empty((new_capacity, dim), dtype=np.float32)
+        alive = np.zeros(new_capacity, dtype=bool)
+        if self._matrix is not None:
+            matrix[:self._size] = self._matrix[:self._size]
+            alive[:self._size] = self._alive[:self._size]
+        self._matrix, self._alive = matrix, alive
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        """Aggiunge i nodi (con embedding già calcolato) alla matrice"""
+        if not nodes:
+            return []
+        vectors = normalize_rows(np.asarray([node.get_embedding() for node in nodes], dtype=np.float32))
+        with self._lock:
+            if self._matrix is not None and self._size and vectors.shape[1] != self._matrix.shape[1]:
+                raise ValueError(
+                    f"Dimensione embedding {vectors.shape[1]} diversa da quella dell'indice {self._matrix.shape[1]}"
+                )
+            self._reserve(len(nodes), vectors.shape[1])
+            for node in nodes:
+                if node.node_id in self._row_of:
+                    self._delete_row(self._row_of[node.node_id])
+            start = self._size
+            self._matrix[start:start + len(nodes)] = vectors
+            self._alive[start:start + len(nodes)] = True
+            for offset, node in enumerate(nodes):
+                row = start + offset
+                ref_doc_id = node.ref_doc_id or "None"
+                self._ids.append(node.node_id)
+                self._ref_doc_ids.append(ref_doc_id)
+                self._row_of[node.node_id] = row
+                self._rows_by_ref.setdefault(ref_doc_id, []).append(row)
+            self._size += len(nodes)
+            self._dirty = True
+            self._on_add(start, vectors)
+        return [node.node_id for node in nodes]
+
+    def _delete_row(self, row: int):
+        if self._alive[row]:
+            self._alive[row] = False
+            self._deleted += 1
+            self._row_of.pop(self._ids[row], None)
+            self._dirty = True
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """Elimina tutti i nodi di un documento"""
+        with self._lock:
+            for row in self._rows_by_ref.pop(ref_doc_id, []):
+                self._delete_row(row)
+
+    def delete_nodes(self, node_ids: Optional[List[str]] = None, filters: Any = None, **delete_kwargs: Any) -> None:
+        if filters is not None:
+            raise ValueError("NumpyVectorStore non supporta i filtri sui metadata")
+        with self._lock:
+            for node_id in node_ids or []:
+                row = self._row_of.get(node_id)
+                if row is not None:
+                    self._delete_row(row)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._matrix = self._alive = None
+            self._size = self._deleted = 0
+            self._ids, self._ref_doc_ids = [], []
+            self._row_of, self._rows_by_ref = {}, {}
+            self._dirty = True
+            self._on_clear()
+
+    def _compact(self):
+        """Rimuove fisicamente le righe eliminate"""
+        keep = np.flatnonzero(self._alive[:self._size])
+        self._matrix = np.ascontiguousarray(self._matrix[keep])
+        self._alive = np.ones(len(keep), dtype=bool)
+        self._set_ids([self._ids[i] for i in keep], [self._ref_doc_ids[i] for i in keep])
+        self._deleted = 0
+        self._on_compact(keep)
+
+    # Hook per le sottoclassi (es. indice IVF)
+
+    def _on_add(self, start: int, vectors: np.ndarray):
+        pass
+
+    def _on_compact(self, keep: np.ndarray):
+        pass
+
+    def _on_clear(self):
+        pass
+
+    def _persist_extra(self, persist_path: str) -> Dict[str, Any]:
+        return {}
+
+    def _load_extra(self, data: Dict[str, Any], persist_path: str, mmap: bool):
+        pass
+
+    def _set_ids(self, ids: List[str], ref_doc_ids: List[str]):
+        self._ids, self._ref_doc_ids = ids, ref_doc_ids
+        self._size = len(ids)
+        self._row_of = {node_id: row for row, node_id in enumerate(ids)}
+        self._rows_by_ref = {}
+        for row, ref_doc_id in enumerate(ref_doc_ids):
+            self._rows_by_ref.setdefault(ref_doc_id, []).append(row)
+
+    # ------------------------------------------------------------------
+    # Ricerca
+    # ------------------------------------------------------------------
+
+    def get_embeddings(self, node_ids: List[str]) -> np.ndarray:
+        """Embedding normalizzati dei nodi indicati (righe nello stesso ordine)"""
+        rows = [self._row_of[node_id] for node_id in node_ids]
+        return np.asarray(self._matrix[rows], dtype=np.float32)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """Top-k esatto: un prodotto matrice-vettore + argpartition"""
+        if query.filters is not None:
+            raise ValueError("NumpyVectorStore non supporta i filtri sui metadata")
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Modalità di query non supportata: {query.mode}")
+
+        # Snapshot coerente anche con add/delete concorrenti
+        with self._lock:
+            matrix, alive, size, ids = self._matrix, self._alive, self._size, self._ids
+            restrict = [self._row_of[i] for i in query.node_ids if i in self._row_of] if query.node_ids is not None else None
+        if matrix is None or size == 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        q = np.asarray(query.query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(q)
+        if norm > 0:
+            q = q / norm
+
+        if restrict is not None:
+            rows = np.asarray(restrict, dtype=np.int64)
+            scores = matrix[rows] @ q if len(rows) else np.empty(0, dtype=np.float32)
+        else:
+            rows = None
+            scores = matrix[:size] @ q
+            if self._deleted:
+                scores = np.where(alive[:size], scores, -np.inf)
+
+        live = len(scores) if rows is not None else size - self._deleted
+        k = min(query.similarity_top_k, live)
+        if k <= 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        result_rows = rows[top] if rows is not None else top
+        return VectorStoreQueryResult(
+            similarities=scores[top].astype(float).tolist(),
+            ids=[ids[r] for r in result_rows],
+        )
+
+    # ------------------------------------------------------------------
+    # Persistenza
+    # ------------------------------------------------------------------
+
+    def release_mmap(self) -> bool:
+        """
+        Copia in RAM la matrice mappata dal file .npy. Su Windows una
+        directory con file mappati non si può rinominare né eliminare (swap
+        blue/green). La mappa viene rilasciata quando anche l'ultima query
+        in corso che la usa termina (nessun close esplicito sotto i suoi piedi).
+        """
+        with self._lock:
+            if not isinstance(self._matrix, np.memmap):
+                return False
+            self._matrix = np.array(self._matrix)
+            return True
+
+    def persist(self, persist_path: str, fs: Any = None) -> None:
+        """Salva id (JSON) e matrice (.npy) con scrittura atomica"""
+        os.makedirs(os.path.dirname(persist_path) or ".", exist_ok=True)
+        npy_path = matrix_path(persist_path)
+        with self._lock:
+            if self._deleted:
+                self._compact()
+            same_file = self._source_path is not None and os.path.abspath(self._source_path) == os.path.abspath(npy_path)
+            if self._dirty or not same_file or not os.path.exists(npy_path):
+                dim = self._matrix.shape[1] if self._matrix is not None else 0
+                matrix = self._matrix[:self._size] if self._matrix is not None else np.empty((0, dim), dtype=np.float32)
+                if isinstance(matrix, np.memmap):
+                    # Il file mappato potrebbe essere quello da sovrascrivere (e su Windows
+                    # un file mappato non si può rimpiazzare): copia in RAM e chiudi la mappa
+                    matrix = np.array(matrix)
+                    mmap = getattr(self._matrix, "_mmap", None)
+                    self._matrix = matrix
+                    if mmap is not None:
+                        mmap.close()
+                tmp_path = npy_path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, np.ascontiguousarray(matrix))
+                os.replace(tmp_path, npy_path)
+                self._source_path = npy_path
+
+            data = {"format": STORE_FORMAT, "ids": self._ids[:self._size], "ref_doc_ids": self._ref_doc_ids[:self._size]}
+            data.update(self._persist_extra(persist_path))
+            tmp_path = persist_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, persist_path)
+            self._dirty = False
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str, mmap: bool = True, **kwargs: Any) -> "NumpyVectorStore":
+        """
+        Carica il vector store. Un JSON del SimpleVectorStore (indici creati
+        prima di questo formato) viene convertito al volo.
+        """
+        with open(persist_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        store = cls(**kwargs)
+        if data.get("format") != STORE_FORMAT:
+            print("🔁 Conversione del vector store JSON in formato NumPy...")
+            embedding_dict = data.get("embedding_dict", {})
+            ids = list(embedding_dict)
+            ref_doc_ids = [data.get("text_id_to_ref_doc_id", {}).get(i, "None") for i in ids]
+            if ids:
+                store._matrix = normalize_rows(np.asarray([embedding_dict[i] for i in ids], dtype=np.float32))
+                store._alive = np.ones(len(ids), dtype=bool)
+            store._set_ids(ids, ref_doc_ids)
+            store._dirty = True
+            store._load_extra({}, persist_path, mmap)
+            return store
+
+        npy_path = matrix_path(persist_path)
+        matrix = np.load(npy_path, mmap_mode="r" if mmap else None)
+        store._set_ids(data["ids"], data["ref_doc_ids"])
+        if store._size:
+            store._matrix = matrix
+            store._alive = np.ones(store._size, dtype=bool)
+        store._source_path = npy_path
+        store._load_extra(data, persist_path, mmap)
+        return store
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, namespace: str = DEFAULT_NAMESPACE, mmap: bool = True, **kwargs: Any) -> "NumpyVectorStore":
+        return cls.from_persist_path(os.path.join(persist_dir, f"{namespace}__{VECTOR_STORE_FNAME}"), mmap=mmap, **kwargs)
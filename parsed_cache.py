@@ -0,0 +1,192 @@
+"""
+Parsed Cache - Cache del testo estratto dai documenti
+=====================================================
+L'estrazione del testo da PDF e DOCX costa più del caricamento dell'indice
+salvato. Questa cache conserva su disco (SQLite, JSON compresso con zlib)
+i documenti estratti da ogni file, con chiave:
+
+    (SHA-256 del contenuto del file, versione del parser)
+
+La chiave dipende solo dai byte del file: un file rinominato, spostato o
+ricaricato dall'Admin Panel con lo stesso contenuto non viene riletto.
+La versione del parser include le versioni di LlamaIndex e delle librerie
+di estrazione: aggiornandole, i file vengono riletti.
+
+I metadati legati al percorso (file_path, file_name, date, dimensione)
+non vengono salvati ma ricalcolati dal file alla lettura dalla cache, come
+farebbe SimpleDirectoryReader; così anche gli id dei documenti
+(filename_as_id) restano quelli del percorso attuale.
+"""
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from importlib import metadata as importlib_metadata
+from pathlib import Path
+from typing import Any, List, Optional
+
+# Da incrementare se cambia il modo in cui i documenti vengono estratti o salvati
+PARSED_CACHE_VERSION = 1
+# Librerie che determinano il testo estratto
+PARSER_PACKAGES = ("llama-index-core", "llama-index-readers-file", "pypdf", "docx2txt")
+# Metadati ricalcolati dal file (non dipendono dal contenuto)
+FILE_METADATA_KEYS = ("file_path", "file_name", "file_type", "file_size",
+                      "creation_date", "last_modified_date", "last_accessed_date")
+EVICTION_CHECK_INTERVAL = 50
+
+
+def parser_version() -> str:
+    """Versione del parser: formato della cache + versioni delle librerie di estrazione"""
+    versions = []
+    for package in PARSER_PACKAGES:
+        try:
+            versions.append(f"{package}={importlib_metadata.version(package)}")
+        except importlib_metadata.PackageNotFoundError:
+            versions.append(f"{package}=-")
+    return f"v{PARSED_CACHE_VERSION};" + ";".join(versions)
+
+
+class ParsedTextCache:
+    """
+    Cache SQLite dei documenti estratti, sicura tra thread e processi.
+
+    Args:
+        db_path: Percorso del database SQLite
+        max_mb: Dimensione massima (dati compressi); oltre, vengono eliminate le voci meno usate
+    """
+
+    def __init__(self, db_path: str, max_mb: int = 1024):
+        self.db_path = db_path
+        self.max_bytes = max_mb * 1024 * 1024
+        self.version = parser_version()
+        self._local = threading.local()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS parsed (
+                file_hash TEXT NOT NULL,
+                parser_version TEXT NOT NULL,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (file_hash, parser_version)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_parsed_last_used ON parsed (last_used)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        """Una connessione per thread (le connessioni sqlite3 non sono condivisibili)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, file_hash: str, path: Path) -> Optional[List[Any]]:
+        """Documenti estratti da un file con questo contenuto, ricollocati in path (None se assenti)"""
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT data FROM parsed WHERE file_hash = ? AND parser_version = ?", (file_hash, self.version)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        try:
+            conn.execute("UPDATE parsed SET last_used = ? WHERE file_hash = ? AND parser_version = ?",
+                         (time.time(), file_hash, self.version))
+            conn.commit()
+        except sqlite3.OperationalError:
+            # Database occupato da un altro processo: l'aggiornamento LRU può attendere
+            conn.rollback()
+        self.hits += 1
+        return self._decode(row[0], path)
+
+    def put(self, file_hash: str, path: Path, documents: List[Any]):
+        data = self._encode(documents, path)
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO parsed (file_hash, parser_version, data, size, last_used) VALUES (?, ?, ?, ?, ?)",
+            (file_hash, self.version, data, len(data), time.time()),
+        )
+        conn.commit()
+        self._puts += 1
+        if self._puts >= EVICTION_CHECK_INTERVAL:
+            self._puts = 0
+            self.evict()
+
+    def evict(self):
+        """Elimina le voci meno usate oltre max_mb (e quelle di versioni del parser superate)"""
+        conn = self._conn()
+        conn.execute("DELETE FROM parsed WHERE parser_version != ?", (self.version,))
+        (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM parsed").fetchone()
+        if total > self.max_bytes:
+            excess = total - self.max_bytes
+            for rowid, size in conn.execute("SELECT rowid, size FROM parsed ORDER BY last_used").fetchall():
+                conn.execute("DELETE FROM parsed WHERE rowid = ?", (rowid,))
+                excess -= size
+                if excess <= 0:
+                    break
+        conn.commit()
+
+    def stats(self) -> dict:
+        count, total = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM parsed").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": count,
+            "megabytes": round(total / (1024 * 1024), 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+    # ------------------------------------------------------------------
+    # Serializzazione
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _encode(documents: List[Any], path: Path) -> bytes:
+        prefix = str(path)
+        items = []
+        for doc in documents:
+            data = doc.to_dict()
+            data.pop("embedding", None)
+            metadata = data.get("metadata", {})
+            # L'ordine delle chiavi conta: i metadati fanno parte del testo embeddato
+            data["metadata_order"] = list(metadata)
+            data["metadata"] = {k: v for k, v in metadata.items() if k not in FILE_METADATA_KEYS}
+            # Id relativo al percorso (filename_as_id): "<percorso>_part_0" → "_part_0"
+            doc_id = data.pop("id_", "")
+            data["id_suffix"] = doc_id[len(prefix):] if doc_id.startswith(prefix) else None
+            items.append(data)
+        return zlib.compress(json.dumps(items, ensure_ascii=False).encode("utf-8"), 6)
+
+    @staticmethod
+    def _decode(blob: bytes, path: Path) -> List[Any]:
+        from llama_index.core import Document
+        from llama_index.core.readers.file.base import default_file_metadata_func
+
+        file_metadata = default_file_metadata_func(str(path))
+        documents = []
+        for data in json.loads(zlib.decompress(blob).decode("utf-8")):
+            suffix = data.pop("id_suffix", None)
+            stored = data.get("metadata", {})
+            data["metadata"] = {
+                key: file_metadata[key] if key in FILE_METADATA_KEYS else stored[key]
+                for key in data.pop("metadata_order", list(stored))
+                if key in stored or key in file_metadata
+            }
+            doc = Document.from_dict(data)
+            if suffix is not None:
+                doc.id_ = str(path) + suffix
+            documents.append(doc)
+        return documents
@@ -28,7 +28,6 @@ Per eseguire questo script, assicurati di aver installato:
 try:
     from llama_index.core import (
         VectorStoreIndex,
-        SimpleDirectoryReader,
         Settings,
         StorageContext,
         load_index_from_storage,
@@ -40,6 +39,11 @@ try:
     from llama_index.core.query_engine import RetrieverQueryEngine
     from llama_index.core.response.pprint_utils import pprint_response
     import google.generativeai as genai
+    from document_parser import DocumentParser
+    from parsed_cache import ParsedTextCache
+    from embedding_cache import EmbeddingCache, CachedEmbedding
+    from index_manifest import scan_documents
+    from ingestion import exclude_path_metadata
 except ImportError as e:
     print(f"❌ Errore di importazione: {e}")
     print("Esegui: pip install llama-index llama-index-llms-google-genai llama-index-embeddings-google-genai google-generativeai pypdf")
@@ -109,7 +113,9 @@ def setup_models():
     
     # Configurazione globale di LlamaIndex
     Settings.llm = llm
-    Settings.embed_model = embed_model
+    # Cache persistente degli embedding (la stessa dell'API server): i chunk
+    # con testo già embeddato non vengono inviati di nuovo a Gemini
+    Settings.embed_model = CachedEmbedding(embed_model, EmbeddingCache("./cache/embeddings.sqlite"))
     Settings.chunk_size = 512  # Dimensione dei chunk di testo
     Settings.chunk_overlap = 50  # Sovrapposizione tra chunk per mantenere contesto
     
@@ -144,16 +150,18 @@ def load_documents(documents_path: str) -> List[Any]:
         print(f"📝 Inserisci i tuoi documenti PDF in: {documents_path}")
         return []
     
-    # SimpleDirectoryReader carica automaticamente vari formati
-    reader = SimpleDirectoryReader(
-        input_dir=documents_path,
-        recursive=True,  # Cerca anche nelle sottodirectory
-        required_exts=[".pdf", ".txt", ".docx", ".md"],  # Formati supportati
-    )
+    # Lettura in parallelo (un processo per core, timeout per file): un file
+    # non leggibile viene segnalato e saltato, gli altri vengono caricati.
+    # Il testo dei file già letti (stesso contenuto) arriva dalla cache
+    files = scan_documents(documents_path)  # anche nelle sottodirectory
+    parser = DocumentParser(cache=ParsedTextCache("./cache/parsed.sqlite"))
     
     try:
-        documents = reader.load_data()
-        print(f"✅ Caricati {len(documents)} documenti\n")
+        documents = []
+        for result in parser.parse(files):
+            documents.extend(result.documents)
+        print(f"✅ Caricati {len(documents)} documenti"
+              f"{f' ({parser.last_stats.failed} file non leggibili)' if parser.last_stats.failed else ''}\n")
         
         # Mostra informazioni sui documenti caricati
         for i, doc in enumerate(documents, 1):
@@ -214,13 +222,24 @@ def create_vector_index(documents: List[Any], persist_dir: str = "./storage") ->
         chunk_overlap=Settings.chunk_overlap
     )
     
+    # Stesso testo embeddato dell'API server (percorso escluso, vedi
+    # ingestion.exclude_path_metadata): la cache degli embedding è condivisa
+    for document in documents:
+        exclude_path_metadata(document)
+    
     print("  🧮 Generazione embeddings (questo può richiedere qualche minuto)...")
+    cache = Settings.embed_model.cache
+    hits, misses = cache.hits, cache.misses
     # Crea l'indice vettoriale
     index = VectorStoreIndex.from_documents(
         documents,
         transformations=[parser],
         show_progress=True,
     )
+    hits, misses = cache.hits - hits, cache.misses - misses
+    if hits + misses:
+        print(f"  🧮 Cache embedding: {hits}/{hits + misses} chunk già embeddati "
+              f"(hit rate {hits / (hits + misses):.0%})")
     
     # Salva l'indice su disco
     print(f"  💾 Salvataggio indice in: {persist_dir}")
@@ -0,0 +1,280 @@
+"""
+Shared Index - Indice condiviso tra più processi uvicorn
+=========================================================
+Con più worker (uvicorn --workers N) ogni processo caricherebbe la propria
+copia del docstore JSON. Qui il docstore viene esportato, a ogni
+salvataggio dell'indice, in un formato che i worker aprono in memory-map
+in sola lettura: il testo dei nodi resta nella page cache del sistema
+operativo, una sola copia per tutti i processi (come già la matrice .npy
+degli embedding di NumpyVectorStore).
+
+Layout in persist_dir/shared_docstore/, per ogni collezione del docstore:
+- <n>.keys.npy     chiavi ordinate (bytes a larghezza fissa, ricerca binaria)
+- <n>.offsets.npy  offset di ogni valore in <n>.bin (int64, len = chiavi + 1)
+- <n>.bin          valori JSON concatenati (UTF-8)
+- manifest.json    collezione → <n> e stato di docstore.json all'esportazione
+
+Coordinamento tra worker:
+- index_build_lock(): lock su file; un solo processo alla volta costruisce
+  o aggiorna l'indice su disco, gli altri attendono e poi lo aprono
+- GenerationFile: file accanto a ./storage con un token che cambia a ogni
+  ricostruzione; i worker lo controllano periodicamente e, se cambia,
+  rimappano l'indice nuovo
+"""
+
+import os
+import json
+import uuid
+import weakref
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+import numpy as np
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.core.storage.kvstore.types import DEFAULT_COLLECTION, BaseKVStore
+
+try:
+    import fcntl
+except ImportError:  # Windows: un solo worker, nessun lock necessario
+    fcntl = None
+
+SHARED_DIR = "shared_docstore"
+MANIFEST_FNAME = "manifest.json"
+DOCSTORE_FNAME = "docstore.json"
+
+
+class ReadOnlyStoreError(PermissionError):
+    """Scrittura su un docstore condiviso (in memory-map, sola lettura)"""
+
+
+# Store aperti in questo processo: su Windows vanno rilasciati prima di
+# sostituire la loro directory (vedi release_mappings)
+_open_stores: "weakref.WeakSet[MmapKVStore]" = weakref.WeakSet()
+
+
+def shared_docstore_path(persist_dir: str) -> str:
+    return os.path.join(persist_dir, SHARED_DIR)
+
+
+def _docstore_stamp(persist_dir: str) -> Optional[list]:
+    """Dimensione e mtime di docstore.json: cambiano se qualcuno salva l'indice senza esportarlo"""
+    try:
+        stat = os.stat(os.path.join(persist_dir, DOCSTORE_FNAME))
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def has_shared_docstore(persist_dir: str) -> bool:
+    """True se esiste un'esportazione allineata al docstore.json corrente"""
+    try:
+        with open(os.path.join(shared_docstore_path(persist_dir), MANIFEST_FNAME), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return False
+    return manifest.get("source") == _docstore_stamp(persist_dir)
+
+
+def export_docstore(docstore, persist_dir: str) -> bool:
+    """
+    Esporta il docstore (SimpleDocumentStore) nel formato memory-mappable.
+    Va chiamata subito dopo il persist dell'indice in persist_dir.
+    I file vengono scritti in una directory temporanea e poi sostituiti
+    con un rename: un worker non vede mai un'esportazione a metà.
+
+    Returns:
+        False se il docstore non è esportabile (es. già in sola lettura)
+    """
+    kvstore = getattr(docstore, "_kvstore", None)
+    if kvstore is None or not hasattr(kvstore, "to_dict"):
+        return False
+
+    target = shared_docstore_path(persist_dir)
+    tmp = f"{target}.tmp-{uuid.uuid4().hex[:8]}"
+    os.makedirs(tmp)
+    manifest = {}
+    for n, (collection, mapping) in enumerate(sorted(kvstore.to_dict().items())):
+        keys = sorted(mapping)
+        encoded = [k.encode("utf-8") for k in keys]
+        width = max((len(k) for k in encoded), default=1)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        with open(os.path.join(tmp, f"{n}.bin"), "wb") as f:
+            for i, key in enumerate(keys):
+                value = json.dumps(mapping[key], ensure_ascii=False).encode("utf-8")
+                f.write(value)
+                offsets[i + 1] = offsets[i] + len(value)
+        np.save(os.path.join(tmp, f"{n}.keys.npy"), np.array(encoded, dtype=f"S{width}"))
+        np.save(os.path.join(tmp, f"{n}.offsets.npy"), offsets)
+        manifest[collection] = str(n)
+    with open(os.path.join(tmp, MANIFEST_FNAME), "w", encoding="utf-8") as f:
+        json.dump({"collections": manifest, "source": _docstore_stamp(persist_dir)}, f)
+
+    # Sostituzione: i worker che hanno già mappato la versione precedente
+    # continuano a leggerla (i file aperti restano validi fino alla chiusura).
+    # Su Windows una directory con file mappati non si rinomina: le mappe di
+    # questo processo vengono prima copiate in RAM
+    if os.name == "nt":
+        release_mappings(target)
+    old = f"{target}.old-{uuid.uuid4().hex[:8]}"
+    if os.path.exists(target):
+        os.rename(target, old)
+    os.rename(tmp, target)
+    if os.path.exists(old):
+        import shutil
+        shutil.rmtree(old, ignore_errors=True)
+    return True
+
+
+class _Collection:
+    """Una collezione esportata: chiavi ordinate + valori JSON in memory-map"""
+
+    def __init__(self, directory: str, prefix: str):
+        self.keys = np.load(os.path.join(directory, f"{prefix}.keys.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, f"{prefix}.offsets.npy"), mmap_mode="r")
+        bin_path = os.path.join(directory, f"{prefix}.bin")
+        self.data = np.memmap(bin_path, dtype=np.uint8, mode="r") if os.path.getsize(bin_path) else np.empty(0, np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def release_mmap(self):
+        """Copia in RAM chiavi, offset e valori (le mappe si chiudono con l'ultimo riferimento)"""
+        self.keys = np.array(self.keys)
+        self.offsets = np.array(self.offsets)
+        self.data = np.array(self.data)
+
+    def get(self, key: str) -> Optional[dict]:
+        encoded = key.encode("utf-8")
+        if not len(self.keys) or len(encoded) > self.keys.dtype.itemsize:
+            return None
+        i = int(np.searchsorted(self.keys, encoded))
+        if i >= len(self.keys) or self.keys[i] != encoded:
+            return None
+        return json.loads(self.data[self.offsets[i]:self.offsets[i + 1]].tobytes())
+
+    def items(self):
+        for i, key in enumerate(self.keys):
+            yield key.decode("utf-8"), json.loads(self.data[self.offsets[i]:self.offsets[i + 1]].tobytes())
+
+
+class MmapKVStore(BaseKVStore):
+    """KV store in sola lettura sui file esportati da export_docstore"""
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, MANIFEST_FNAME), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        self._collections: Dict[str, _Collection] = {
+            name: _Collection(directory, prefix) for name, prefix in manifest["collections"].items()
+        }
+        self.directory = os.path.abspath(directory)
+        _open_stores.add(self)
+
+    def release_mmap(self):
+        """Rinuncia al memory-map: i dati restano in RAM in questo processo"""
+        for table in self._collections.values():
+            table.release_mmap()
+
+    def count(self, collection: str = DEFAULT_COLLECTION) -> int:
+        table = self._collections.get(collection)
+        return len(table) if table is not None else 0
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        table = self._collections.get(collection)
+        return table.get(key) if table is not None else None
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        table = self._collections.get(collection)
+        return dict(table.items()) if table is not None else {}
+
+    async def aget(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        return self.get(key, collection)
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        return self.get_all(collection)
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        raise ReadOnlyStoreError("Docstore condiviso in sola lettura: impossibile scrivere")
+
+    async def aput(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put(key, val, collection)
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        raise ReadOnlyStoreError("Docstore condiviso in sola lettura: impossibile eliminare")
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self.delete(key, collection)
+
+
+class SharedDocumentStore(KVDocumentStore):
+    """Docstore in sola lettura condiviso tra processi (memory-map)"""
+
+    def __init__(self, persist_dir: str, **kwargs: Any):
+        super().__init__(MmapKVStore(shared_docstore_path(persist_dir)), **kwargs)
+
+    def __len__(self) -> int:
+        return self._kvstore.count(self._node_collection)
+
+    def release_mmap(self):
+        self._kvstore.release_mmap()
+
+    def persist(self, persist_path: str = "", fs: Any = None) -> None:
+        """Niente da salvare: i file sono già quelli esportati dal processo che ha costruito l'indice"""
+
+
+def release_mappings(directory: str):
+    """Copia in RAM gli store di questo processo mappati da directory (o da sue sottodirectory)"""
+    directory = os.path.abspath(directory)
+    for store in list(_open_stores):
+        if store.directory == directory or store.directory.startswith(directory + os.sep):
+            store.release_mmap()
+
+
+@contextmanager
+def index_build_lock(lock_path: str):
+    """Lock esclusivo tra processi (bloccante) per costruire/aggiornare l'indice su disco"""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    with open(lock_path, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class GenerationFile:
+    """
+    Token della versione dell'indice su disco, condiviso tra i worker.
+    bump() dopo ogni ricostruzione; changed() è un confronto economico
+    (stat del file) da chiamare periodicamente.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.loaded: Optional[str] = None
+
+    def read(self) -> Optional[str]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def bump(self) -> str:
+        """Pubblica una nuova versione (scrittura atomica) e la segna come caricata"""
+        token = uuid.uuid4().hex
+        tmp = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(token)
+        os.replace(tmp, self.path)
+        self.loaded = token
+        return token
+
+    def mark_loaded(self, token: Optional[str]):
+        self.loaded = token
+
+    def changed(self) -> bool:
+        token = self.read()
+        return token is not None and token != self.loaded
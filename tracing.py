@@ -0,0 +1,314 @@
+"""
+Tracing - Log strutturati e span per richiesta
+===============================================
+- Log JSON (una riga per evento) scritti da un thread dedicato tramite
+  QueueHandler/QueueListener: l'event loop non attende mai stdout
+- Request id per richiesta (header X-Request-ID in ingresso o generato),
+  propagato con contextvars attraverso chat_completions → run_query →
+  retriever → LLM e aggiunto a ogni riga di log
+- Span: durata delle fasi della richiesta (embed, retrieve, synthesize...),
+  restituite nell'header Server-Timing e registrate nel log di accesso
+
+Le chiamate all'LLM dentro LlamaIndex vengono tracciate con un event
+handler della instrumentation di LlamaIndex, che raccoglie anche i token
+di prompt e di risposta (usage) di ogni richiesta.
+"""
+
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import logging
+import logging.handlers
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("rag")
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("rag_trace", default=None)
+_listener: Optional[logging.handlers.QueueListener] = None
+
+# Attributi standard di LogRecord, esclusi dai campi "extra" del JSON
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class Trace:
+    """Span di una singola richiesta"""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float]] = []
+        # Span LlamaIndex aperti: (tipo, span_id) → (inizio, prompt inviato)
+        self.open_spans: Dict[Tuple[str, str], Tuple[float, str]] = {}
+        # Token usati dalle chiamate al LLM della richiesta
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # Usage riportato da una chiamata annidata, in attesa della più esterna
+        self.pending_usage: Optional[Tuple[int, int]] = None
+
+    def add(self, name: str, duration: float):
+        self.spans.append((name, duration))
+
+    def add_usage(self, prompt_tokens: int, completion_tokens: int):
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+
+    def usage(self) -> Dict[str, int]:
+        """Token della richiesta nel formato usage di OpenAI"""
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+        }
+
+    def breakdown(self) -> Dict[str, float]:
+        """Millisecondi per fase (le fasi ripetute vengono sommate)"""
+        result: Dict[str, float] = {}
+        for name, duration in self.spans:
+            result[name] = round(result.get(name, 0.0) + duration * 1000, 2)
+        result["total"] = round((time.perf_counter() - self.started) * 1000, 2)
+        return result
+
+    def server_timing(self) -> str:
+        """Valore dell'header Server-Timing (es. "retrieve;dur=4.1, synthesize;dur=812.0")"""
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.breakdown().items())
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def current_request_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.request_id if trace is not None else None
+
+
+@contextmanager
+def span(name: str):
+    """Registra la durata del blocco come span della richiesta corrente"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, time.perf_counter() - started)
+
+
+# ============================================================================
+# LOGGING
+# ============================================================================
+
+class RequestIdFilter(logging.Filter):
+    """Aggiunge request_id a ogni record (letto dal contesto del chiamante)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = current_request_id()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Una riga JSON per record, con i campi passati in extra={...}"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.request_id:
+            data["request_id"] = record.request_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and key != "request_id":
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: str = "INFO", fmt: str = "json"):
+    """
+    Configura il logger "rag": i record vanno in una coda in memoria e un
+    thread dedicato li formatta e li scrive su stdout.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(message)s"))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Il request id va letto nel thread del chiamante, prima di entrare in coda
+    queue_handler.addFilter(RequestIdFilter())
+
+    logger.handlers[:] = [queue_handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=False)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Svuota la coda dei log e ferma il thread di scrittura"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# ============================================================================
+# MIDDLEWARE E INSTRUMENTATION
+# ============================================================================
+
+class TracingMiddleware:
+    """
+    Middleware ASGI: crea il Trace della richiesta, restituisce X-Request-ID
+    (e Server-Timing se server_timing=True) e scrive una riga di log di
+    accesso con il dettaglio delle latenze.
+
+    Nelle risposte in streaming le intestazioni partono prima della
+    generazione: Server-Timing contiene solo le fasi già concluse.
+    """
+
+    def __init__(self, app, server_timing: bool = True, skip_paths: Tuple[str, ...] = ("/metrics",)):
+        self.app = app
+        self.server_timing = server_timing
+        self.skip_paths = skip_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope.get("headers") or []).get(b"x-request-id")
+        request_id = incoming.decode("latin-1")[:128] if incoming else uuid.uuid4().hex[:16]
+        trace = Trace(request_id)
+        token = _current_trace.set(trace)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", request_id.encode("latin-1")))
+                if self.server_timing:
+                    headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            logger.info(
+                "richiesta HTTP",
+                extra={
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status["code"],
+                    "timings_ms": trace.breakdown(),
+                },
+            )
+            _current_trace.reset(token)
+
+
+def _reported_usage(response) -> Optional[Tuple[int, int]]:
+    """(prompt, completion) riportati dal provider (Gemini: usage_metadata)"""
+    extra = getattr(response, "additional_kwargs", None) or {}
+    if extra.get("prompt_tokens") is not None:
+        return int(extra["prompt_tokens"]), int(extra.get("completion_tokens") or 0)
+    raw = getattr(response, "raw", None)
+    metadata = raw.get("usage_metadata") if isinstance(raw, dict) else None
+    if metadata and metadata.get("prompt_token_count") is not None:
+        return int(metadata["prompt_token_count"]), int(metadata.get("candidates_token_count") or 0)
+    return None
+
+
+def _prompt_text(event) -> str:
+    messages = getattr(event, "messages", None)
+    if messages is not None:
+        return "\n".join(str(m.content or "") for m in messages)
+    return str(getattr(event, "prompt", "") or "")
+
+
+def _response_text(response) -> str:
+    message = getattr(response, "message", None)
+    if message is not None:
+        return str(message.content or "")
+    return str(getattr(response, "text", "") or "")
+
+
+def instrument_llama_index():
+    """
+    Span "llm" (chiamate a Gemini dentro synthesize) e usage dagli eventi di
+    instrumentation di LlamaIndex, attribuiti alla richiesta corrente
+    tramite contextvars. I token sono quelli riportati da Gemini; se il
+    provider non li fornisce vengono contati con il tokenizer di LlamaIndex.
+    """
+    from llama_index.core.instrumentation import get_dispatcher
+    from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+    from llama_index.core.utils import get_tokenizer
+
+    starts = {
+        "LLMChatStartEvent": "llm",
+        "LLMCompletionStartEvent": "llm",
+    }
+    ends = {
+        "LLMChatEndEvent": "llm",
+        "LLMCompletionEndEvent": "llm",
+    }
+    class TraceEventHandler(BaseEventHandler):
+        @classmethod
+        def class_name(cls) -> str:
+            return "TraceEventHandler"
+
+        def handle(self, event, **kwargs):
+            # Chiamato anche per ogni token in streaming: solo confronti di stringhe
+            name = type(event).__name__
+            if name not in starts and name not in ends:
+                return
+            trace = _current_trace.get()
+            if trace is None:
+                return
+            if name in starts:
+                trace.open_spans[(starts[name], str(event.span_id))] = (time.perf_counter(), _prompt_text(event))
+                return
+            kind = ends[name]
+            opened = trace.open_spans.pop((kind, str(event.span_id)), None)
+            if opened is None:
+                return
+            usage = _reported_usage(event.response)
+            # Chiamate annidate (es. complete → chat):
+            # conta solo la più esterna
+            if any(k == kind for k, _ in trace.open_spans):
+                trace.pending_usage = usage or trace.pending_usage
+                return
+            started, prompt = opened
+            duration = time.perf_counter() - started
+            trace.add(kind, duration)
+
+            usage = usage or trace.pending_usage
+            trace.pending_usage = None
+            if usage is None:
+                tokenizer = get_tokenizer()
+                usage = (len(tokenizer(prompt)), len(tokenizer(_response_text(event.response))))
+            trace.add_usage(*usage)
+            logger.debug(kind, extra={
+                "duration_ms": round(duration * 1000, 2),
+                "prompt_tokens": usage[0],
+                "completion_tokens": usage[1],
+            })
+
+    get_dispatcher().add_event_handler(TraceEventHandler())